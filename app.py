@@ -1,13 +1,39 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, jsonify,
+    abort, Response, stream_with_context)
+from flask.ctx import _AppCtxGlobals
+from sqlalchemy.orm import make_transient_to_detached
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError, PendingRollbackError
 from functools import wraps
-
-from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Like
+from itertools import islice
+
+from cache import TTLCache
+from httpcache import conditional
+from instrumentation import connect_instrumentation
+from migrations import connect_migrations
+from passwords import connect_passwords
+from replicas import REPLICA_BIND, connect_replicas, pool_options
+from forms import (
+    UserAddForm, LoginForm, MessageForm, UserEditForm, FollowImportForm)
+from models import (
+    db, connect_db, User, Message, Like, Follows, MESSAGE_CARD_OPTIONS)
 from admin import ADMINPASSWORD
+import bulk_follows
+import deletion
+import fragments
+import graph
+import reads
+import search
+import suggestions
+import timeline
+import trending
+from pagination import (
+    connect_pagination, decode_message_cursor, page_size, paginate_messages,
+    paginate_users)
 
 CURR_USER_KEY = "curr_user"
 
@@ -17,14 +43,47 @@ app = Flask(__name__)
 # if not set there, use development local db.
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DB_URL', 'postgresql:///warbler'))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = pool_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+    max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)))
+
+# Optional read replica: GET requests read from it (see replicas.py).
+if os.environ.get('REPLICA_DB_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {
+        REPLICA_BIND: os.environ['REPLICA_DB_URL']}
+    app.config['REPLICA_ENGINE_OPTIONS'] = pool_options(
+        os.environ['REPLICA_DB_URL'],
+        pool_size=int(os.environ.get('REPLICA_POOL_SIZE', 10)),
+        max_overflow=int(os.environ.get('REPLICA_MAX_OVERFLOW', 20)))
+app.config['REPLICA_STICKY_SECONDS'] = float(
+    os.environ.get('REPLICA_STICKY_SECONDS', 5))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('PASSWORD_WORKERS', 2))
+app.config['USER_CACHE_SIZE'] = 10000
+app.config['USER_CACHE_TTL'] = 60
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
+app.config['FOLLOW_IMPORT_MAX'] = 5000
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+connect_replicas(app)
+connect_instrumentation(app)
+connect_passwords(app)
+timeline.connect_timelines(app)
+connect_pagination(app)
+fragments.connect_fragments(app)
+search.connect_search(app)
+connect_migrations(app)
+deletion.connect_deletion(app)
+trending.connect_trending(app)
+suggestions.connect_suggestions(app)
+graph.connect_graph(app)
 
 
 ##############################################################################
@@ -39,16 +98,93 @@ def check_authenticated(func):
         return func(*args, **kwargs)
     return wrap
 
+# Profile columns of recently seen users, by id. Counters and the password
+# hash aren't cached; they're loaded from the database if used.
+USER_CACHE_COLUMNS = ('id', 'username', 'email', 'image_url',
+                      'header_image_url', 'bio', 'location', 'admin')
+
+user_cache = TTLCache(maxsize=app.config['USER_CACHE_SIZE'],
+                      ttl=app.config['USER_CACHE_TTL'])
+
+
+def get_cached_user(user_id):
+    """User `user_id`, from the identity cache if possible.
+
+    A cache hit is merged into the session without a query; columns that
+    aren't cached load on first access.
+    """
+
+    columns = user_cache.get(user_id)
+
+    if columns is None:
+        user = User.query.get(user_id)
+        if user is not None:
+            user_cache.set(user_id, {name: getattr(user, name)
+                                     for name in USER_CACHE_COLUMNS})
+        return user
+
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def forget_cached_user(user_id):
+    """Drop a user from the identity cache after changing their profile."""
+
+    user_cache.pop(user_id)
+
+
+class LazyGlobals(_AppCtxGlobals):
+    """Flask `g` that resolves `g.user` and `g.form` on first access.
+
+    Requests that never look at them (redirects, static files, many 404s)
+    don't pay for a user lookup or a form.
+    """
+
+    def __getattr__(self, name):
+        if name == 'user':
+            user_id = session.get(CURR_USER_KEY)
+            value = get_cached_user(user_id) if user_id else None
+        elif name == 'form':
+            value = MessageForm()
+        else:
+            return super().__getattr__(name)
+
+        setattr(self, name, value)
+        return value
+
+
+app.app_ctx_globals_class = LazyGlobals
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
-    g.form = MessageForm()
+    """Forget any user or form resolved earlier in this app context.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    They're looked up again, lazily, the first time the request uses them.
+    """
 
-    else:
-        g.user = None
+    g.pop('user', None)
+    g.pop('form', None)
+
+
+def viewer_liked_ids(messages):
+    """Ids of `messages` the logged-in user has liked, for message_card."""
+
+    if not g.user:
+        return set()
+
+    return Like.liked_ids(g.user.id, [message.id for message in messages])
+
+
+def load_viewer_follows(users):
+    """Look up which of `users` the logged-in user follows, in one query.
+
+    user_card's is_following checks are then set lookups.
+    """
+
+    if g.user:
+        g.user.load_following_ids([user.id for user in users])
 
 
 def do_login(user):
@@ -113,6 +249,8 @@ def login():
                                  form.password.data)
     
         if user:
+            # Saves the password's rehash, if authenticate made one.
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -137,17 +275,46 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location (best matches first).
     """
 
-    search = request.args.get('q')
+    term = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
+    if not term:
+        page = paginate_users(User.query, request.args.get('cursor'))
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = search.search_users(term, request.args.get('cursor'))
+
+    load_viewer_follows(page.items)
+
+    return render_template('users/index.html', users=page.items, page=page)
 
-    return render_template('users/index.html', users=users)
+
+def viewer_connections(user, shown=3):
+    """How the logged-in user is connected to `user`, from the follow graph.
+
+    Returns template values: `follows_you`, `followed_by` (up to `shown`
+    of the users the viewer follows who follow `user`) and
+    `followed_by_count`. Empty on the viewer's own profile.
+    """
+
+    if not g.user or g.user.id == user.id:
+        return {}
+
+    follow_graph = graph.get_graph()
+    followed_by_ids = follow_graph.followed_by_followed(g.user.id, user.id)
+
+    followed_by = []
+    if followed_by_ids:
+        followed_by = (User.query
+                       .filter(User.id.in_(followed_by_ids[:shown]))
+                       .order_by(User.id)
+                       .all())
+
+    return {'follows_you': follow_graph.follows(user.id, g.user.id),
+            'followed_by': followed_by,
+            'followed_by_count': len(followed_by_ids)}
 
 
 @app.route('/users/<int:user_id>')
@@ -156,14 +323,33 @@ def users_show(user_id):
 
     user = User.query.get_or_404(user_id)
 
-    return render_template('users/show.html', user=user)
+    def render():
+        query = (Message.query
+                 .options(*MESSAGE_CARD_OPTIONS)
+                 .filter_by(user_id=user.id))
+        page = paginate_messages(query, request.args.get('cursor'))
+
+        return render_template('users/show.html', user=user, page=page,
+                               liked_ids=viewer_liked_ids(page.items),
+                               **viewer_connections(user))
+
+    # Posting, being (un)followed and profile edits all update the user;
+    # the viewer's connections change with the viewer's or the user's
+    # follows, which update one of them, but only show up here once the
+    # follow graph has them.
+    return conditional(render, user.id, user.updated_at, graph.loaded_at())
 
 @app.route('/users/<int:user_id>/following')
 @check_authenticated
 def show_following(user_id):
     """Show list of people this user is following."""
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    query = (User.query
+             .join(Follows, Follows.user_being_followed_id == User.id)
+             .filter(Follows.user_following_id == user.id))
+    page = paginate_users(query, request.args.get('cursor'))
+    load_viewer_follows(page.items)
+    return render_template('users/following.html', user=user, page=page)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -171,7 +357,46 @@ def show_following(user_id):
 def users_followers(user_id):
     """Show list of followers of this user."""
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    query = (User.query
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user.id))
+    page = paginate_users(query, request.args.get('cursor'))
+    load_viewer_follows(page.items)
+    return render_template('users/followers.html', user=user, page=page)
+
+
+def user_exists(user_id):
+    return db.session.query(User.query.filter_by(id=user_id).exists()).scalar()
+
+
+def set_following(followed_id, following):
+    """Make the logged-in user follow (or not) `followed_id` (idempotent).
+
+    Writes the follows row directly, without loading either user's
+    collections; counters and timelines only change if the row did.
+    """
+
+    if following:
+        changed = Follows.add(g.user.id, followed_id)
+    else:
+        changed = Follows.remove(g.user.id, followed_id)
+
+    if not changed:
+        return
+
+    delta = 1 if following else -1
+    User.bump_counts(g.user.id, following_count=delta)
+    User.bump_counts(followed_id, followers_count=delta)
+    db.session.commit()
+
+    if following:
+        timeline.follow_added(g.user.id, followed_id)
+    else:
+        timeline.follow_removed(g.user.id, followed_id)
+
+    graph.follows_changed(g.user.id, [followed_id], following)
+    suggestions.follows_changed(g.user.id,
+                                [followed_id] if following else [])
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -179,9 +404,13 @@ def users_followers(user_id):
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    if not user_exists(follow_id):
+        abort(404)
+
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+    else:
+        set_following(follow_id, True)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -191,13 +420,163 @@ def add_follow(follow_id):
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    if not user_exists(follow_id):
+        abort(404)
+
+    set_following(follow_id, False)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
+@app.route('/api/users/<int:user_id>/follow', methods=['PUT', 'DELETE'])
+def api_follow_user(user_id):
+    """Follow (PUT) or unfollow (DELETE) a user. Safe to repeat.
+
+    Returns JSON: {"following": true/false, "followers_count": the
+    user's followers}.
+    """
+
+    if not g.user:
+        return jsonify(error="Log in to follow users."), 401
+
+    if not user_exists(user_id):
+        return jsonify(error="No such user."), 404
+
+    if user_id == g.user.id:
+        return jsonify(error="You can't follow yourself."), 400
+
+    following = request.method == 'PUT'
+    set_following(user_id, following)
+
+    followers_count = (db.session
+                       .query(User.followers_count)
+                       .filter_by(id=user_id)
+                       .scalar())
+
+    return jsonify(following=following, followers_count=followers_count)
+
+
+@app.route('/api/follows', methods=['POST', 'DELETE'])
+def api_bulk_follow():
+    """Follow (POST) or unfollow (DELETE) many users at once.
+
+    Takes JSON {"usernames": [...]} and/or {"user_ids": [...]}, up to
+    FOLLOW_IMPORT_MAX in all. Returns {"followed" (or "unfollowed"): ids
+    whose follow changed, "not_found": usernames that don't exist}.
+    """
+
+    if not g.user:
+        return jsonify(error="Log in to follow users."), 401
+
+    data = request.get_json(silent=True) or {}
+    usernames = data.get('usernames') or []
+    user_ids = data.get('user_ids') or []
+
+    if not (isinstance(usernames, list) and isinstance(user_ids, list)
+            and all(isinstance(name, str) for name in usernames)
+            and all(isinstance(user_id, int) for user_id in user_ids)):
+        return jsonify(error="Expected lists of usernames and user_ids."), 400
+
+    if len(usernames) + len(user_ids) > app.config['FOLLOW_IMPORT_MAX']:
+        return jsonify(error="Too many users in one request."), 413
+
+    found = bulk_follows.resolve_usernames(usernames)
+    user_ids = list(found.values()) + user_ids
+
+    not_found = [name for name in bulk_follows.unique(usernames)
+                 if name not in found]
+
+    if request.method == 'POST':
+        followed = bulk_follows.follow_many(g.user.id, user_ids)
+        timeline.follows_changed(g.user.id)
+        graph.follows_changed(g.user.id, followed, True)
+        suggestions.follows_changed(g.user.id, followed)
+        return jsonify(followed=followed, not_found=not_found)
+
+    unfollowed = bulk_follows.unfollow_many(g.user.id, user_ids)
+    timeline.follows_changed(g.user.id, unfollowed)
+    graph.follows_changed(g.user.id, unfollowed, False)
+    suggestions.follows_changed(g.user.id)
+    return jsonify(unfollowed=unfollowed, not_found=not_found)
+
+
+@app.route('/api/suggestions')
+def api_suggestions():
+    """Who the logged-in user might follow, best first (see suggestions.py).
+
+    Returns JSON: {"suggestions": [{"user": {...}, "followed_by": how many
+    of the user's follows follow them}, ...]}.
+    """
+
+    if not g.user:
+        return jsonify(error="Log in to see suggestions."), 401
+
+    return jsonify(suggestions=[
+        {'user': {'id': user.id, 'username': user.username,
+                  'image_url': user.image_url},
+         'followed_by': user.overlap}
+        for user in suggestions.suggestions_for(g.user.id)
+    ])
+
+
+@app.route('/users/follows/import', methods=["GET", "POST"])
+@check_authenticated
+def import_follows():
+    """Follow every account named in an uploaded CSV of usernames."""
+
+    form = FollowImportForm()
+    limit = app.config['FOLLOW_IMPORT_MAX']
+
+    if form.validate_on_submit():
+        usernames = list(islice(
+            bulk_follows.read_usernames(form.file.data.stream), limit + 1))
+
+        if len(usernames) > limit:
+            flash(f"That file has more than {limit} usernames.", "danger")
+            return redirect("/users/follows/import")
+
+        usernames = bulk_follows.unique(usernames)
+
+        found = bulk_follows.resolve_usernames(usernames)
+        added = bulk_follows.follow_many(g.user.id, found.values())
+        timeline.follows_changed(g.user.id)
+        graph.follows_changed(g.user.id, added, True)
+        suggestions.follows_changed(g.user.id, added)
+
+        flash(f"Followed {len(added)} new accounts "
+              f"({len(usernames) - len(found)} not found).", "success")
+        return redirect(f"/users/{g.user.id}/following")
+
+    return render_template('users/import.html', form=form, limit=limit)
+
+
+@app.route('/users/<int:user_id>/following.csv')
+@check_authenticated
+def export_following(user_id):
+    """Stream the usernames this user follows as CSV."""
+
+    return follow_list_csv(user_id, 'following')
+
+
+@app.route('/users/<int:user_id>/followers.csv')
+@check_authenticated
+def export_followers(user_id):
+    """Stream the usernames of this user's followers as CSV."""
+
+    return follow_list_csv(user_id, 'followers')
+
+
+def follow_list_csv(user_id, direction):
+    user = User.query.get_or_404(user_id)
+    usernames = bulk_follows.follow_list(user.id, direction)
+
+    return Response(
+        stream_with_context(bulk_follows.write_follow_list(usernames)),
+        mimetype='text/csv',
+        headers={'Content-Disposition':
+                 f'attachment; filename="{user.username}-{direction}.csv"'})
+
+
 @app.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
@@ -212,8 +591,11 @@ def profile():
             user.image_url = form.image_url.data or None
             user.header_image_url = form.header_image_url.data or None
             user.bio = form.bio.data
+            user.profile_version = User.profile_version + 1
 
             db.session.commit()
+            forget_cached_user(user.id)
+            fragments.forget_user(user.id)
 
             return redirect(f"/users/{user.id}")
         else:
@@ -227,12 +609,23 @@ def profile():
 @app.route('/users/delete', methods=["POST"])
 @check_authenticated
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    They're hidden right away; their rows are purged in the background
+    (see deletion.py).
+    """
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+
+    deletion.mark_deleted(user_id)
     db.session.commit()
+    forget_cached_user(user_id)
+    fragments.forget_user(user_id)
+
+    if app.config['PURGE_IN_BACKGROUND']:
+        deletion.get_worker().notify()
 
     return redirect("/signup")
 
@@ -253,18 +646,48 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        User.bump_counts(g.user.id, messages_count=1)
         db.session.commit()
 
+        timeline.message_added(msg)
+
         return redirect(f"/users/{g.user.id}")
 
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Page of messages matching the 'q' param, best matches first."""
+
+    term = request.args.get('q', '')
+    page = search.search_messages(term, request.args.get('cursor'))
+
+    return render_template('messages/search.html', term=term, page=page,
+                           liked_ids=viewer_liked_ids(page.items))
+
+
+@app.route('/messages/trending')
+def messages_trending():
+    """Recent messages ranked by likes and age (see trending.py)."""
+
+    messages = trending.trending_messages()
+
+    return render_template('messages/trending.html', messages=messages,
+                           liked_ids=viewer_liked_ids(messages))
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = (Message.query
+           .options(*MESSAGE_CARD_OPTIONS)
+           .get_or_404(message_id))
+
+    # Messages can't be edited; only the author's profile can change.
+    return conditional(
+        lambda: render_template('messages/show.html', message=msg),
+        msg.id, msg.user.updated_at)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -277,37 +700,207 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    release_counts_of_message(msg.id)
+    User.bump_counts(g.user.id, messages_count=-1)
     db.session.delete(msg)
     db.session.commit()
 
+    timeline.message_removed(message_id, g.user.id)
+    fragments.forget_message(message_id)
+
     return redirect(f"/users/{g.user.id}")
 
+def message_author_id(message_id):
+    """Id of a message's author, or None if there's no such message."""
+
+    return (db.session
+            .query(Message.user_id)
+            .filter_by(id=message_id)
+            .scalar())
+
+
+def set_like(message_id, liked):
+    """Make the logged-in user's like of a message `liked` (idempotent).
+
+    Writes the likes row directly; the counter only moves if it changed.
+    """
+
+    if liked:
+        changed = Like.add(g.user.id, message_id)
+    else:
+        changed = Like.remove(g.user.id, message_id)
+
+    if changed:
+        User.bump_counts(g.user.id, likes_count=1 if liked else -1)
+        Message.bump_like_count(message_id, 1 if liked else -1)
+    db.session.commit()
+
+
 @app.route('/messages/<int:message_id>/likes', methods=['POST'])
 @check_authenticated
 def add_liked_message(message_id):
-    """ Like a messages """
+    """Toggle a like on a message (for browsers without JavaScript)."""
+
+    author_id = message_author_id(message_id)
 
-    message = Message.query.get(message_id)
+    if author_id is None:
+        abort(404)
 
-    if message.user.id == g.user.id:
+    if author_id == g.user.id:
         flash("Can't like your own messages!", "danger")
         return redirect("/")
 
-    if message in g.user.liked_messages:
-        g.user.liked_messages.remove(message)
-        db.session.commit()
+    if message_id in Like.liked_ids(g.user.id, [message_id]):
+        set_like(message_id, False)
         flash('Message unliked!')
     else:
-        g.user.liked_messages.append(message)
-        db.session.commit()
+        set_like(message_id, True)
         flash('Message liked!')
-    
+
     return redirect('/')
 
+
+@app.route('/api/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+def api_like_message(message_id):
+    """Like (PUT) or unlike (DELETE) a message. Safe to repeat.
+
+    Returns JSON: {"liked": true/false, "like_count": likes on the message}.
+    """
+
+    if not g.user:
+        return jsonify(error="Log in to like messages."), 401
+
+    author_id = message_author_id(message_id)
+
+    if author_id is None:
+        return jsonify(error="No such message."), 404
+
+    if author_id == g.user.id:
+        return jsonify(error="Can't like your own messages!"), 403
+
+    liked = request.method == 'PUT'
+    set_like(message_id, liked)
+
+    like_count = (db.session.query(Message.like_count)
+                  .filter_by(id=message_id)
+                  .scalar())
+
+    return jsonify(liked=liked, like_count=like_count)
+
 @app.route('/users/<int:user_id>/likes')
 def show_liked_messages(user_id):
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)    
+    query = (Message.query
+             .options(*MESSAGE_CARD_OPTIONS)
+             .join(Like, Like.message_id == Message.id)
+             .filter(Like.user_id == user.id))
+    page = paginate_messages(query, request.args.get('cursor'))
+
+    # Liking, unliking and deletion of a liked message update the user;
+    # the authors shown can change their profiles independently.
+    return conditional(
+        lambda: render_template('users/likes.html', user=user, page=page),
+        user.id, user.updated_at,
+        *[message.user.updated_at for message in page.items])
+
+
+##############################################################################
+# JSON read API
+#
+# The same documents are served by asgi.py in async mode; the queries and
+# serializers are shared in reads.py.
+
+
+@app.route('/api/timeline')
+def api_timeline():
+    """The logged-in user's timeline, a page at a time (pass 'cursor')."""
+
+    if not g.user:
+        return jsonify(error="Log in to see your timeline."), 401
+
+    before = decode_message_cursor(request.args.get('cursor'))
+    entries, next_cursor = timeline.run(
+        timeline.timeline_entries(g.user.id, page_size(), before))
+
+    rows = []
+    if entries:
+        message_ids = [message_id for (_, message_id, _) in entries]
+        rows = db.session.execute(reads.messages_statement(message_ids)).all()
+
+    return jsonify(reads.entries_page(rows, entries, next_cursor))
+
+
+@app.route('/api/users/<int:user_id>')
+def api_user(user_id):
+    """A user's profile and first page of messages."""
+
+    user = db.session.execute(reads.user_statement(user_id)).first()
+    if user is None:
+        return jsonify(error="No such user."), 404
+
+    before = decode_message_cursor(request.args.get('cursor'))
+    rows = db.session.execute(
+        reads.user_messages_statement(user_id, page_size(), before)).all()
+
+    return jsonify(user=reads.user_json(user),
+                   **reads.message_page(rows, page_size()))
+
+
+@app.route('/api/users/<int:user_id>/likes')
+def api_user_likes(user_id):
+    """The messages a user has liked, a page at a time."""
+
+    if db.session.execute(reads.user_exists_statement(user_id)).first() is None:
+        return jsonify(error="No such user."), 404
+
+    before = decode_message_cursor(request.args.get('cursor'))
+    rows = db.session.execute(
+        reads.liked_messages_statement(user_id, page_size(), before)).all()
+
+    return jsonify(reads.message_page(rows, page_size()))
+
+
+@app.route('/api/messages/<int:message_id>')
+def api_message(message_id):
+    """A single message."""
+
+    row = db.session.execute(reads.message_statement(message_id)).first()
+    if row is None:
+        return jsonify(error="No such message."), 404
+
+    return jsonify(message=reads.message_json(row))
+
+
+##############################################################################
+# Denormalized counters
+
+
+def release_counts_of_message(message_id):
+    """Decrement likes_count of every user who liked this message.
+
+    Call before deleting the message; the likes rows go with it.
+    """
+
+    liker_ids = db.select([Like.user_id]).where(Like.message_id == message_id)
+
+    User.bump_counts(liker_ids, likes_count=-1)
+
+
+@app.cli.command('recount')
+@click.option('--user-id', 'user_ids', type=int, multiple=True,
+              help="Only recount these users (repeatable).")
+def recount_command(user_ids):
+    """Recompute the stored follower/following/message/like counters.
+
+    Messages' like counts are recounted too, unless limited to some users.
+    """
+
+    repaired = User.recount(user_ids or None)
+    messages_repaired = 0 if user_ids else Message.recount_likes()
+    db.session.commit()
+
+    click.echo(f"Repaired counters for {repaired} user(s) "
+               f"and {messages_repaired} message(s).")
 
 
 ##############################################################################
@@ -319,38 +912,41 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a
+      time (pass 'cursor' for older pages)
+
+    The logged-in timeline comes from the precomputed store in
+    timeline.py, rebuilt from the database when it's cold.
     """
 
     if g.user:
-        user_id_to_display = [user.id for user in g.user.following]
-        user_id_to_display.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(user_id_to_display))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        before = decode_message_cursor(request.args.get('cursor'))
+        page = timeline.home_timeline(g.user.id, page_size(), before)
 
-        return render_template('home.html', messages=messages)
+        return render_template('home.html', messages=page.items, page=page,
+                               liked_ids=viewer_liked_ids(page.items),
+                               suggested=suggestions.suggestions_for(g.user.id))
 
     else:
-        return render_template('home-anon.html')
+        return conditional(lambda: render_template('home-anon.html'))
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Turn off caching for everything that doesn't ask for it
+#
+# Pages sent through httpcache.conditional are revalidated with ETags, and
+# static files are cached for SEND_FILE_MAX_AGE_DEFAULT. Anything else
+# (forms with CSRF tokens, redirects, account pages) is never stored.
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to responses without their own policy."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if request.endpoint != 'static' and 'Cache-Control' not in response.headers:
+        response.cache_control.no_store = True
     return response
 
 
@@ -0,0 +1,211 @@
+"""Async serving mode: the JSON read API on Starlette, the rest on Flask.
+
+    gunicorn asgi:app -k uvicorn.workers.UvicornH11Worker
+
+The read-heavy routes (home timeline, profile, message, likes) are
+served async as their JSON endpoints under /api, by handlers on an async
+SQLAlchemy engine (asyncpg, or aiosqlite for SQLite URLs), so a worker
+keeps serving other requests while one waits on the database. Each
+worker has one connection pool, shared by all of its requests, sized
+like the sync one (SQLALCHEMY_ENGINE_OPTIONS, REPLICA_ENGINE_OPTIONS).
+The timeline is read through timeline.py's stores and pull merge, as
+on the homepage: its plans run here on the AsyncSession (`run_plan`).
+
+The HTML pages of those routes are not async: they're built from
+Flask's request machinery (g.user, CSRF tokens, flashes, conditional
+GETs, the card fragment cache), so they, and every other path, fall
+through to the Flask app, mounted as WSGI, and run on its thread pool
+as in sync mode. Logins are shared: the handlers read the same signed
+session cookie. As in replicas.py, reads go to the replica if one is
+configured, except during a user's read-your-writes window.
+"""
+
+import time
+
+from itsdangerous import BadSignature
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import HTTPException
+
+import reads
+import timeline
+from app import app as flask_app, CURR_USER_KEY
+from pagination import decode_message_cursor
+from replicas import PRIMARY_UNTIL_KEY, REPLICA_BIND
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_url(url):
+    """`url` with the async driver for its database."""
+
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+config = flask_app.config
+
+primary_engine = create_async_engine(
+    async_url(config['SQLALCHEMY_DATABASE_URI']),
+    **config['SQLALCHEMY_ENGINE_OPTIONS'])
+primary_sessions = sessionmaker(primary_engine, class_=AsyncSession)
+
+replica_url = (config.get('SQLALCHEMY_BINDS') or {}).get(REPLICA_BIND)
+if replica_url:
+    replica_engine = create_async_engine(
+        async_url(replica_url), **config.get('REPLICA_ENGINE_OPTIONS', {}))
+    replica_sessions = sessionmaker(replica_engine, class_=AsyncSession)
+else:
+    replica_engine = replica_sessions = None
+
+
+def flask_session(request):
+    """The Flask session from the request's cookie ({} if none or bad)."""
+
+    cookie = request.cookies.get(flask_app.session_cookie_name)
+    if not cookie:
+        return {}
+
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+
+    try:
+        return serializer.loads(cookie, max_age=max_age)
+    except BadSignature:
+        return {}
+
+
+def sessions_for(session):
+    """Replica sessions, unless there's none or the user just wrote."""
+
+    if replica_sessions and session.get(PRIMARY_UNTIL_KEY, 0) <= time.time():
+        return replica_sessions
+    return primary_sessions
+
+
+async def run_plan(plan, db_session):
+    """Run a timeline.py read plan on `db_session`; returns its result.
+
+    The plan's own code (store and config lookups) runs in a Flask app
+    context, pushed for each step and popped before awaiting: app
+    contexts are per thread, and this thread serves many requests.
+    """
+
+    rows = None
+    try:
+        while True:
+            with flask_app.app_context():
+                statement = plan.send(rows)
+            rows = (await db_session.execute(statement)).all()
+    except StopIteration as done:
+        return done.value
+
+
+def error(message, status):
+    return JSONResponse({'error': message}, status_code=status)
+
+
+def page_args(request):
+    """(page size, `before` key) for a message list request."""
+
+    return (config['PAGE_SIZE'],
+            decode_message_cursor(request.query_params.get('cursor')))
+
+
+async def api_timeline(request):
+    session = flask_session(request)
+    user_id = session.get(CURR_USER_KEY)
+    if not user_id:
+        return error("Log in to see your timeline.", 401)
+
+    limit, before = page_args(request)
+
+    async with sessions_for(session)() as db_session:
+        entries, next_cursor = await run_plan(
+            timeline.timeline_entries(user_id, limit, before), db_session)
+
+        rows = []
+        if entries:
+            message_ids = [message_id for (_, message_id, _) in entries]
+            result = await db_session.execute(
+                reads.messages_statement(message_ids))
+            rows = result.all()
+
+    return JSONResponse(reads.entries_page(rows, entries, next_cursor))
+
+
+async def api_user(request):
+    user_id = request.path_params['user_id']
+    limit, before = page_args(request)
+
+    async with sessions_for(flask_session(request))() as db_session:
+        user = (await db_session.execute(reads.user_statement(user_id))).first()
+        if user is None:
+            return error("No such user.", 404)
+
+        result = await db_session.execute(
+            reads.user_messages_statement(user_id, limit, before))
+        rows = result.all()
+
+    return JSONResponse({'user': reads.user_json(user),
+                         **reads.message_page(rows, limit)})
+
+
+async def api_user_likes(request):
+    user_id = request.path_params['user_id']
+    limit, before = page_args(request)
+
+    async with sessions_for(flask_session(request))() as db_session:
+        exists = await db_session.execute(reads.user_exists_statement(user_id))
+        if exists.first() is None:
+            return error("No such user.", 404)
+
+        result = await db_session.execute(
+            reads.liked_messages_statement(user_id, limit, before))
+        rows = result.all()
+
+    return JSONResponse(reads.message_page(rows, limit))
+
+
+async def api_message(request):
+    message_id = request.path_params['message_id']
+
+    async with sessions_for(flask_session(request))() as db_session:
+        result = await db_session.execute(reads.message_statement(message_id))
+        row = result.first()
+
+    if row is None:
+        return error("No such message.", 404)
+
+    return JSONResponse({'message': reads.message_json(row)})
+
+
+async def http_error(request, exc):
+    return error(exc.description, exc.code)
+
+
+async def dispose_engines():
+    await primary_engine.dispose()
+    if replica_engine:
+        await replica_engine.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/timeline', api_timeline),
+        Route('/api/users/{user_id:int}', api_user),
+        Route('/api/users/{user_id:int}/likes', api_user_likes),
+        Route('/api/messages/{message_id:int}', api_message),
+        Mount('/', WSGIMiddleware(flask_app)),
+    ],
+    exception_handlers={HTTPException: http_error},
+    on_shutdown=[dispose_engines],
+)
@@ -0,0 +1,53 @@
+"""Periodic jobs run on a background thread of the app process.
+
+A BackgroundWorker calls its job in an app context every `poll_seconds`,
+and right away when `notify`d. Jobs must be safe to run in several
+processes at once (each gunicorn worker has its own thread); they get no
+scheduling guarantees beyond "soon" and "again later".
+"""
+
+import logging
+import threading
+
+from models import db
+
+log = logging.getLogger(__name__)
+
+
+class BackgroundWorker:
+    """Daemon thread running `job()` for `app`, started on first use."""
+
+    def __init__(self, app, name, job, poll_seconds):
+        self.app = app
+        self.name = name
+        self.job = job
+        self.poll_seconds = poll_seconds
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def notify(self):
+        """Run the job as soon as possible."""
+
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    self.job()
+                except Exception:
+                    log.exception("Background job %s failed", self.name)
+                finally:
+                    db.session.remove()
+
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
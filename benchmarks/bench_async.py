@@ -0,0 +1,180 @@
+"""Throughput of the JSON read API under concurrent connections, sync vs async.
+
+Run from the repo root:
+
+    python -m benchmarks.bench_async --scale small --concurrency 1 16 64
+
+The dataset is seeded as in bench_routes. The app is then started twice
+with gunicorn on the same number of workers: sync workers running
+app:app, and uvicorn workers running asgi:app (see asgi.py). Each one is
+driven by CONCURRENCY simultaneous connections for --duration seconds,
+cycling through the timeline, profile, message and likes endpoints
+logged in as a heavy user. We report requests/sec, p50/p95/p99 latency
+and errors for each mode and concurrency level. --out writes them as
+JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.bench_routes import ROOT, database_url, percentile, seed
+
+MODES = {
+    'sync': ['app:app'],
+    'async': ['asgi:app', '-k', 'uvicorn.workers.UvicornH11Worker'],
+}
+
+
+def prepare(scale):
+    """(session cookie of the viewer, paths to request) for `scale`."""
+
+    os.environ['DB_URL'] = database_url(scale)
+    sys.path.insert(0, ROOT)
+
+    from app import app, CURR_USER_KEY
+    from models import User, Message
+
+    with app.app_context():
+        viewer = User.query.order_by(User.following_count.desc()).first()
+        celebrity = User.query.order_by(User.followers_count.desc()).first()
+        liker = User.query.order_by(User.likes_count.desc()).first()
+        message = Message.query.order_by(Message.id.desc()).first()
+
+        serializer = app.session_interface.get_signing_serializer(app)
+        cookie = serializer.dumps({CURR_USER_KEY: viewer.id})
+
+        paths = ['/api/timeline',
+                 f'/api/users/{celebrity.id}',
+                 f'/api/messages/{message.id}',
+                 f'/api/users/{liker.id}/likes']
+
+    return cookie, paths
+
+
+async def fetch(port, path, cookie):
+    """GET `path` on a new connection; returns the status code."""
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                 f"Cookie: session={cookie}\r\nConnection: close\r\n\r\n"
+                 .encode())
+    await writer.drain()
+
+    response = await reader.read()
+    writer.close()
+
+    return int(response.split(b" ", 2)[1])
+
+
+async def drive(port, paths, cookie, concurrency, duration):
+    """Keep `concurrency` requests in flight for `duration` seconds."""
+
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client(offset):
+        nonlocal errors
+        n = offset
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                status = await fetch(port, paths[n % len(paths)], cookie)
+            except OSError:
+                status = None
+            if status != 200:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+            n += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client(i) for i in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    return {
+        'requests_per_sec': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'requests': len(latencies),
+        'errors': errors,
+    }
+
+
+def wait_until_up(port, paths, cookie, timeout=30):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            if asyncio.run(fetch(port, paths[0], cookie)) == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+
+    raise RuntimeError(f"server on port {port} didn't come up")
+
+
+def run_mode(mode, args, paths, cookie):
+    env = {**os.environ, 'DB_URL': database_url(args.scale)}
+    server = subprocess.Popen(
+        ['gunicorn', *MODES[mode],
+         '--workers', str(args.workers), '--bind', f'127.0.0.1:{args.port}',
+         '--log-level', 'warning'],
+        cwd=ROOT, env=env)
+
+    try:
+        wait_until_up(args.port, paths, cookie)
+        return {
+            str(concurrency): asyncio.run(drive(args.port, paths, cookie,
+                                                concurrency, args.duration))
+            for concurrency in args.concurrency
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', default='small',
+                        choices=['small', 'medium', 'large'])
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 16, 64])
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help="seconds per mode and concurrency level")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=8931)
+    parser.add_argument('--out', metavar='FILE',
+                        help="write results as JSON to FILE")
+    args = parser.parse_args()
+
+    seed(args.scale)
+    cookie, paths = prepare(args.scale)
+
+    results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'scale': args.scale, 'workers': args.workers, 'modes': {}}
+
+    print(f"{'mode':<6} {'conns':>5} {'req/s':>9} {'p50':>8} {'p95':>8} "
+          f"{'p99':>8} {'errors':>6}")
+
+    for mode in MODES:
+        results['modes'][mode] = run_mode(mode, args, paths, cookie)
+
+        for concurrency, stats in results['modes'][mode].items():
+            print(f"{mode:<6} {concurrency:>5} {stats['requests_per_sec']:>9} "
+                  f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} "
+                  f"{stats['p99_ms']:>8} {stats['errors']:>6}")
+
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
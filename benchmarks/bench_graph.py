@@ -0,0 +1,90 @@
+"""Benchmark the in-memory follow graph (graph.py) on a synthetic graph.
+
+Run from the repo root:
+
+    python -m benchmarks.bench_graph --users 100000 --follows 3000000
+
+Builds a FollowGraph from --follows random follows among --users users
+(no database involved), then times the queries a profile view makes:
+follows (membership), followers_count (degree) and followed_by_followed
+(intersection), each from random viewer/user pairs. Reports build time,
+bytes per follow and microseconds per query. Add --json FILE for
+machine-readable output.
+"""
+
+import argparse
+import json
+import random
+import time
+from array import array
+
+from graph import FollowGraph
+
+
+def random_follows(users, follows, seed):
+    """Parallel follower/followed arrays, sorted, without duplicates."""
+
+    rng = random.Random(seed)
+    pairs = set()
+    while len(pairs) < follows:
+        follower_id = rng.randint(1, users)
+        followed_id = rng.randint(1, users)
+        if follower_id != followed_id:
+            pairs.add((follower_id, followed_id))
+
+    pairs = sorted(pairs)
+    return (array('i', (follower_id for follower_id, _ in pairs)),
+            array('i', (followed_id for _, followed_id in pairs)))
+
+
+def time_query(query, pairs):
+    """Microseconds per call of query(a, b) over `pairs`."""
+
+    started = time.perf_counter()
+    for a, b in pairs:
+        query(a, b)
+    return round(1e6 * (time.perf_counter() - started) / len(pairs), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=300000)
+    parser.add_argument('--queries', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='FILE')
+    args = parser.parse_args()
+
+    followers, followed = random_follows(args.users, args.follows, args.seed)
+
+    started = time.perf_counter()
+    graph = FollowGraph(followers, followed)
+    build_seconds = time.perf_counter() - started
+
+    rng = random.Random(args.seed + 1)
+    pairs = [(rng.randint(1, args.users), rng.randint(1, args.users))
+             for _ in range(args.queries)]
+
+    result = {
+        'users': args.users,
+        'follows': graph.edges,
+        'build_seconds': round(build_seconds, 3),
+        'bytes': graph.nbytes(),
+        'bytes_per_follow': round(graph.nbytes() / max(graph.edges, 1), 2),
+        'us_follows': time_query(graph.follows, pairs),
+        'us_followers_count': time_query(
+            lambda a, b: graph.followers_count(b), pairs),
+        'us_followed_by_followed': time_query(
+            graph.followed_by_followed, pairs),
+    }
+
+    for name, value in result.items():
+        print(f"{name:>24} {value}")
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(result, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
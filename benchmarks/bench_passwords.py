@@ -0,0 +1,88 @@
+"""Benchmark password checks (logins) per second at several bcrypt costs.
+
+Run from the repo root:
+
+    python -m benchmarks.bench_passwords --costs 10 11 12 13 --seconds 5
+
+For each cost, a hash is made once and then checked repeatedly from
+--clients threads through a PasswordHasher allowing --workers hashes at
+once, for --seconds. Reports logins/sec in total and per core (divided by
+the number of cores the hasher can actually use). Add --json FILE for machine-readable output.
+"""
+
+import argparse
+import json
+import os
+import time
+from threading import Thread
+
+from passwords import PasswordHasher
+
+
+def bench_cost(cost, seconds, workers, clients):
+    """Logins/sec at `cost` with up to `workers` hashes at once."""
+
+    hasher = PasswordHasher(rounds=cost, workers=workers)
+    hashed = hasher.hash("correct horse battery staple")
+
+    counts = [0] * clients
+    deadline = time.perf_counter() + seconds
+
+    def client(i):
+        while time.perf_counter() < deadline:
+            hasher.check(hashed, "correct horse battery staple")
+            counts[i] += 1
+
+    started = time.perf_counter()
+    threads = [Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    cores = min(workers, os.cpu_count() or 1)
+    per_sec = sum(counts) / elapsed
+
+    return {
+        'cost': cost,
+        'logins': sum(counts),
+        'seconds': round(elapsed, 3),
+        'logins_per_sec': round(per_sec, 2),
+        'logins_per_sec_per_core': round(per_sec / cores, 2),
+        'ms_per_login': round(1000 * cores / per_sec, 2) if per_sec else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--costs', type=int, nargs='+',
+                        default=[10, 11, 12, 13])
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="hashes allowed at once")
+    parser.add_argument('--clients', type=int, default=None,
+                        help="concurrent callers (default: 2 x workers)")
+    parser.add_argument('--json', metavar='FILE')
+    args = parser.parse_args()
+
+    clients = args.clients or args.workers * 2
+
+    print(f"{'cost':>4} {'logins/s':>10} {'per core':>10} {'ms/login':>9}")
+
+    results = []
+    for cost in args.costs:
+        result = bench_cost(cost, args.seconds, args.workers, clients)
+        results.append(result)
+        print(f"{cost:>4} {result['logins_per_sec']:>10} "
+              f"{result['logins_per_sec_per_core']:>10} "
+              f"{result['ms_per_login']:>9}")
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'workers': args.workers, 'clients': clients,
+                       'results': results}, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
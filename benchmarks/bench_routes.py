@@ -0,0 +1,251 @@
+"""Route-level latency benchmarks at several dataset scales.
+
+Run from the repo root:
+
+    python -m benchmarks.bench_routes --scales small medium --out results.json
+    python -m benchmarks.bench_routes --compare before.json after.json
+
+For each scale, a dataset is generated (generator/create_csvs.py) and
+loaded (loader.py) into its own database the first time, then reused.
+Databases are SQLite files under .bench/ unless BENCH_DB_URL is set to a
+template like "postgresql:///warbler_bench_{scale}".
+
+Each scale runs in a fresh process (the app binds its database at
+import). Every route is driven through the Flask test client, logged in
+as a heavy user, and we report p50/p95/p99 latency, requests/sec and SQL
+queries per request. --compare prints the change between two result
+files and exits non-zero if any route's p95 or query count regressed by
+more than --threshold.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, '.bench')
+
+# users, messages, follows, likes
+SCALES = {
+    'small': (1000, 10000, 20000, 10000),
+    'medium': (10000, 100000, 300000, 100000),
+    'large': (100000, 1000000, 3000000, 1000000),
+}
+
+ROUTES = ['homepage', 'users_show', 'list_users', 'list_users_search',
+          'show_liked_messages', 'add_liked_message']
+
+
+def database_url(scale):
+    template = os.environ.get('BENCH_DB_URL')
+    if template:
+        return template.format(scale=scale)
+    return f"sqlite:///{os.path.join(BENCH_DIR, scale + '.db')}"
+
+
+def seed(scale):
+    """Generate and load the dataset for `scale`, unless already done."""
+
+    data_dir = os.path.join(BENCH_DIR, scale)
+    marker = os.path.join(data_dir, '.loaded-' + database_url(scale).replace('/', '_'))
+    if os.path.exists(marker):
+        return
+
+    users, messages, follows, likes = SCALES[scale]
+    os.makedirs(data_dir, exist_ok=True)
+
+    subprocess.run(
+        [sys.executable, 'generator/create_csvs.py', '--out', data_dir,
+         '--users', str(users), '--messages', str(messages),
+         '--follows', str(follows), '--likes', str(likes)],
+        cwd=ROOT, check=True)
+
+    env = {**os.environ, 'DB_URL': database_url(scale), 'FLASK_APP': 'app'}
+
+    subprocess.run(
+        [sys.executable, 'loader.py', '--dir', data_dir],
+        cwd=ROOT, check=True, env=env)
+
+    subprocess.run(
+        [sys.executable, '-m', 'flask', 'migrate'],
+        cwd=ROOT, check=True, env=env)
+
+    open(marker, 'w').close()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def run_scale(scale, iterations, warmup):
+    """Benchmark every route against the `scale` database (in-process)."""
+
+    os.environ['DB_URL'] = database_url(scale)
+    sys.path.insert(0, ROOT)
+
+    from app import app, CURR_USER_KEY
+    from instrumentation import track_queries
+    from models import User, Message, Like
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    with app.app_context():
+        viewer = User.query.order_by(User.following_count.desc()).first()
+        celebrity = User.query.order_by(User.followers_count.desc()).first()
+        liker = User.query.order_by(User.likes_count.desc()).first()
+        message = (Message.query
+                   .filter(Message.user_id != viewer.id)
+                   .order_by(Message.id)
+                   .first())
+        search_term = celebrity.username[:4]
+        paths = {
+            'homepage': ('GET', '/'),
+            'users_show': ('GET', f'/users/{celebrity.id}'),
+            'list_users': ('GET', '/users'),
+            'list_users_search': ('GET', f'/users?q={search_term}'),
+            'show_liked_messages': ('GET', f'/users/{liker.id}/likes'),
+            'add_liked_message': ('POST', f'/messages/{message.id}/likes'),
+        }
+        viewer_id = viewer.id
+        dataset = {
+            'users': User.query.count(),
+            'messages': Message.query.count(),
+            'likes': Like.query.count(),
+        }
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = viewer_id
+
+    results = {}
+
+    for route in ROUTES:
+        method, path = paths[route]
+        send = client.get if method == 'GET' else client.post
+
+        for _ in range(warmup):
+            send(path)
+
+        latencies = []
+        query_counts = []
+        started = time.perf_counter()
+
+        for _ in range(iterations):
+            before = time.perf_counter()
+            with track_queries() as stats:
+                response = send(path)
+            latencies.append((time.perf_counter() - before) * 1000)
+            query_counts.append(stats.count)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{route}: {method} {path} -> "
+                                   f"{response.status_code}")
+
+        elapsed = time.perf_counter() - started
+
+        results[route] = {
+            'path': path,
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'mean_ms': round(statistics.mean(latencies), 3),
+            'requests_per_sec': round(iterations / elapsed, 2),
+            'queries_per_request': round(statistics.mean(query_counts), 2),
+            'max_queries': max(query_counts),
+        }
+
+    return {'database': database_url(scale).split(':')[0],
+            'dataset': dataset, 'routes': results}
+
+
+def print_scale(scale, result):
+    print(f"\n== {scale} {result['dataset']}")
+    print(f"{'route':<22} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8} {'queries':>8}")
+    for route, stats in result['routes'].items():
+        print(f"{route:<22} {stats['p50_ms']:>8} {stats['p95_ms']:>8} "
+              f"{stats['p99_ms']:>8} {stats['requests_per_sec']:>8} "
+              f"{stats['queries_per_request']:>8}")
+
+
+def compare(before_path, after_path, threshold):
+    """Print per-route changes; returns the number of regressions."""
+
+    with open(before_path) as file:
+        before = json.load(file)
+    with open(after_path) as file:
+        after = json.load(file)
+
+    regressions = 0
+
+    for scale, result in after['scales'].items():
+        if scale not in before['scales']:
+            continue
+        print(f"\n== {scale}")
+        print(f"{'route':<22} {'p95 before':>11} {'p95 after':>10} {'change':>8} {'queries':>12}")
+
+        for route, stats in result['routes'].items():
+            old = before['scales'][scale]['routes'].get(route)
+            if old is None:
+                continue
+
+            change = (stats['p95_ms'] - old['p95_ms']) / old['p95_ms']
+            more_queries = stats['max_queries'] > old['max_queries']
+            flag = ""
+            if change > threshold or more_queries:
+                regressions += 1
+                flag = "  REGRESSION"
+
+            print(f"{route:<22} {old['p95_ms']:>11} {stats['p95_ms']:>10} "
+                  f"{change:>+8.1%} {old['max_queries']:>5} -> {stats['max_queries']:<4}"
+                  f"{flag}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', nargs='+', choices=SCALES, default=['small'])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--out', metavar='FILE',
+                        help="write results as JSON to FILE")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="p95 slowdown (fraction) counted as a regression")
+    parser.add_argument('--one-scale', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    if args.one_scale:
+        result = run_scale(args.one_scale, args.iterations, args.warmup)
+        json.dump(result, sys.stdout)
+        return
+
+    results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'iterations': args.iterations, 'scales': {}}
+
+    for scale in args.scales:
+        seed(scale)
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_routes',
+             '--one-scale', scale, '--iterations', str(args.iterations),
+             '--warmup', str(args.warmup)],
+            cwd=ROOT, check=True, capture_output=True, text=True).stdout
+        results['scales'][scale] = json.loads(output)
+        print_scale(scale, results['scales'][scale])
+
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
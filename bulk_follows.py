@@ -0,0 +1,182 @@
+"""Bulk follow and unfollow, and CSV import/export of follow lists.
+
+Work is done in chunks of up to FOLLOW_CHUNK_SIZE users: one query to
+find which of them exist and aren't followed yet, one multi-row INSERT
+(or one DELETE), one counter update, one commit. Nobody's `following`
+collection is loaded.
+"""
+
+import csv
+import io
+
+from models import db, User, Follows, insert_many_if_missing
+
+FOLLOW_CHUNK_SIZE = 500
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def unique(items):
+    """`items` without repeats, in their original order."""
+
+    return list(dict.fromkeys(items))
+
+
+def read_usernames(file):
+    """Usernames from an uploaded CSV: the first column of each row.
+
+    A header row whose first cell is "username" is skipped, so files
+    from `write_follow_list` import as they are.
+    """
+
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+
+    for number, row in enumerate(csv.reader(text)):
+        if not row or not row[0].strip():
+            continue
+        name = row[0].strip().lstrip('@')
+        if number == 0 and name.lower() == 'username':
+            continue
+        yield name
+
+
+def resolve_usernames(usernames, chunk_size=FOLLOW_CHUNK_SIZE):
+    """{username: id} for the `usernames` that exist, a chunk per query."""
+
+    found = {}
+
+    for chunk in chunked(unique(usernames), chunk_size):
+        found.update(db.session
+                     .query(User.username, User.id)
+                     .filter(User.username.in_(chunk)))
+
+    return found
+
+
+def _settle_counts(follower_id, user_ids, changed, delta):
+    """Move the counters for a chunk whose `user_ids` were (un)followed.
+
+    `changed` is the number of rows the write touched; if a concurrent
+    request got to some of them first it's short, and the counters of
+    everyone involved are recounted instead.
+    """
+
+    if changed == len(user_ids):
+        User.bump_counts(follower_id, following_count=delta * changed)
+        User.bump_counts(user_ids, followers_count=delta)
+    else:
+        User.recount([follower_id] + user_ids)
+
+
+def follow_many(follower_id, user_ids, chunk_size=FOLLOW_CHUNK_SIZE):
+    """Follow every existing user in `user_ids`; returns the newly followed."""
+
+    user_ids = [user_id for user_id in unique(user_ids)
+                if user_id != follower_id]
+    added = []
+
+    for chunk in chunked(user_ids, chunk_size):
+        already = (db.session
+                   .query(Follows)
+                   .filter(Follows.user_following_id == follower_id)
+                   .filter(Follows.user_being_followed_id == User.id)
+                   .exists())
+        new_ids = [user_id for (user_id,) in
+                   db.session
+                   .query(User.id)
+                   .filter(User.id.in_(chunk))
+                   .filter(~already)]
+
+        if not new_ids:
+            continue
+
+        inserted = insert_many_if_missing(Follows, [
+            {'user_following_id': follower_id,
+             'user_being_followed_id': user_id}
+            for user_id in new_ids
+        ])
+        _settle_counts(follower_id, new_ids, inserted, 1)
+        db.session.commit()
+
+        added.extend(new_ids)
+
+    return added
+
+
+def unfollow_many(follower_id, user_ids, chunk_size=FOLLOW_CHUNK_SIZE):
+    """Unfollow every user in `user_ids`; returns those that were followed."""
+
+    removed = []
+
+    for chunk in chunked(unique(user_ids), chunk_size):
+        mine = (Follows.query
+                .filter(Follows.user_following_id == follower_id)
+                .filter(Follows.user_being_followed_id.in_(chunk)))
+
+        followed_ids = [user_id for (user_id,) in
+                        mine.with_entities(Follows.user_being_followed_id)]
+
+        if not followed_ids:
+            continue
+
+        deleted = mine.delete(synchronize_session=False)
+        _settle_counts(follower_id, followed_ids, deleted, -1)
+        db.session.commit()
+
+        removed.extend(followed_ids)
+
+    return removed
+
+
+def follow_list(user_id, direction, chunk_size=FOLLOW_CHUNK_SIZE):
+    """Yield the usernames `user_id` follows (or its followers), by id.
+
+    Reads in keyset-paged chunks, so a huge list is never held in memory.
+    """
+
+    if direction == 'following':
+        mine = Follows.user_following_id
+        theirs = Follows.user_being_followed_id
+    else:
+        mine = Follows.user_being_followed_id
+        theirs = Follows.user_following_id
+
+    last_id = 0
+
+    while True:
+        rows = (db.session
+                .query(User.id, User.username)
+                .join(Follows, theirs == User.id)
+                .filter(mine == user_id)
+                .filter(User.id > last_id)
+                .order_by(User.id)
+                .limit(chunk_size)
+                .all())
+
+        if not rows:
+            return
+
+        for _, username in rows:
+            yield username
+
+        last_id = rows[-1][0]
+
+
+def write_follow_list(usernames, chunk_size=FOLLOW_CHUNK_SIZE):
+    """Yield a CSV of `usernames` (with a header), a chunk at a time."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['username'])
+
+    for number, username in enumerate(usernames, start=1):
+        writer.writerow([username])
+        if number % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
@@ -0,0 +1,383 @@
+"""Account deletion: hide the user at once, purge their rows later.
+
+Deleting an account with many messages, likes and follows in one request
+holds locks on all of those rows (and everyone's counters) until it's
+done. Instead, `mark_deleted` only stamps users.deleted_at and queues an
+account_purges row. From then on every ORM SELECT, on any session, sync
+or async, leaves out the user and their messages (`hide_deleted`); pass
+the execution option include_deleted=True to see them.
+
+The rows themselves are removed by a background thread in each app
+process (see background.py), or by `flask purge-deleted`. A purge works
+through STAGES in order, removing at most PURGE_CHUNK_SIZE rows per
+transaction and recounting the counters of the users on the other end
+of those rows, so locks are short and counters stay right. Its stage
+and rows_deleted are saved with each chunk. A worker leases the purge
+for PURGE_LEASE_SECONDS, renewed every chunk; if it dies, another one
+resumes the purge where it stopped once the lease runs out.
+
+The user's follows stay until the purge, but stop counting at once:
+`mark_deleted` takes them off the other users' counters, and recounts,
+follow graph loads and suggestion runs skip deleted users. Once the
+deletion commits, this process's follow graph, timelines and the
+followers' suggestions forget the user; likewise each purged chunk of
+messages or follows. Other processes' copies catch up on their own:
+deleted users' messages are hidden anyway, and follow graphs reload.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, orm
+
+import graph
+import suggestions
+import timeline
+from background import BackgroundWorker
+from models import (
+    db, AccountPurge, Follows, FollowSuggestion, Like, Message, User,
+    DELETED_USER_IDS)
+
+log = logging.getLogger(__name__)
+
+PURGE_CHUNK_SIZE = 500
+PURGE_LEASE_SECONDS = 60
+PURGE_POLL_SECONDS = 60
+
+@event.listens_for(orm.Session, 'do_orm_execute')
+def hide_deleted(execute_state):
+    """Leave deleted users and their messages out of ORM SELECTs."""
+
+    if (not execute_state.is_select
+            or execute_state.execution_options.get('include_deleted')):
+        return
+
+    execute_state.statement = execute_state.statement.options(
+        orm.with_loader_criteria(
+            User, lambda cls: cls.deleted_at.is_(None),
+            include_aliases=True),
+        orm.with_loader_criteria(
+            Message, lambda cls: cls.user_id.notin_(DELETED_USER_IDS),
+            include_aliases=True),
+    )
+
+
+def mark_deleted(user_id):
+    """Hide `user_id` and queue the purge of their rows (caller commits)."""
+
+    (User.query
+        .filter(User.id == user_id)
+        .update({User.deleted_at: datetime.utcnow()},
+                synchronize_session=False))
+
+    db.session.add(AccountPurge(user_id=user_id))
+
+    followed_ids = (db.select([Follows.user_being_followed_id])
+                    .where(Follows.user_following_id == user_id))
+    follower_ids = (db.select([Follows.user_following_id])
+                    .where(Follows.user_being_followed_id == user_id))
+
+    User.bump_counts(followed_ids, followers_count=-1)
+    User.bump_counts(follower_ids, following_count=-1)
+
+    _after_commit(_forget_user, user_id,
+                  [followed_id for (followed_id,)
+                   in db.session.execute(followed_ids)],
+                  [follower_id for (follower_id,)
+                   in db.session.execute(follower_ids)])
+
+    # Refreshing an instance the session already holds skips the criteria,
+    # so drop it; later lookups go to the database and come back empty.
+    key = db.session.identity_key(User, user_id)
+    if key in db.session.identity_map:
+        db.session.expunge(db.session.identity_map[key])
+
+
+##############################################################################
+# Purge stages
+#
+# Each takes (user_id, chunk_size), removes up to chunk_size rows and
+# returns how many it removed; 0 means the stage is done.
+
+
+def _query(*entities):
+    return db.session.query(*entities).execution_options(include_deleted=True)
+
+
+def _after_commit(forget, *args):
+    """Call `forget(*args)` once the chunk commits.
+
+    For dropping purged rows from in-memory copies: it runs after the
+    transaction, so it mustn't query.
+    """
+
+    event.listen(db.session(), 'after_commit',
+                 lambda session: forget(*args), once=True)
+
+
+def _purge_follows(user_id, chunk_size, column, other_column):
+    """Remove up to `chunk_size` follows; returns (removed, other ids)."""
+
+    other_ids = [other_id for (other_id,) in
+                 _query(other_column).filter(column == user_id)
+                 .limit(chunk_size)]
+    if not other_ids:
+        return 0, []
+
+    removed = (Follows.query
+               .filter(column == user_id, other_column.in_(other_ids))
+               .delete(synchronize_session=False))
+    User.recount(other_ids)
+
+    return removed, other_ids
+
+
+def purge_likes_given(user_id, chunk_size):
+    """Likes by the user; the like_count of those messages drops."""
+
+    message_ids = [message_id for (message_id,) in
+                   _query(Like.message_id).filter(Like.user_id == user_id)
+                   .limit(chunk_size)]
+    if not message_ids:
+        return 0
+
+    removed = (Like.query
+               .filter(Like.user_id == user_id, Like.message_id.in_(message_ids))
+               .delete(synchronize_session=False))
+    Message.recount_likes(message_ids)
+
+    return removed
+
+
+def purge_likes_received(user_id, chunk_size):
+    """Likes on the user's messages; their likers' likes_count drops."""
+
+    keys = [tuple(key) for key in
+            _query(Like.user_id, Like.message_id)
+            .join(Message, Message.id == Like.message_id)
+            .filter(Message.user_id == user_id)
+            .limit(chunk_size)]
+    if not keys:
+        return 0
+
+    removed = (Like.query
+               .filter(db.tuple_(Like.user_id, Like.message_id).in_(keys))
+               .delete(synchronize_session=False))
+    User.recount({liker_id for liker_id, _ in keys})
+
+    return removed
+
+
+def purge_messages(user_id, chunk_size):
+    message_ids = [message_id for (message_id,) in
+                   _query(Message.id).filter(Message.user_id == user_id)
+                   .limit(chunk_size)]
+    if not message_ids:
+        return 0
+
+    _after_commit(timeline.author_purged, user_id)
+
+    return (Message.query
+            .filter(Message.id.in_(message_ids))
+            .delete(synchronize_session=False))
+
+
+def _forget_user(user_id, followed_ids, follower_ids):
+    _forget_following(user_id, followed_ids)
+    _forget_followers(user_id, follower_ids)
+    for follower_id in follower_ids:
+        suggestions.follows_changed(follower_id, [user_id])
+
+
+def _forget_following(user_id, followed_ids):
+    graph.follows_changed(user_id, followed_ids, False)
+
+
+def _forget_followers(user_id, follower_ids):
+    timeline.author_purged(user_id, follower_ids)
+    for follower_id in follower_ids:
+        graph.follows_changed(follower_id, [user_id], False)
+
+
+def purge_following(user_id, chunk_size):
+    """Whom the user follows; their followers_count drops."""
+
+    removed, followed_ids = _purge_follows(
+        user_id, chunk_size, Follows.user_following_id,
+        Follows.user_being_followed_id)
+    if removed:
+        _after_commit(_forget_following, user_id, followed_ids)
+
+    return removed
+
+
+def purge_followers(user_id, chunk_size):
+    """Who follows the user; their following_count drops."""
+
+    removed, follower_ids = _purge_follows(
+        user_id, chunk_size, Follows.user_being_followed_id,
+        Follows.user_following_id)
+    if removed:
+        _after_commit(_forget_followers, user_id, follower_ids)
+
+    return removed
+
+
+def purge_user_row(user_id, chunk_size):
+    (FollowSuggestion.query
+        .filter(FollowSuggestion.user_id == user_id)
+        .delete(synchronize_session=False))
+
+    return (User.query
+            .filter(User.id == user_id)
+            .delete(synchronize_session=False))
+
+
+STAGES = [
+    ('likes_given', purge_likes_given),
+    ('likes_received', purge_likes_received),
+    ('messages', purge_messages),
+    ('following', purge_following),
+    ('followers', purge_followers),
+    ('user', purge_user_row),
+]
+
+
+##############################################################################
+# Running purges
+
+
+def claim(user_id, lease_seconds=PURGE_LEASE_SECONDS):
+    """Lease the purge of `user_id` unless it's done or leased; True if so."""
+
+    now = datetime.utcnow()
+
+    claimed = (AccountPurge.query
+               .filter(AccountPurge.user_id == user_id,
+                       AccountPurge.finished_at.is_(None),
+                       db.or_(AccountPurge.locked_until.is_(None),
+                              AccountPurge.locked_until < now))
+               .update({AccountPurge.locked_until:
+                        now + timedelta(seconds=lease_seconds)},
+                       synchronize_session=False))
+    db.session.commit()
+
+    return claimed == 1
+
+
+def purge_user(user_id, chunk_size=PURGE_CHUNK_SIZE,
+               lease_seconds=PURGE_LEASE_SECONDS):
+    """Remove a claimed deleted user's rows, one chunk per transaction.
+
+    Picks up at the purge's saved stage; returns the rows removed.
+    """
+
+    purge = AccountPurge.query.get(user_id)
+    names = [name for name, _ in STAGES]
+    removed = 0
+
+    for name, run in STAGES[names.index(purge.stage):]:
+        while True:
+            count = run(user_id, chunk_size)
+
+            purge.stage = name
+            purge.rows_deleted += count
+            purge.locked_until = (datetime.utcnow()
+                                  + timedelta(seconds=lease_seconds))
+            if name == 'user':
+                purge.finished_at = datetime.utcnow()
+                purge.locked_until = None
+            db.session.commit()
+
+            removed += count
+            if count < chunk_size:
+                break
+
+    return removed
+
+
+def pending_purges():
+    """User ids of the unfinished purges, oldest request first."""
+
+    return [user_id for (user_id,) in
+            db.session.query(AccountPurge.user_id)
+            .filter(AccountPurge.finished_at.is_(None))
+            .order_by(AccountPurge.requested_at)]
+
+
+def purge_pending(chunk_size=PURGE_CHUNK_SIZE,
+                  lease_seconds=PURGE_LEASE_SECONDS):
+    """Run every unfinished purge nobody else holds; returns how many."""
+
+    finished = 0
+
+    for user_id in pending_purges():
+        if not claim(user_id, lease_seconds):
+            continue
+
+        try:
+            purge_user(user_id, chunk_size, lease_seconds)
+        except Exception:
+            # The lease runs out and the purge is retried from its stage.
+            db.session.rollback()
+            log.exception("Purge of user #%s failed", user_id)
+            continue
+
+        finished += 1
+
+    return finished
+
+
+@click.command('purge-deleted')
+@click.option('--status', is_flag=True,
+              help="List unfinished purges instead of running them.")
+@with_appcontext
+def purge_command(status):
+    """Purge the rows of deleted accounts now."""
+
+    if status:
+        for purge in (AccountPurge.query
+                      .filter(AccountPurge.finished_at.is_(None))
+                      .order_by(AccountPurge.requested_at)):
+            click.echo(f"user #{purge.user_id:<8} {purge.stage:<15} "
+                       f"{purge.rows_deleted:>8} rows  "
+                       f"requested {purge.requested_at}")
+        return
+
+    finished = purge_pending(current_app.config['PURGE_CHUNK_SIZE'],
+                             current_app.config['PURGE_LEASE_SECONDS'])
+    click.echo(f"Purged {finished} account(s).")
+
+
+def get_worker():
+    return current_app.extensions['purge_worker']
+
+
+def connect_deletion(app):
+    """Set up the purge worker and the `flask purge-deleted` command.
+
+    With PURGE_IN_BACKGROUND off, purges wait for `flask purge-deleted`.
+    """
+
+    app.config.setdefault('PURGE_CHUNK_SIZE', PURGE_CHUNK_SIZE)
+    app.config.setdefault('PURGE_LEASE_SECONDS', PURGE_LEASE_SECONDS)
+    app.config.setdefault('PURGE_IN_BACKGROUND', True)
+
+    def run_purges():
+        purge_pending(app.config['PURGE_CHUNK_SIZE'],
+                      app.config['PURGE_LEASE_SECONDS'])
+
+    worker = app.extensions['purge_worker'] = BackgroundWorker(
+        app, "account-purge", run_purges, PURGE_POLL_SECONDS)
+
+    @app.before_first_request
+    def start_purge_worker():
+        if app.config['PURGE_IN_BACKGROUND']:
+            worker.start()
+
+    app.cli.add_command(purge_command)
+
+    return worker
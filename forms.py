@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
@@ -34,3 +35,9 @@ class UserEditForm(FlaskForm):
     header_image_url = StringField('(Optional) Image URL')
     bio = TextAreaField('Bio')
     password = PasswordField('Password', validators=[Length(min=6)])
+
+
+class FollowImportForm(FlaskForm):
+    """Form for following every account in a CSV of usernames."""
+
+    file = FileField('CSV of usernames', validators=[FileRequired()])
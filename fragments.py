@@ -0,0 +1,130 @@
+"""Cache of rendered message and user cards.
+
+A card's HTML depends only on the message (which can't be edited) and on
+its author's profile, so it's rendered once and reused for every viewer,
+keyed by id and checked against a stamp built on `User.profile_version`
+(plus fields that tell apart a new row that reused a deleted row's id).
+
+The per-viewer parts (the like heart, the follow button) are rendered in
+every variant, each wrapped in `<!--name-->...<!--/name-->` markers; a
+request keeps the variants that apply to its viewer and drops the rest,
+which is a string join rather than a render.
+"""
+
+import re
+
+from flask import current_app, g, get_template_attribute
+from markupsafe import Markup
+
+from cache import TTLCache
+
+FRAGMENT_CACHE_SIZE = 20000
+FRAGMENT_CACHE_TTL = 3600
+
+SECTION = re.compile(r"<!--(\w+)-->(.*?)<!--/\1-->", re.DOTALL)
+
+
+def split_sections(html):
+    """[(section name or None, text)] for a fragment with marked sections."""
+
+    parts = []
+    position = 0
+
+    for match in SECTION.finditer(html):
+        parts.append((None, html[position:match.start()]))
+        parts.append((match.group(1), match.group(2)))
+        position = match.end()
+
+    parts.append((None, html[position:]))
+    return parts
+
+
+def join_sections(parts, keep):
+    """The fragment with only the unnamed text and the `keep` sections."""
+
+    return Markup("".join(text for name, text in parts
+                          if name is None or name in keep))
+
+
+def get_cache():
+    return current_app.extensions['fragment_cache']
+
+
+def cached_parts(kind, obj, stamp, macro):
+    """Sections of `obj`'s card, rendered with `macro` on a miss.
+
+    A cached card is only used if it was rendered with the same `stamp`.
+    """
+
+    cache = get_cache()
+    key = (kind, obj.id)
+
+    cached_stamp, parts = cache.get(key, (None, None))
+
+    if parts is None or cached_stamp != stamp:
+        render = get_template_attribute('cards.html', macro)
+        parts = split_sections(str(render(obj)))
+        cache.set(key, (stamp, parts))
+
+    return parts
+
+
+def message_fragment(message, liked_ids=()):
+    """A message card's <li> for the current viewer."""
+
+    stamp = (message.user_id, message.timestamp,
+             message.user.profile_version)
+    parts = cached_parts('message', message, stamp, 'message_item')
+
+    if g.user and g.user.id == message.user_id:
+        keep = ()
+    elif message.id in liked_ids:
+        keep = ('liked',)
+    else:
+        keep = ('unliked',)
+
+    return join_sections(parts, keep)
+
+
+def user_fragment(user):
+    """A user card for the current viewer."""
+
+    stamp = (user.username, user.profile_version)
+    parts = cached_parts('user', user, stamp, 'user_item')
+
+    if not g.user:
+        keep = ()
+    elif g.user.is_following(user):
+        keep = ('unfollow',)
+    else:
+        keep = ('follow',)
+
+    return join_sections(parts, keep)
+
+
+def forget_message(message_id):
+    """Drop a deleted message's card."""
+
+    get_cache().pop(('message', message_id))
+
+
+def forget_user(user_id):
+    """Drop a user's card after a profile edit.
+
+    Their message cards are re-rendered as they're next shown, since the
+    author's profile_version no longer matches their stamps.
+    """
+
+    get_cache().pop(('user', user_id))
+
+
+def connect_fragments(app):
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', FRAGMENT_CACHE_SIZE)
+    app.config.setdefault('FRAGMENT_CACHE_TTL', FRAGMENT_CACHE_TTL)
+
+    app.extensions['fragment_cache'] = TTLCache(
+        maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+        ttl=app.config['FRAGMENT_CACHE_TTL'])
+
+    app.add_template_global(message_fragment)
+    app.add_template_global(user_fragment)
@@ -3,75 +3,292 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Run from the repo root:
+
+    python generator/create_csvs.py                      # the bundled dataset size
+    python generator/create_csvs.py --scale large --out data/large
+    python generator/create_csvs.py --users 50000 --follows 2000000 --seed 7
+
+Output is deterministic for a given --seed (and --end-date), needs no
+network access, and is written row by row so memory stays small at any
+scale. Who gets followed, who posts, and which messages get liked follow
+Zipf distributions (--zipf), so a few hot accounts get most of the
+traffic, as on a real site.
+
+Load the result with `python loader.py --dir <out>`.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import random
+from array import array
+from datetime import datetime
+
+from helpers import ZipfSampler, random_timestamp, shuffled_ids
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
+
+# users, messages, follows, likes
+SCALES = {
+    'small': (300, 1000, 5000, 0),
+    'medium': (20000, 200000, 1000000, 500000),
+    'large': (1000000, 10000000, 50000000, 20000000),
+}
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# bcrypt hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+WORDS = """
+    about above across after again air all almost along also always among
+    animal answer any around ask away back bird birds book both bright
+    build call came carry city close cold come could country cross day
+    deep different does done down draw early earth east even every eye
+    face far farm fast feel field find fire first fish follow food form
+    found free friend full game garden give good great green group grow
+    hand happy hard head hear heard help high hill home hope house idea
+    island just keep kind know land large last late learn leave light
+    line little live long look made make many mark may mean measure might
+    mind more morning most mountain move much music must name near need
+    never new next night north note nothing now number ocean often old
+    once open order other over own paper part people picture place plant
+    play point press quick quiet rain read ready real river road rock room
+    round run said same saw say school sea second see seem sentence set
+    several shape short should show side simple sing small snow song soon
+    sound south space spring stand star start state still stone stop
+    story street strong study such summer sun sure table take talk tell
+    than thing think those thought through time today together told took
+    town travel tree true try turn under until upon usual very voice walk
+    want warm watch water way weather week well went west while white
+    whole wind window winter wish without wood word work world write year
+    young
+""".split()
 
-# Generate random profile image URLs to use for users
+PLACES = """
+    Oakland Boston Denver Austin Portland Seattle Chicago Phoenix Dallas
+    Atlanta Miami Detroit Raleigh Madison Tucson Fresno Omaha Tulsa Reno
+    Boise
+""".split()
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+HEADER_IMAGE_URLS = [
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
+    "/static/images/nav-bg.png",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def sentence(rng, min_words=4, max_words=12):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return " ".join(words).capitalize() + "."
+
+
+def write_users(path, num_users, rng):
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+        users_writer.writeheader()
+
+        for i in range(1, num_users + 1):
+            # The id suffix keeps usernames (and emails) unique at any scale.
+            username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{i}"
+            users_writer.writerow(dict(
+                email=f"{username}@example.com",
+                username=username,
+                image_url=rng.choice(IMAGE_URLS),
+                password=PASSWORD,
+                bio=sentence(rng),
+                header_image_url=rng.choice(HEADER_IMAGE_URLS),
+                location=rng.choice(PLACES),
+            ))
+
+
+def write_messages(path, num_users, num_messages, zipf, start, span, rng):
+    """Write messages; returns an array of each message's author (by id - 1)."""
+
+    posters = shuffled_ids(num_users, rng)
+    poster_rank = ZipfSampler(num_users, zipf, rng)
+    authors = array('i')
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
+        messages_writer.writeheader()
+
+        for _ in range(num_messages):
+            author = posters[poster_rank()]
+            authors.append(author)
+            messages_writer.writerow(dict(
+                text=sentence(rng, 3, 25)[:MAX_WARBLER_LENGTH],
+                timestamp=random_timestamp(start, span, rng),
+                user_id=author,
+            ))
+
+    return authors
+
+
+def distinct_draws(draw, count, exclude, max_tries):
+    """Up to `count` distinct values from `draw()`, skipping `exclude`."""
+
+    found = set()
+    tries = 0
+    while len(found) < count and tries < max_tries:
+        value = draw()
+        tries += 1
+        if value != exclude:
+            found.add(value)
+    return found
+
+
+def follow_degrees(num_users, num_follows, max_degree, rng):
+    """How many accounts each user follows (by id - 1), summing to num_follows.
+
+    Degrees are drawn around the mean, then the difference from
+    num_follows is made up one follow at a time on random users, so it's
+    spread out rather than landing on any one account.
+    """
+
+    mean_degree = num_follows / num_users
+    degrees = array('i', (min(round(rng.expovariate(1 / mean_degree)), max_degree)
+                          for _ in range(num_users)))
+
+    excess = sum(degrees) - min(num_follows, num_users * max_degree)
+    while excess:
+        i = rng.randrange(num_users)
+        if excess > 0 and degrees[i] > 0:
+            degrees[i] -= 1
+            excess -= 1
+        elif excess < 0 and degrees[i] < max_degree:
+            degrees[i] += 1
+            excess += 1
+
+    return degrees
+
+
+def write_follows(path, num_users, num_follows, zipf, rng):
+    """Each user follows ~num_follows/num_users accounts, Zipf-skewed."""
+
+    popular = shuffled_ids(num_users, rng)
+    popular_rank = ZipfSampler(num_users, zipf, rng)
+    degrees = follow_degrees(num_users, num_follows,
+                             max(num_users // 2, 1), rng)
+
+    written = 0
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
+        follows_writer.writeheader()
+
+        for follower in range(1, num_users + 1):
+            degree = degrees[follower - 1]
+            followed = distinct_draws(lambda: popular[popular_rank()],
+                                      degree, follower, degree * 20)
+            for followed_user in sorted(followed):
+                follows_writer.writerow(dict(user_being_followed_id=followed_user,
+                                             user_following_id=follower))
+            written += len(followed)
+
+    return written
+
+
+def write_likes(path, num_users, num_likes, authors, zipf, rng):
+    """Likes skewed toward popular messages; nobody likes their own."""
+
+    num_messages = len(authors)
+    popular = shuffled_ids(num_messages, rng)
+    popular_rank = ZipfSampler(num_messages, zipf, rng)
+    mean_likes = num_likes / num_users
+    max_likes = max(num_messages // 2, 1)
+
+    written = 0
+
+    with open(path, 'w', newline='') as likes_csv:
+        likes_writer = csv.DictWriter(likes_csv, fieldnames=LIKES_CSV_HEADERS)
+        likes_writer.writeheader()
+
+        for user in range(1, num_users + 1):
+            remaining = num_likes - written
+            if remaining <= 0:
+                break
+            count = min(round(rng.expovariate(1 / mean_likes)),
+                        max_likes, remaining)
+
+            liked = distinct_draws(lambda: popular[popular_rank()],
+                                   count, None, count * 20)
+            for message_id in sorted(liked):
+                if authors[message_id - 1] == user:
+                    continue
+                likes_writer.writerow(dict(user_id=user, message_id=message_id))
+                written += 1
+
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs.")
+    parser.add_argument('--scale', choices=SCALES, default='small',
+                        help="preset sizes (overridden by the options below)")
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--messages', type=int)
+    parser.add_argument('--follows', type=int)
+    parser.add_argument('--likes', type=int)
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help="Zipf exponent for follower counts, posting "
+                             "rates and likes (higher = more skew)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--end-date', default='2021-04-01',
+                        help="messages are dated in the two years before this")
+    parser.add_argument('--out', default='generator',
+                        help="directory to write the CSVs to")
+    args = parser.parse_args(argv)
+
+    num_users, num_messages, num_follows, num_likes = SCALES[args.scale]
+    num_users = args.users if args.users is not None else num_users
+    num_messages = args.messages if args.messages is not None else num_messages
+    num_follows = args.follows if args.follows is not None else num_follows
+    num_likes = args.likes if args.likes is not None else num_likes
+
+    end = datetime.fromisoformat(args.end_date)
+    start = end.replace(year=end.year - 2)
+    span = (end - start).total_seconds()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    # One generator per file, so changing one table's size doesn't
+    # reshuffle the others.
+    def rng_for(table):
+        return random.Random(f"{args.seed}:{table}")
+
+    write_users(os.path.join(args.out, 'users.csv'), num_users, rng_for('users'))
+
+    authors = write_messages(os.path.join(args.out, 'messages.csv'),
+                             num_users, num_messages, args.zipf,
+                             start, span, rng_for('messages'))
+
+    follows = 0
+    if num_follows and num_users > 1:
+        follows = write_follows(os.path.join(args.out, 'follows.csv'),
+                                num_users, num_follows, args.zipf,
+                                rng_for('follows'))
+
+    likes = 0
+    if num_likes and num_messages:
+        likes = write_likes(os.path.join(args.out, 'likes.csv'),
+                            num_users, num_likes, authors, args.zipf,
+                            rng_for('likes'))
+
+    print(f"Wrote {num_users:,} users, {num_messages:,} messages, "
+          f"{follows:,} follows and {likes:,} likes to {args.out}/")
+
+
+if __name__ == '__main__':
+    main()
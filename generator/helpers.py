@@ -1,14 +1,41 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from array import array
+from bisect import bisect
+from datetime import timedelta
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+class ZipfSampler:
+    """Draws ranks 0..n-1 with P(rank k) proportional to 1 / (k + 1) ** s.
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    Rank 0 is the most popular. The cumulative weights are kept in a
+    compact array (8 bytes per rank), and each draw is a binary search.
+    """
 
-    return datetime.fromtimestamp(random_timestamp)
+    def __init__(self, n, s, rng):
+        self.rng = rng
+        self.cumulative = array('d')
+
+        total = 0.0
+        for k in range(1, n + 1):
+            total += 1.0 / k ** s
+            self.cumulative.append(total)
+        self.total = total
+
+    def __call__(self):
+        rank = bisect(self.cumulative, self.rng.random() * self.total)
+        return min(rank, len(self.cumulative) - 1)
+
+
+def shuffled_ids(n, rng):
+    """1..n in a random order, as a compact array (rank -> id)."""
+
+    ids = array('i', range(1, n + 1))
+    rng.shuffle(ids)
+    return ids
+
+
+def random_timestamp(start, span_seconds, rng):
+    """A datetime uniformly within `span_seconds` after `start`."""
+
+    return start + timedelta(seconds=rng.uniform(0, span_seconds))
@@ -0,0 +1,362 @@
+"""The follows graph in memory, for questions asked on every profile view.
+
+FollowGraph keeps the follows table in compressed sparse row form, in
+both directions: for user id u, `out_targets[out_offsets[u]:out_offsets[u
++ 1]]` are the ids u follows, sorted, and likewise `in_*` for u's
+followers. The four arrays are 32-bit ints, so the graph costs 8 bytes
+per follow plus 8 per user id, and is built from one read of follows
+ordered by (follower, followed) (the follower index), with no per-user
+queries or User rows. Membership is a binary search, degree a
+subtraction, and intersections run over two sorted slices.
+
+Follows and unfollows made by this process are applied on top right away
+(`follows_changed`), as small per-user sets of added and removed ids. The
+whole graph is reloaded every GRAPH_REFRESH_SECONDS on a background
+thread (see background.py), or sooner once GRAPH_MAX_CHANGES changes
+have piled up. That's also how changes made by other processes arrive,
+so answers can be that stale; use it for what's shown about other users
+("follows you", "followed by ... you follow"), not for the viewer's own
+follow buttons.
+"""
+
+import logging
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from threading import Lock
+
+from flask import current_app
+
+from background import BackgroundWorker
+from models import db, Follows, DELETED_USER_IDS
+
+log = logging.getLogger(__name__)
+
+GRAPH_REFRESH_SECONDS = 300
+GRAPH_MAX_CHANGES = 10000
+
+
+def _offsets(counts):
+    """Prefix sums of `counts`: row start offsets, one past the last row."""
+
+    offsets = array('i', [0]) * (len(counts) + 1)
+    total = 0
+    for node, count in enumerate(counts):
+        offsets[node] = total
+        total += count
+    offsets[len(counts)] = total
+    return offsets
+
+
+def _contains(targets, lo, hi, value):
+    i = bisect_left(targets, value, lo, hi)
+    return i < hi and targets[i] == value
+
+
+class FollowGraph:
+    """Follows as CSR arrays plus this process's changes since loading."""
+
+    def __init__(self, followers, followed):
+        """Build from parallel arrays of follower and followed ids, sorted
+        by (follower, followed)."""
+
+        size = max(max(followers, default=0), max(followed, default=0)) + 1
+
+        out_counts = array('i', [0]) * size
+        in_counts = array('i', [0]) * size
+        for follower_id in followers:
+            out_counts[follower_id] += 1
+        for followed_id in followed:
+            in_counts[followed_id] += 1
+
+        self.size = size
+        self.edges = len(followers)
+
+        # Already in follower order, so that's the out rows, each sorted.
+        self.out_offsets = _offsets(out_counts)
+        self.out_targets = followed
+
+        # Counting sort by followed id; it's stable, so each in row comes
+        # out sorted by follower.
+        self.in_offsets = _offsets(in_counts)
+        self.in_targets = array('i', [0]) * len(followers)
+        fill = array('i', self.in_offsets)
+        for follower_id, followed_id in zip(followers, followed):
+            self.in_targets[fill[followed_id]] = follower_id
+            fill[followed_id] += 1
+
+        # {user id: ids} added since loading (not in the arrays) and
+        # removed (in the arrays), for each direction.
+        self._added = {'out': {}, 'in': {}}
+        self._removed = {'out': {}, 'in': {}}
+        self.changes = 0
+        self.loaded_at = None
+        self._lock = Lock()
+
+    @classmethod
+    def load(cls):
+        """The graph of the follows table now."""
+
+        loaded_at = datetime.utcnow()
+        followers = array('i')
+        followed = array('i')
+
+        rows = (db.session
+                .query(Follows.user_following_id,
+                       Follows.user_being_followed_id)
+                .filter(Follows.user_following_id.notin_(DELETED_USER_IDS),
+                        Follows.user_being_followed_id.notin_(
+                            DELETED_USER_IDS))
+                .order_by(Follows.user_following_id,
+                          Follows.user_being_followed_id)
+                .yield_per(10000))
+
+        for follower_id, followed_id in rows:
+            followers.append(follower_id)
+            followed.append(followed_id)
+
+        graph = cls(followers, followed)
+        graph.loaded_at = loaded_at
+        return graph
+
+    def nbytes(self):
+        """Bytes held by the arrays (not the change sets)."""
+
+        return sum(arr.itemsize * len(arr) for arr in (
+            self.out_offsets, self.out_targets,
+            self.in_offsets, self.in_targets))
+
+    def _row(self, direction, user_id):
+        """(targets, lo, hi) of `user_id`'s loaded row in `direction`."""
+
+        if direction == 'out':
+            offsets, targets = self.out_offsets, self.out_targets
+        else:
+            offsets, targets = self.in_offsets, self.in_targets
+
+        if not 0 <= user_id < self.size:
+            return targets, 0, 0
+        return targets, offsets[user_id], offsets[user_id + 1]
+
+    def _has(self, direction, user_id, other_id):
+        if other_id in self._added[direction].get(user_id, ()):
+            return True
+        if other_id in self._removed[direction].get(user_id, ()):
+            return False
+        return _contains(*self._row(direction, user_id), other_id)
+
+    def _ids(self, direction, user_id):
+        targets, lo, hi = self._row(direction, user_id)
+        ids = set(targets[lo:hi])
+        ids -= self._removed[direction].get(user_id, set())
+        ids |= self._added[direction].get(user_id, set())
+        return ids
+
+    def _degree(self, direction, user_id):
+        _, lo, hi = self._row(direction, user_id)
+        return (hi - lo
+                + len(self._added[direction].get(user_id, ()))
+                - len(self._removed[direction].get(user_id, ())))
+
+    def follows(self, user_id, other_id):
+        """Does `user_id` follow `other_id`?"""
+
+        with self._lock:
+            return self._has('out', user_id, other_id)
+
+    def following_count(self, user_id):
+        with self._lock:
+            return self._degree('out', user_id)
+
+    def followers_count(self, user_id):
+        with self._lock:
+            return self._degree('in', user_id)
+
+    def following(self, user_id):
+        """Sorted ids of the users `user_id` follows."""
+
+        with self._lock:
+            return sorted(self._ids('out', user_id))
+
+    def followers(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        with self._lock:
+            return sorted(self._ids('in', user_id))
+
+    def followed_by_followed(self, viewer_id, user_id):
+        """Sorted ids of the users `viewer_id` follows who follow `user_id`.
+
+        Intersects the smaller of the two rows into the larger.
+        """
+
+        with self._lock:
+            if self._degree('out', viewer_id) <= self._degree('in', user_id):
+                small, large = ('out', viewer_id), ('in', user_id)
+            else:
+                small, large = ('in', user_id), ('out', viewer_id)
+
+            return sorted(other_id for other_id in self._ids(*small)
+                          if self._has(*large, other_id))
+
+    def common_following(self, user_id, other_id):
+        """Sorted ids followed by both `user_id` and `other_id`."""
+
+        with self._lock:
+            return sorted(self._ids('out', user_id)
+                          & self._ids('out', other_id))
+
+    def _set(self, direction, user_id, other_id, present):
+        added = self._added[direction]
+        removed = self._removed[direction]
+        loaded = _contains(*self._row(direction, user_id), other_id)
+
+        if present == loaded:
+            added.get(user_id, set()).discard(other_id)
+            removed.get(user_id, set()).discard(other_id)
+        elif present:
+            added.setdefault(user_id, set()).add(other_id)
+        else:
+            removed.setdefault(user_id, set()).add(other_id)
+
+    def set_follow(self, follower_id, followed_id, following):
+        """Record that `follower_id` now follows `followed_id` (or not)."""
+
+        with self._lock:
+            self._set('out', follower_id, followed_id, following)
+            self._set('in', followed_id, follower_id, following)
+            self.changes += 1
+
+
+class GraphHolder:
+    """The current FollowGraph of a process, reloaded in the background.
+
+    Loads run one at a time; a request that finds no graph waits for the
+    load in flight. Changes made while a load reads the table are
+    replayed onto the new graph before it replaces the old one.
+    """
+
+    def __init__(self, max_changes=GRAPH_MAX_CHANGES):
+        self.max_changes = max_changes
+        self.graph = None
+        self.worker = None
+        self._lock = Lock()
+        self._load_lock = Lock()
+        self._replay = None
+
+    def get(self):
+        graph = self.graph
+        if graph is None:
+            with self._load_lock:
+                if self.graph is None:
+                    self._load()
+                graph = self.graph
+        return graph
+
+    def reload(self):
+        with self._load_lock:
+            self._load()
+
+    def _load(self):
+        replay = []
+        with self._lock:
+            self._replay = replay
+
+        try:
+            graph = FollowGraph.load()
+        except Exception:
+            with self._lock:
+                self._replay = None
+            raise
+
+        with self._lock:
+            for change in replay:
+                graph.set_follow(*change)
+            self._replay = None
+            self.graph = graph
+
+        log.info("Loaded follow graph: %d follows, %d bytes",
+                 graph.edges, graph.nbytes())
+
+    def reset(self):
+        """Forget the graph; the next get() loads it again."""
+
+        with self._load_lock, self._lock:
+            self.graph = None
+
+    def set_follow(self, follower_id, followed_id, following):
+        """Apply a change; returns True once the graph is due a reload."""
+
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((follower_id, followed_id, following))
+            graph = self.graph
+
+        # Not loaded yet: the first load will read it from the table.
+        if graph is None:
+            return False
+
+        graph.set_follow(follower_id, followed_id, following)
+        return graph.changes >= self.max_changes
+
+
+def get_graph():
+    """This process's follow graph, loading it on first use."""
+
+    return current_app.extensions['follow_graph'].get()
+
+
+def loaded_at():
+    """When this process's graph was read from the table (None if not yet).
+
+    A page built from the graph needs this among its HTTP validators:
+    changes made by other processes only show up with a reload.
+    """
+
+    graph = current_app.extensions['follow_graph'].graph
+    return graph.loaded_at if graph else None
+
+
+def reset():
+    """Drop this process's graph (between tests); it loads on next use."""
+
+    current_app.extensions['follow_graph'].reset()
+
+
+def follows_changed(follower_id, followed_ids, following):
+    """Apply follows (or unfollows) by `follower_id` that were committed."""
+
+    holder = current_app.extensions['follow_graph']
+
+    due = False
+    for followed_id in followed_ids:
+        due = holder.set_follow(follower_id, followed_id, following)
+
+    if due and current_app.config['GRAPH_IN_BACKGROUND']:
+        holder.worker.notify()
+
+
+def connect_graph(app):
+    """Keep a follow graph per process, reloaded in the background.
+
+    With GRAPH_IN_BACKGROUND off, it's loaded on first use and then only
+    sees this process's changes.
+    """
+
+    app.config.setdefault('GRAPH_REFRESH_SECONDS', GRAPH_REFRESH_SECONDS)
+    app.config.setdefault('GRAPH_MAX_CHANGES', GRAPH_MAX_CHANGES)
+    app.config.setdefault('GRAPH_IN_BACKGROUND', True)
+
+    holder = app.extensions['follow_graph'] = GraphHolder(
+        app.config['GRAPH_MAX_CHANGES'])
+
+    holder.worker = BackgroundWorker(
+        app, "follow-graph", holder.reload,
+        app.config['GRAPH_REFRESH_SECONDS'])
+
+    @app.before_first_request
+    def start_graph_worker():
+        if app.config['GRAPH_IN_BACKGROUND']:
+            holder.worker.start()
+
+    return holder
@@ -0,0 +1,75 @@
+"""Conditional GETs (ETag / Last-Modified) for Warbler pages.
+
+A page's validators come from cheap version stamps (mostly
+`User.updated_at`) instead of from rendering it, so an unchanged page is
+answered with 304 Not Modified before its queries and template run.
+
+Pages are per-viewer (follow buttons, hearts, the nav bar, the CSRF
+token in the new-message form), so they're sent `private, no-cache`
+with `Vary: Cookie`: browsers may keep a copy but must revalidate it,
+and shared caches must not store it. Responses that don't opt in keep
+the app-wide `no-store`.
+"""
+
+import hashlib
+import time
+from datetime import datetime
+
+from flask import current_app, g, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+# Changes on restart, so a deploy (new templates) invalidates every page.
+STARTED_AT = datetime.utcnow()
+
+
+def viewer_stamps():
+    """Stamps for whatever about the viewer shows up on every page."""
+
+    if not g.user:
+        return (None,)
+
+    # Signed CSRF tokens expire (WTF_CSRF_TIME_LIMIT); don't keep serving
+    # a page whose token is more than half-way there.
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    epoch = int(time.time() // (limit / 2)) if limit else 0
+
+    return (g.user.id, g.user.updated_at, session.get('csrf_token'), epoch)
+
+
+def validators(*stamps):
+    """(weak ETag, Last-Modified) for a page built from `stamps`."""
+
+    stamps = (STARTED_AT,) + stamps + viewer_stamps()
+    etag = hashlib.sha1(repr(stamps).encode('UTF-8')).hexdigest()
+    last_modified = max(stamp for stamp in stamps
+                        if isinstance(stamp, datetime))
+
+    return etag, last_modified
+
+
+def conditional(render, *stamps):
+    """Answer 304 if the client's copy of the page is current, else render().
+
+    `stamps` are values that change whenever the page does, e.g. the
+    `updated_at` of the users it shows; the viewer is always included.
+    """
+
+    if session.get('_flashes'):
+        # Flashed messages show once, so this render can't be reused.
+        return make_response(render())
+
+    etag, last_modified = validators(*stamps)
+
+    if is_resource_modified(request.environ, etag=etag,
+                            last_modified=last_modified):
+        response = make_response(render())
+    else:
+        response = current_app.response_class(status=304)
+
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+
+    return response
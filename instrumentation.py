@@ -0,0 +1,195 @@
+"""Per-request SQL instrumentation for Warbler.
+
+Every statement run through SQLAlchemy is timed (engine cursor events).
+For each request we keep the query count, total DB time, the slowest
+statements and how often each statement repeated, then:
+
+- add `X-Query-Count`, `X-DB-Time` and `Server-Timing` response headers
+  (SQL_STATS_HEADERS),
+- log one JSON line per request on the "warbler.sql" logger, at WARNING
+  when a statement repeats SQL_REPEAT_WARNING times or more (the usual
+  shape of an N+1 query in a template loop).
+
+Tests can wrap code in `track_queries()`, or mix QueryBudgetMixin into a
+TestCase and use `assertMaxQueries(n)` to fail on query-count regressions.
+"""
+
+import heapq
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.sql')
+
+SLOWEST_KEPT = 3
+REPEAT_WARNING = 5
+
+# QueryStats collecting outside of requests (track_queries), per thread.
+_local = threading.local()
+
+
+class QueryStats:
+    """Running totals for the statements run in some unit of work."""
+
+    def __init__(self, keep=SLOWEST_KEPT):
+        self.keep = keep
+        self.count = 0
+        self.duration = 0.0
+        self.statements = []
+        self.repeats = Counter()
+        self._slowest = []
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements.append(statement)
+        self.repeats[statement] += 1
+
+        entry = (duration, self.count, statement)
+        if len(self._slowest) < self.keep:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+    @property
+    def slowest(self):
+        """[(seconds, statement)] of the slowest statements, slowest first."""
+
+        return [(duration, statement) for duration, _, statement
+                in sorted(self._slowest, reverse=True)]
+
+    def repeated(self, at_least):
+        """{statement: times run} for statements run `at_least` times."""
+
+        return {statement: times for statement, times in self.repeats.items()
+                if times >= at_least}
+
+
+def _collectors():
+    collectors = list(getattr(_local, 'stack', ()))
+    if has_app_context():
+        stats = g.get('sql_stats')
+        if stats is not None:
+            collectors.append(stats)
+    return collectors
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['query_started'].pop()
+    for stats in _collectors():
+        stats.record(statement, duration)
+
+
+def _handle_error(context):
+    # after_cursor_execute doesn't fire for a failed statement.
+    if context.connection is not None and context.cursor is not None:
+        started = context.connection.info.get('query_started')
+        if started:
+            started.pop()
+
+
+def listen():
+    """Time statements on every engine (idempotent)."""
+
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+@contextmanager
+def track_queries(keep=SLOWEST_KEPT):
+    """Collect QueryStats for the statements run in the block (this thread)."""
+
+    listen()
+    stats = QueryStats(keep)
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(stats)
+    try:
+        yield stats
+    finally:
+        stack.remove(stats)
+
+
+def request_log_record(stats, response, elapsed, repeat_warning):
+    return {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(elapsed * 1000, 2),
+        'queries': stats.count,
+        'db_ms': round(stats.duration * 1000, 2),
+        'slowest': [{'ms': round(duration * 1000, 2), 'sql': statement}
+                    for duration, statement in stats.slowest],
+        'repeated': stats.repeated(repeat_warning),
+    }
+
+
+def connect_instrumentation(app):
+    """Collect SQL stats for every request of `app`."""
+
+    app.config.setdefault('SQL_STATS_HEADERS', True)
+    app.config.setdefault('SQL_SLOWEST_KEPT', SLOWEST_KEPT)
+    app.config.setdefault('SQL_REPEAT_WARNING', REPEAT_WARNING)
+
+    listen()
+
+    @app.before_request
+    def start_sql_stats():
+        g.sql_stats = QueryStats(app.config['SQL_SLOWEST_KEPT'])
+        g.sql_stats_started = time.perf_counter()
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return response
+
+        elapsed = time.perf_counter() - g.pop('sql_stats_started')
+
+        if app.config['SQL_STATS_HEADERS']:
+            db_ms = stats.duration * 1000
+            response.headers['X-Query-Count'] = str(stats.count)
+            response.headers['X-DB-Time'] = f"{db_ms:.2f}"
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={db_ms:.2f};desc="{stats.count} queries"')
+
+        repeat_warning = app.config['SQL_REPEAT_WARNING']
+        record = request_log_record(stats, response, elapsed, repeat_warning)
+        level = logging.WARNING if record['repeated'] else logging.INFO
+        logger.log(level, json.dumps(record))
+
+        return response
+
+
+class QueryBudgetMixin:
+    """TestCase mixin: `with self.assertMaxQueries(n): ...`."""
+
+    @contextmanager
+    def assertMaxQueries(self, budget, msg=None):
+        with track_queries() as stats:
+            yield stats
+
+        if stats.count > budget:
+            statements = "\n".join(
+                f"  {times}x {statement}"
+                for statement, times in stats.repeats.most_common())
+            self.fail(self._formatMessage(
+                msg, f"{stats.count} queries run, budget is {budget}:\n"
+                     f"{statements}"))
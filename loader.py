@@ -0,0 +1,313 @@
+"""Streaming bulk loader for Warbler's CSV datasets.
+
+Loads users, messages, follows and (optionally) likes CSVs as made by
+generator/create_csvs.py:
+
+    python loader.py                      # recreate the schema, load generator/*.csv
+    python loader.py --append             # add to what's already there
+    python loader.py --dir data/large --parallel --chunk-size 100000
+
+Each CSV is streamed in chunks of --chunk-size rows and every chunk is
+committed on its own, so memory stays flat and an interrupted load keeps
+what it finished. Postgres loads use COPY; other databases (SQLite, for
+local testing) fall back to batched executemany inserts.
+
+Ids in the CSVs are 1-based row positions (the n-th user is user n). The
+loader assigns ids explicitly, offset past the existing rows in --append
+mode, and remaps the foreign keys to match.
+
+Secondary indexes on the loaded tables are dropped before the load and
+rebuilt after it (--keep-indexes to skip). With --parallel, messages and
+follows load concurrently once users are in (Postgres only). Stored
+counters are recomputed at the end, then migrations are run; a fresh
+load runs them all again, which rebuilds the search indexes.
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import sqlalchemy as sa
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# table -> (CSV columns, columns written, {fk column: table it points at})
+TABLES = {
+    'users': (
+        ['email', 'username', 'image_url', 'password', 'bio',
+         'header_image_url', 'location'],
+        ['id', 'email', 'username', 'image_url', 'password', 'bio',
+         'header_image_url', 'location'],
+        {},
+    ),
+    'messages': (
+        ['text', 'timestamp', 'user_id'],
+        ['id', 'text', 'timestamp', 'user_id'],
+        {'user_id': 'users'},
+    ),
+    'follows': (
+        ['user_being_followed_id', 'user_following_id'],
+        ['user_being_followed_id', 'user_following_id'],
+        {'user_being_followed_id': 'users', 'user_following_id': 'users'},
+    ),
+    'likes': (
+        ['user_id', 'message_id'],
+        ['user_id', 'message_id'],
+        {'user_id': 'users', 'message_id': 'messages'},
+    ),
+}
+
+# Tables with their own serial id, assigned from the row position.
+SERIAL_TABLES = ('users', 'messages')
+
+# Load order; tables in the same stage only depend on earlier stages.
+STAGES = [['users'], ['messages', 'follows'], ['likes']]
+
+
+def print_progress(table, rows, elapsed):
+    rate = rows / elapsed if elapsed else 0
+    print(f"{table}: {rows:,} rows ({rate:,.0f} rows/s)", file=sys.stderr)
+
+
+def read_rows(path, table, offsets):
+    """Stream the rows of a CSV as tuples in TABLES[table] column order."""
+
+    csv_columns, columns, foreign_keys = TABLES[table]
+
+    with open(path, newline='') as file:
+        for position, record in enumerate(csv.DictReader(file), start=1):
+            row = {name: record.get(name) or None for name in csv_columns}
+            for column, target in foreign_keys.items():
+                row[column] = int(row[column]) + offsets[target]
+            if table in SERIAL_TABLES:
+                row['id'] = position + offsets[table]
+            yield tuple(row[name] for name in columns)
+
+
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def copy_chunk(engine, table, columns, chunk):
+    """Write one chunk with Postgres COPY and commit it."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(chunk)
+    buffer.seek(0)
+
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {table} ({', '.join(columns)}) "
+                f"FROM STDIN WITH (FORMAT csv)", buffer)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def insert_chunk(engine, table, columns, chunk):
+    """Write one chunk with a batched executemany insert and commit it."""
+
+    target = sa.table(table, *[sa.column(name) for name in columns])
+
+    if 'timestamp' in columns:
+        at = columns.index('timestamp')
+        chunk = [row[:at] + (datetime.fromisoformat(row[at]),) + row[at + 1:]
+                 for row in chunk]
+
+    with engine.begin() as connection:
+        connection.execute(target.insert(),
+                           [dict(zip(columns, row)) for row in chunk])
+
+
+def load_table(engine, table, path, offsets, chunk_size, progress):
+    """Stream one CSV into `table`; returns the number of rows loaded."""
+
+    columns = TABLES[table][1]
+    write = copy_chunk if engine.dialect.name == 'postgresql' else insert_chunk
+
+    loaded = 0
+    started = time.perf_counter()
+
+    for chunk in chunks(read_rows(path, table, offsets), chunk_size):
+        write(engine, table, columns, chunk)
+        loaded += len(chunk)
+        progress(table, loaded, time.perf_counter() - started)
+
+    return loaded
+
+
+def drop_indexes(engine, tables):
+    """Drop the secondary indexes on `tables`; returns their DDL to rebuild.
+
+    Primary keys and unique constraints are left alone.
+    """
+
+    with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            rows = connection.execute(sa.text(
+                "SELECT i.indexname, i.indexdef FROM pg_indexes i "
+                "WHERE i.schemaname = current_schema() "
+                "AND i.tablename = ANY(:tables) "
+                "AND NOT EXISTS (SELECT 1 FROM pg_constraint c "
+                "WHERE c.conname = i.indexname)"),
+                {'tables': list(tables)})
+        elif engine.dialect.name == 'sqlite':
+            rows = connection.execute(sa.text(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                "AND sql IS NOT NULL AND tbl_name IN ({})".format(
+                    ", ".join(f"'{table}'" for table in tables))))
+        else:
+            return []
+
+        indexes = list(rows)
+        for name, _ in indexes:
+            connection.execute(sa.text(f'DROP INDEX "{name}"'))
+
+    return [ddl for _, ddl in indexes]
+
+
+def rebuild_indexes(engine, statements, progress):
+    started = time.perf_counter()
+
+    with engine.begin() as connection:
+        for statement in statements:
+            connection.execute(sa.text(statement))
+
+    progress('indexes', len(statements), time.perf_counter() - started)
+
+
+def reset_sequences(engine, tables):
+    """Move Postgres id sequences past the explicitly assigned ids."""
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    with engine.begin() as connection:
+        for table in tables:
+            connection.execute(sa.text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"coalesce((SELECT max(id) FROM {table}), 0) + 1, false)"))
+
+
+def current_offsets(engine):
+    """Largest existing id of each serial table (0 when empty)."""
+
+    with engine.connect() as connection:
+        return {
+            table: connection.execute(
+                sa.text(f"SELECT coalesce(max(id), 0) FROM {table}")).scalar()
+            for table in SERIAL_TABLES
+        }
+
+
+def load(engine, paths, append=False, parallel=False, defer_indexes=None,
+         chunk_size=DEFAULT_CHUNK_SIZE, progress=print_progress):
+    """Load the CSVs in `paths` ({table: path}) into the database.
+
+    The schema must already exist. Returns {table: rows loaded}.
+    """
+
+    if defer_indexes is None:
+        defer_indexes = not append
+
+    if engine.dialect.name != 'postgresql':
+        # SQLite allows one writer at a time.
+        parallel = False
+
+    offsets = current_offsets(engine) if append else dict.fromkeys(SERIAL_TABLES, 0)
+
+    index_ddl = drop_indexes(engine, list(paths)) if defer_indexes else []
+
+    loaded = {}
+
+    def run(table):
+        loaded[table] = load_table(engine, table, paths[table], offsets,
+                                   chunk_size, progress)
+
+    with ThreadPoolExecutor(max_workers=2 if parallel else 1) as pool:
+        for stage in STAGES:
+            stage = [table for table in stage if table in paths]
+            for future in [pool.submit(run, table) for table in stage]:
+                future.result()
+
+    reset_sequences(engine, [t for t in SERIAL_TABLES if t in paths])
+
+    if index_ddl:
+        rebuild_indexes(engine, index_ddl, progress)
+
+    return loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Bulk load Warbler CSVs into the database.")
+    parser.add_argument('--dir', default='generator',
+                        help="directory holding users.csv, messages.csv, "
+                             "follows.csv and (optionally) likes.csv")
+    parser.add_argument('--append', action='store_true',
+                        help="add to existing data instead of recreating "
+                             "the schema")
+    parser.add_argument('--parallel', action='store_true',
+                        help="load independent tables concurrently")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--keep-indexes', action='store_true',
+                        help="don't drop and rebuild secondary indexes")
+    args = parser.parse_args(argv)
+
+    paths = {
+        table: os.path.join(args.dir, f"{table}.csv")
+        for table in TABLES
+        if os.path.exists(os.path.join(args.dir, f"{table}.csv"))
+    }
+
+    if not paths:
+        parser.error(f"no CSVs found in {args.dir!r}")
+
+    from app import app
+    from migrations import schema_migrations, upgrade
+    from models import db, Message, User
+
+    with app.app_context():
+        if not args.append:
+            db.drop_all()
+            # Forget the applied migrations too, so the upgrade below
+            # rebuilds what they made (search indexes and triggers).
+            schema_migrations.drop(db.engine, checkfirst=True)
+            db.create_all()
+
+        loaded = load(db.engine, paths,
+                      append=args.append,
+                      parallel=args.parallel,
+                      defer_indexes=False if args.keep_indexes else None,
+                      chunk_size=args.chunk_size)
+
+        # The CSVs don't carry the denormalized counters.
+        repaired = User.recount()
+        Message.recount_likes()
+        db.session.commit()
+
+        # After the load, so the search indexes are built over all of it.
+        migrated = upgrade(db.engine)
+
+    for table, rows in loaded.items():
+        print(f"Loaded {rows:,} {table}.")
+    print(f"Recounted {repaired:,} users.")
+    print(f"Applied {len(migrated)} migration(s).")
+
+
+if __name__ == '__main__':
+    main()
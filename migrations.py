@@ -0,0 +1,411 @@
+"""Versioned schema migrations for Warbler.
+
+`db.create_all()` only creates missing tables, so columns and indexes
+added to models.py after a database was made need a migration here.
+Each migration has a version, runs once, and is recorded in the
+schema_migrations table. Run the pending ones with `flask migrate`
+(`flask migrate --list` shows what's applied).
+
+Migrations look before they change anything, so on a database made by
+create_all (which already has it all) they're just recorded. On an empty
+database, `upgrade` runs create_all first, so a first deploy's `flask
+migrate` makes the whole schema.
+
+On Postgres, indexes are built with CREATE INDEX CONCURRENTLY, which
+doesn't block writes to the table while it runs. That can't happen in a
+transaction, so index migrations run on an autocommit connection; an
+index left invalid by an interrupted build is dropped and rebuilt on the
+next run.
+
+`unindexed_scans` reports the tables a statement's plan reads in full,
+for tests that check hot queries still use their indexes.
+"""
+
+import json
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Column, DateTime, MetaData, Table, Text
+
+import search
+from models import db
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', Text, primary_key=True),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow),
+)
+
+MIGRATIONS = []
+
+
+class Migration:
+    """A registered schema change: `run(schema)` applies it."""
+
+    def __init__(self, version, run, transactional):
+        self.version = version
+        self.run = run
+        self.transactional = transactional
+        self.description = (run.__doc__ or "").strip().splitlines()[0]
+
+
+def migration(version, transactional=True):
+    """Register the decorated function as migration `version`.
+
+    It's called with a Schema. Pass transactional=False for changes that
+    can't run in a transaction (concurrent index builds).
+    """
+
+    def register(run):
+        MIGRATIONS.append(Migration(version, run, transactional))
+        return run
+
+    return register
+
+
+class Schema:
+    """A migration's view of the database: its connection plus helpers."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.dialect = connection.dialect.name
+
+    def execute(self, sql, **params):
+        return self.connection.execute(db.text(sql), params)
+
+    def has_column(self, table, column):
+        columns = db.inspect(self.connection).get_columns(table)
+        return any(info['name'] == column for info in columns)
+
+    def add_column(self, table, column, ddl):
+        """ALTER TABLE ... ADD COLUMN unless it's there; True if added."""
+
+        if self.has_column(table, column):
+            return False
+
+        self.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+        return True
+
+    @property
+    def timestamp(self):
+        """DDL type of a DateTime column."""
+
+        if self.dialect == 'postgresql':
+            return "TIMESTAMP WITHOUT TIME ZONE"
+        return "DATETIME"
+
+    def create_index(self, name, table, columns, where=None, using=None):
+        """Create an index unless it exists (concurrently on Postgres).
+
+        `where` makes it a partial index over the rows matching it;
+        `using` picks the index method (e.g. "gin").
+        """
+
+        method = f" USING {using}" if using else ""
+        target = f"{table}{method} ({', '.join(columns)})"
+        if where:
+            target = f"{target} WHERE {where}"
+
+        if self.dialect == 'postgresql':
+            invalid = self.execute(
+                "SELECT 1 FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name AND NOT i.indisvalid",
+                name=name).first()
+            if invalid:
+                self.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+            self.execute(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {target}")
+        else:
+            self.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+
+@migration('0001_user_counters')
+def add_user_counters(schema):
+    """Denormalized counters on users, filled in from the source tables."""
+
+    added = [
+        schema.add_column('users', name, "INTEGER NOT NULL DEFAULT 0")
+        for name in ('messages_count', 'following_count',
+                     'followers_count', 'likes_count')
+    ]
+
+    # Plain SQL rather than User.recount: a migration has to keep working
+    # against the schema of its time as models.py moves on.
+    if any(added):
+        schema.execute(
+            "UPDATE users SET "
+            "messages_count = (SELECT count(*) FROM messages m "
+            "                  WHERE m.user_id = users.id), "
+            "following_count = (SELECT count(*) FROM follows f "
+            "                   WHERE f.user_following_id = users.id), "
+            "followers_count = (SELECT count(*) FROM follows f "
+            "                   WHERE f.user_being_followed_id = users.id), "
+            "likes_count = (SELECT count(*) FROM likes l "
+            "               WHERE l.user_id = users.id)")
+
+
+@migration('0002_user_updated_at')
+def add_user_updated_at(schema):
+    """users.updated_at, the version stamp for conditional GETs."""
+
+    if schema.dialect == 'postgresql':
+        schema.add_column('users', 'updated_at',
+                          "TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()")
+    elif schema.add_column('users', 'updated_at',
+                           "DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00'"):
+        # SQLite can't add a column with a non-constant default.
+        schema.execute("UPDATE users SET updated_at = CURRENT_TIMESTAMP")
+
+
+@migration('0003_user_profile_version')
+def add_user_profile_version(schema):
+    """users.profile_version, the stamp for cached cards."""
+
+    schema.add_column('users', 'profile_version', "INTEGER NOT NULL DEFAULT 0")
+
+
+@migration('0004_messages_user_id_timestamp', transactional=False)
+def index_messages_by_user(schema):
+    """Index messages on (user_id, timestamp) for profiles and timelines."""
+
+    schema.create_index('ix_messages_user_id_timestamp', 'messages',
+                        ['user_id', 'timestamp'])
+
+
+@migration('0005_likes_message_id', transactional=False)
+def index_likes_by_message(schema):
+    """Index likes on message_id for a message's likers."""
+
+    schema.create_index('ix_likes_message_id', 'likes', ['message_id'])
+
+
+@migration('0006_follows_user_following_id', transactional=False)
+def index_follows_by_follower(schema):
+    """Index follows on user_following_id for who a user follows."""
+
+    schema.create_index('ix_follows_user_following_id', 'follows',
+                        ['user_following_id', 'user_being_followed_id'])
+
+
+@migration('0007_account_purges')
+def add_account_purges(schema):
+    """users.deleted_at and account_purges, for background account purges."""
+
+    schema.add_column('users', 'deleted_at', schema.timestamp)
+
+    schema.execute(
+        "CREATE TABLE IF NOT EXISTS account_purges ("
+        " user_id INTEGER NOT NULL PRIMARY KEY,"
+        f" requested_at {schema.timestamp} NOT NULL,"
+        " stage TEXT NOT NULL,"
+        " rows_deleted INTEGER NOT NULL,"
+        f" locked_until {schema.timestamp},"
+        f" finished_at {schema.timestamp})")
+
+
+@migration('0008_users_deleted_at', transactional=False)
+def index_deleted_users(schema):
+    """Partial index of the deleted users waiting to be purged."""
+
+    schema.create_index('ix_users_deleted_at', 'users', ['deleted_at'],
+                        where="deleted_at IS NOT NULL")
+
+
+@migration('0009_message_like_count')
+def add_message_like_count(schema):
+    """messages.like_count and trending_stale, and trending_messages."""
+
+    if schema.add_column('messages', 'like_count',
+                         "INTEGER NOT NULL DEFAULT 0"):
+        schema.execute(
+            "UPDATE messages SET like_count = "
+            "(SELECT count(*) FROM likes l WHERE l.message_id = messages.id)")
+
+    true = "true" if schema.dialect == 'postgresql' else "1"
+    schema.add_column('messages', 'trending_stale',
+                      f"BOOLEAN NOT NULL DEFAULT {true}")
+
+    schema.execute(
+        "CREATE TABLE IF NOT EXISTS trending_messages ("
+        " message_id INTEGER NOT NULL PRIMARY KEY"
+        "  REFERENCES messages (id) ON DELETE CASCADE,"
+        " score FLOAT NOT NULL,"
+        f" timestamp {schema.timestamp} NOT NULL)")
+    schema.execute("CREATE INDEX IF NOT EXISTS ix_trending_messages_score "
+                   "ON trending_messages (score)")
+
+
+@migration('0010_messages_trending_stale', transactional=False)
+def index_stale_messages(schema):
+    """Partial index of the messages waiting to be rescored for trending."""
+
+    # As SQLAlchemy writes the filter, so the planner matches the index.
+    where = ("trending_stale" if schema.dialect == 'postgresql'
+             else "trending_stale = 1")
+    schema.create_index('ix_messages_trending_stale', 'messages', ['id'],
+                        where=where)
+
+
+@migration('0011_follow_suggestions')
+def add_follow_suggestions(schema):
+    """follow_suggestions, the precomputed "who to follow" lists."""
+
+    schema.execute(
+        "CREATE TABLE IF NOT EXISTS follow_suggestions ("
+        " user_id INTEGER NOT NULL,"
+        " suggested_id INTEGER NOT NULL,"
+        " overlap INTEGER NOT NULL,"
+        " PRIMARY KEY (user_id, suggested_id))")
+
+
+@migration('0012_job_leases')
+def add_job_leases(schema):
+    """job_leases, so one process at a time runs a shared job."""
+
+    schema.execute(
+        "CREATE TABLE IF NOT EXISTS job_leases ("
+        " name TEXT NOT NULL PRIMARY KEY,"
+        f" locked_until {schema.timestamp} NOT NULL)")
+
+
+@migration('0013_search_indexes', transactional=False)
+def add_search_indexes(schema):
+    """The search backend's indexes (GIN on Postgres, FTS5 on SQLite)."""
+
+    backend = search.BACKENDS.get(schema.dialect)
+    if backend:
+        backend().install(schema)
+
+
+@migration('0014_job_lease_holder')
+def add_job_lease_holder(schema):
+    """job_leases.holder, so only the process holding a lease renews it."""
+
+    schema.add_column('job_leases', 'holder', "TEXT")
+
+
+@migration('0015_trending_messages_timestamp', transactional=False)
+def index_trending_by_timestamp(schema):
+    """Index trending_messages on timestamp, for dropping aged-out rows."""
+
+    schema.create_index('ix_trending_messages_timestamp', 'trending_messages',
+                        ['timestamp'])
+
+
+def applied_versions(connection):
+    """{version: applied_at} of the migrations already run."""
+
+    schema_migrations.create(connection, checkfirst=True)
+
+    rows = connection.execute(
+        db.select([schema_migrations.c.version,
+                   schema_migrations.c.applied_at]))
+
+    return {version: applied_at for version, applied_at in rows}
+
+
+def upgrade(engine):
+    """Run every pending migration, oldest first; returns their versions."""
+
+    with engine.begin() as connection:
+        # The migrations alter tables that create_all makes; on an empty
+        # database they'd have nothing to alter.
+        if not db.inspect(connection).has_table('users'):
+            db.metadata.create_all(connection)
+        applied = applied_versions(connection)
+
+    done = []
+
+    for pending in MIGRATIONS:
+        if pending.version in applied:
+            continue
+
+        if pending.transactional:
+            with engine.begin() as connection:
+                pending.run(Schema(connection))
+                connection.execute(schema_migrations.insert()
+                                   .values(version=pending.version))
+        else:
+            with engine.connect() as connection:
+                connection = connection.execution_options(
+                    isolation_level='AUTOCOMMIT')
+                pending.run(Schema(connection))
+                connection.execute(schema_migrations.insert()
+                                   .values(version=pending.version))
+
+        done.append(pending.version)
+
+    return done
+
+
+def unindexed_scans(engine, statement, parameters=()):
+    """Names of the tables `statement`'s plan reads without an index.
+
+    `statement` and `parameters` are as sent to the driver (e.g. from a
+    before_cursor_execute listener). On Postgres, sequential scans are
+    disabled for the EXPLAIN so the result doesn't depend on table size:
+    a table is only scanned if no index can serve the query.
+    """
+
+    scanned = set()
+
+    with engine.begin() as connection:
+        tables = set(db.inspect(connection).get_table_names())
+
+        if connection.dialect.name == 'postgresql':
+            connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            plan = connection.exec_driver_sql(
+                "EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+
+            nodes = [plan[0]['Plan']]
+            while nodes:
+                node = nodes.pop()
+                if node['Node Type'] == 'Seq Scan':
+                    scanned.add(node['Relation Name'])
+                nodes.extend(node.get('Plans', ()))
+        else:
+            rows = connection.exec_driver_sql(
+                "EXPLAIN QUERY PLAN " + statement, parameters)
+
+            for *_, detail in rows:
+                # "SCAN messages", or "SCAN TABLE messages" before 3.36.
+                words = [word for word in detail.split() if word != 'TABLE']
+                if words[0] == 'SCAN' and 'USING' not in words:
+                    scanned.add(words[1])
+
+    return scanned & tables
+
+
+@click.command('migrate')
+@click.option('--list', 'show', is_flag=True,
+              help="List the migrations and when each was applied.")
+@with_appcontext
+def migrate_command(show):
+    """Apply pending schema migrations."""
+
+    if show:
+        with db.engine.begin() as connection:
+            applied = applied_versions(connection)
+        for known in MIGRATIONS:
+            when = applied.get(known.version, "pending")
+            click.echo(f"{known.version:<36} {when}  {known.description}")
+        return
+
+    done = upgrade(db.engine)
+
+    for version in done:
+        click.echo(f"Applied {version}.")
+    click.echo(f"{len(done)} migration(s) applied.")
+
+
+def connect_migrations(app):
+    """Add the `flask migrate` command."""
+
+    app.cli.add_command(migrate_command)
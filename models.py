@@ -1,12 +1,55 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from uuid import uuid4
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import get_hasher
+from replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
+
+
+def insert_if_missing(model, **values):
+    """INSERT a row of `model` unless its key already exists.
+
+    One statement (ON CONFLICT DO NOTHING) on Postgres and SQLite. Returns
+    True if a row was inserted, False if it was already there.
+    """
+
+    return insert_many_if_missing(model, [values]) == 1
+
+
+def insert_many_if_missing(model, rows):
+    """INSERT the `rows` (dicts) of `model` whose keys don't exist yet.
+
+    A single multi-row statement on Postgres and SQLite. Returns the
+    number of rows inserted.
+    """
+
+    if not rows:
+        return 0
+
+    dialects = {'postgresql': postgresql, 'sqlite': sqlite}
+    dialect = dialects.get(db.engine.dialect.name)
+
+    if dialect is not None:
+        statement = (dialect.insert(model.__table__)
+                     .values(rows)
+                     .on_conflict_do_nothing())
+        return db.session.execute(statement).rowcount
+
+    inserted = 0
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(model.__table__.insert().values(**row))
+        except IntegrityError:
+            continue
+        inserted += 1
+    return inserted
 
 
 class Follows(db.Model):
@@ -14,6 +57,13 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key leads with user_being_followed_id (followers of a
+    # user); this covers the other direction (who a user follows).
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -26,12 +76,33 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Follow a user; True if not already following (caller commits)."""
+
+        return insert_if_missing(cls, user_following_id=follower_id,
+                                 user_being_followed_id=followed_id)
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Unfollow a user; True if they were followed (caller commits)."""
+
+        deleted = (cls.query
+                   .filter_by(user_following_id=follower_id,
+                              user_being_followed_id=followed_id)
+                   .delete(synchronize_session=False))
+        return deleted == 1
+
 
 class Like(db.Model):
     """Connection of a message <-> user"""
 
     __tablename__ = 'likes'
 
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -44,6 +115,39 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def liked_ids(cls, user_id, message_ids):
+        """Which of `message_ids` has `user_id` liked? Returns a set.
+
+        One query, limited to the given messages, so a page of cards can
+        check likes without loading the user's liked_messages.
+        """
+
+        if not user_id or not message_ids:
+            return set()
+
+        return {
+            message_id for (message_id,) in
+            db.session
+            .query(cls.message_id)
+            .filter(cls.user_id == user_id)
+            .filter(cls.message_id.in_(message_ids))
+        }
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Like a message; True if it wasn't liked already (caller commits)."""
+
+        return insert_if_missing(cls, user_id=user_id, message_id=message_id)
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Unlike a message; True if it was liked (caller commits)."""
+
+        deleted = (cls.query
+                   .filter_by(user_id=user_id, message_id=message_id)
+                   .delete(synchronize_session=False))
+        return deleted == 1
 
 
 class User(db.Model):
@@ -51,6 +155,13 @@ class User(db.Model):
 
     __tablename__ = 'users'
 
+    # Only the few accounts waiting to be purged are in this index.
+    __table_args__ = (
+        db.Index('ix_users_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL'),
+                 sqlite_where=db.text('deleted_at IS NOT NULL')),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -96,6 +207,64 @@ class User(db.Model):
         default=False
     )
 
+    # Denormalized counters shown in stats.html; kept in step by the write
+    # paths in app.py and repaired in bulk by `User.recount`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Version stamp for conditional GETs: set on every UPDATE of the row,
+    # including counter bumps, so it changes whenever anything shown on
+    # this user's pages (or anything this user sees as a viewer) does.
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    # Bumped by profile edits only; cached cards (fragments.py) showing
+    # this user's name, picture or bio are keyed on it.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Set when the account is deleted; from then on the user and their
+    # messages are hidden from every query (deletion.py) until the purge
+    # worker removes their rows.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message', order_by='Message.timestamp.desc()')
 
     liked_messages = db.relationship('Message', secondary="likes")
@@ -117,17 +286,147 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def _follow_checks(self, direction):
+        """{"checked": ids looked up, "found": ids of those that matched}.
+
+        Plain (unmapped) attribute, cleared when the instance is expired,
+        e.g. by a commit.
+        """
+
+        checks = self.__dict__.get('_follow_checks_cache')
+        if checks is None:
+            checks = self.__dict__['_follow_checks_cache'] = {
+                'following': {'checked': set(), 'found': set()},
+                'followers': {'checked': set(), 'found': set()},
+            }
+        return checks[direction]
+
+    def load_following_ids(self, user_ids):
+        """Look up which of `user_ids` this user follows, in one query.
+
+        Later is_following calls for those users are set lookups.
+        """
+
+        self._load_follow_ids('following', user_ids)
+
+    def load_follower_ids(self, user_ids):
+        """Look up which of `user_ids` follow this user, in one query."""
+
+        self._load_follow_ids('followers', user_ids)
+
+    def _load_follow_ids(self, direction, user_ids):
+        checks = self._follow_checks(direction)
+        user_ids = set(user_ids) - checks['checked']
+        if not user_ids:
+            return
+
+        if direction == 'following':
+            mine = Follows.user_following_id
+            theirs = Follows.user_being_followed_id
+        else:
+            mine = Follows.user_being_followed_id
+            theirs = Follows.user_following_id
+
+        found = (db.session
+                 .query(theirs)
+                 .filter(mine == self.id)
+                 .filter(theirs.in_(user_ids)))
+
+        checks['found'].update(user_id for (user_id,) in found)
+        checks['checked'].update(user_ids)
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        self.load_follower_ids([other_user.id])
+        return other_user.id in self._follow_checks('followers')['found']
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        self.load_following_ids([other_user.id])
+        return other_user.id in self._follow_checks('following')['found']
+
+    @classmethod
+    def bump_counts(cls, user_ids, **deltas):
+        """Add `deltas` (e.g. followers_count=1) to the counters of `user_ids`.
+
+        `user_ids` is an id, a list of ids or a select of ids. Runs as a
+        single UPDATE so no relationship collections are loaded.
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        values = {
+            getattr(cls, name): getattr(cls, name) + delta
+            for name, delta in deltas.items()
+            if delta
+        }
+
+        if isinstance(user_ids, (list, tuple, set)) and not user_ids:
+            return
+        if not values:
+            return
+
+        (cls.query
+            .filter(cls.id.in_(user_ids))
+            .update(values, synchronize_session=False))
+
+    @classmethod
+    def count_expressions(cls):
+        """Correlated subqueries computing each counter from the source tables."""
+
+        return {
+            'messages_count': (
+                db.select([db.func.count(Message.id)])
+                .where(Message.user_id == cls.id)
+                .scalar_subquery()),
+            # Follows of deleted users stay until they're purged, but
+            # don't count from the moment of deletion.
+            'following_count': (
+                db.select([db.func.count()])
+                .select_from(Follows)
+                .where(Follows.user_following_id == cls.id)
+                .where(Follows.user_being_followed_id.notin_(DELETED_USER_IDS))
+                .scalar_subquery()),
+            'followers_count': (
+                db.select([db.func.count()])
+                .select_from(Follows)
+                .where(Follows.user_being_followed_id == cls.id)
+                .where(Follows.user_following_id.notin_(DELETED_USER_IDS))
+                .scalar_subquery()),
+            'likes_count': (
+                db.select([db.func.count()])
+                .select_from(Like)
+                .where(Like.user_id == cls.id)
+                .scalar_subquery()),
+        }
+
+    @classmethod
+    def recount(cls, user_ids=None):
+        """Recompute every counter from the source tables.
+
+        Only rows whose stored counters have drifted are written. Pass
+        `user_ids` to limit the repair to some users. Returns the number
+        of users that were repaired (caller commits).
+        """
+
+        expressions = cls.count_expressions()
+
+        drifted = db.or_(*[
+            getattr(cls, name) != expression
+            for name, expression in expressions.items()
+        ])
+
+        query = cls.query.filter(drifted)
+        if user_ids is not None:
+            query = query.filter(cls.id.in_(user_ids))
+
+        return query.update(
+            {getattr(cls, name): expression
+             for name, expression in expressions.items()},
+            synchronize_session=False)
 
     @classmethod
     def signup(cls, username, email, password, image_url, admin):
@@ -136,7 +435,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = get_hasher().hash(password)
 
         user = User(
             username=username,
@@ -157,22 +456,47 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made at a different cost than the current
+        BCRYPT_LOG_ROUNDS, it's replaced with a new hash of `password`
+        (caller commits).
         """
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            hasher = get_hasher()
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
 
+# Ids of the deleted users whose rows are waiting to be purged (see
+# deletion.py). Users table columns rather than User's, so the criteria
+# hiding deleted users don't apply inside it and empty it; never
+# correlated, so it means the same inside statements that read users.
+DELETED_USER_IDS = (db.select([User.__table__.c.id])
+                    .where(User.__table__.c.deleted_at.isnot(None))
+                    .correlate(None))
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # A user's messages, newest first: profiles and timeline rebuilds.
+    # The partial index lists the messages trending.py has to rescore.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_messages_trending_stale', 'id',
+                 postgresql_where=db.text('trending_stale'),
+                 sqlite_where=db.text('trending_stale = 1')),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -186,7 +510,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -195,12 +519,250 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized: number of likes rows for this message.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Set when like_count changes (and for new messages) until trending.py
+    # has rescored the message.
+    trending_stale = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+        server_default=db.true(),
+    )
+
     user = db.relationship('User')
     likers = db.relationship('User', secondary="likes")
 
     def __repr__(self):
         return f"<Message #{self.id}: {self.text}, {self.user_id}>"
 
+    @classmethod
+    def bump_like_count(cls, message_id, delta):
+        """Add `delta` to a message's like_count (caller commits)."""
+
+        (cls.query
+            .filter(cls.id == message_id)
+            .update({cls.like_count: cls.like_count + delta,
+                     cls.trending_stale: True},
+                    synchronize_session=False))
+
+    @classmethod
+    def recount_likes(cls, message_ids=None):
+        """Recompute like_count from the likes table where it has drifted.
+
+        Pass `message_ids` to limit the repair to some messages. Returns
+        the number repaired (caller commits).
+        """
+
+        count = (db.select([db.func.count()])
+                 .select_from(Like)
+                 .where(Like.message_id == cls.id)
+                 .scalar_subquery())
+
+        query = cls.query.filter(cls.like_count != count)
+        if message_ids is not None:
+            query = query.filter(cls.id.in_(message_ids))
+
+        return query.update({cls.like_count: count, cls.trending_stale: True},
+                            synchronize_session=False)
+
+
+class TrendingMessage(db.Model):
+    """A message in the trending ranking, kept up by trending.py."""
+
+    __tablename__ = 'trending_messages'
+
+    __table_args__ = (
+        db.Index('ix_trending_messages_score', 'score'),
+        db.Index('ix_trending_messages_timestamp', 'timestamp'),
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # The message's, so ones that age out of the window can be dropped
+    # without looking at messages.
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class JobLease(db.Model):
+    """A background job that only one process may run at a time.
+
+    Whoever holds an unexpired lease runs the job; if it dies, another
+    process can claim it once `locked_until` passes. Each claim gets a
+    fresh `holder` token, and only that token renews or releases it, so
+    a holder that overran its lease can't touch the next one's.
+    """
+
+    __tablename__ = 'job_leases'
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    locked_until = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    holder = db.Column(
+        db.Text,
+    )
+
+    @classmethod
+    def claim(cls, name, seconds):
+        """Hold job `name` for `seconds`; returns the holder token, or None
+        if another process holds it. Commits."""
+
+        now = datetime.utcnow()
+        until = now + timedelta(seconds=seconds)
+        holder = uuid4().hex
+
+        claimed = (cls.query
+                   .filter(cls.name == name, cls.locked_until < now)
+                   .update({cls.locked_until: until, cls.holder: holder},
+                           synchronize_session=False))
+        if claimed:
+            db.session.commit()
+            return holder
+
+        # No expired lease: either the job has never run, or it's held.
+        db.session.add(cls(name=name, locked_until=until, holder=holder))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return None
+        return holder
+
+    @classmethod
+    def renew(cls, name, holder, seconds):
+        """Push back `holder`'s lease on job `name`; False if it's lost the
+        lease (caller commits)."""
+
+        renewed = (cls.query
+                   .filter(cls.name == name, cls.holder == holder)
+                   .update({cls.locked_until:
+                            datetime.utcnow() + timedelta(seconds=seconds)},
+                           synchronize_session=False))
+        return bool(renewed)
+
+    @classmethod
+    def release(cls, name, holder):
+        """Let any process claim job `name` now, if `holder` still holds
+        it. Commits."""
+
+        (cls.query
+            .filter(cls.name == name, cls.holder == holder)
+            .update({cls.locked_until: datetime.utcnow()},
+                    synchronize_session=False))
+        db.session.commit()
+
+
+class FollowSuggestion(db.Model):
+    """An account suggested to a user, kept up by suggestions.py.
+
+    `overlap` is how many of the accounts the user follows follow it.
+    No foreign keys: rows for deleted users are skipped when read and
+    go with the next batch run.
+    """
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    overlap = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class AccountPurge(db.Model):
+    """A deleted account whose rows are being removed (see deletion.py).
+
+    Not a foreign key to users: the row outlives the user, as a record of
+    the purge.
+    """
+
+    __tablename__ = 'account_purges'
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # The step being worked through, and rows removed so far.
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+        default='likes_given',
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # A worker holds the purge until then, renewing it every chunk; if it
+    # dies, another worker picks the purge up once this passes.
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    def __repr__(self):
+        return (f"<AccountPurge user #{self.user_id}: {self.stage}, "
+                f"{self.rows_deleted} rows>")
+
+
+@db.event.listens_for(User, 'expire')
+def forget_follow_checks(user, attrs):
+    """Follow checks are only good until the user is next expired."""
+
+    if user is not None:
+        user.__dict__.pop('_follow_checks_cache', None)
+
+
+# Loader options for a page of message cards: the authors come back in the
+# same query instead of one lazy load per card.
+MESSAGE_CARD_OPTIONS = (db.joinedload(Message.user),)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
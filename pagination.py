@@ -0,0 +1,124 @@
+"""Keyset (cursor) pagination for Warbler's list views.
+
+Message lists are ordered newest first by (timestamp, id) and user lists
+by id. A page is fetched with a WHERE on those columns rather than an
+OFFSET, so every page costs the same however deep it is.
+
+The cursor for the next page is an opaque string passed back in the
+`cursor` query-string argument.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort, current_app, request, url_for
+
+from models import db, Message, User
+
+PAGE_SIZE = 20
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(*values):
+    """Opaque cursor for a key of ints and datetimes."""
+
+    parts = [
+        value.isoformat() if isinstance(value, datetime) else str(value)
+        for value in values
+    ]
+
+    return urlsafe_b64encode("|".join(parts).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, *types):
+    """Decode a cursor made by `encode_cursor` into values of `types`.
+
+    Returns None for no cursor; aborts with 400 on a malformed one.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        parts = urlsafe_b64decode(padded.encode()).decode().split("|")
+        if len(parts) != len(types):
+            raise ValueError(cursor)
+        return tuple(
+            datetime.fromisoformat(part) if kind is datetime else kind(part)
+            for part, kind in zip(parts, types)
+        )
+    except (ValueError, UnicodeDecodeError, Base64Error):
+        abort(400)
+
+
+def message_key(message):
+    """Sort key of a message in a newest-first list: (timestamp, id)."""
+
+    return (message.timestamp, message.id)
+
+
+def decode_message_cursor(cursor):
+    return decode_cursor(cursor, datetime, int)
+
+
+def page_size():
+    return current_app.config.get('PAGE_SIZE', PAGE_SIZE)
+
+
+def make_page(items, per_page, key):
+    """Page of the first `per_page` of `items` (fetched with one extra row)."""
+
+    if len(items) > per_page:
+        items = items[:per_page]
+        return Page(items, encode_cursor(*key(items[-1])))
+
+    return Page(items, None)
+
+
+def paginate_messages(query, cursor=None, per_page=None):
+    """Page of messages from `query`, newest first, after `cursor`."""
+
+    per_page = per_page or page_size()
+
+    before = decode_message_cursor(cursor)
+    if before:
+        query = query.filter(db.tuple_(Message.timestamp, Message.id) < before)
+
+    items = (query
+             .order_by(Message.timestamp.desc(), Message.id.desc())
+             .limit(per_page + 1)
+             .all())
+
+    return make_page(items, per_page, message_key)
+
+
+def paginate_users(query, cursor=None, per_page=None):
+    """Page of users from `query`, ordered by id, after `cursor`."""
+
+    per_page = per_page or page_size()
+
+    after = decode_cursor(cursor, int)
+    if after:
+        query = query.filter(User.id > after[0])
+
+    items = query.order_by(User.id).limit(per_page + 1).all()
+
+    return make_page(items, per_page, lambda user: (user.id,))
+
+
+def next_page_url(cursor):
+    """URL of the current view with `cursor` swapped in (for templates)."""
+
+    args = request.args.to_dict()
+    args['cursor'] = cursor
+
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
+def connect_pagination(app):
+    app.config.setdefault('PAGE_SIZE', PAGE_SIZE)
+    app.add_template_global(next_page_url)
@@ -0,0 +1,90 @@
+"""Password hashing for Warbler, with a cap on concurrent hashes.
+
+bcrypt is CPU-bound and runs on the request thread that needs it, but
+only PASSWORD_WORKERS hashes run at once in a process; further callers
+wait for a slot. So a burst of logins can't take every core from the
+requests that aren't hashing (bcrypt releases the GIL, so those keep
+running meanwhile).
+
+The cost factor comes from the BCRYPT_LOG_ROUNDS config. Stored hashes
+made at a different cost are upgraded the next time their owner logs in
+(see User.authenticate).
+"""
+
+from threading import BoundedSemaphore
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+
+# bcrypt only looks at the first 72 bytes of a password; older versions of
+# the library truncated silently, newer ones raise. Keep the old behavior.
+MAX_PASSWORD_BYTES = 72
+
+
+def _encode(password):
+    return password.encode('UTF-8')[:MAX_PASSWORD_BYTES]
+
+
+def cost_of(hashed):
+    """The cost factor a bcrypt hash was made with ("$2b$12$..." -> 12)."""
+
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Hashes and checks passwords, at most `workers` at a time."""
+
+    def __init__(self, rounds=DEFAULT_ROUNDS, workers=2):
+        self.rounds = rounds
+        self.workers = workers
+        self._slots = BoundedSemaphore(workers)
+
+    def _run(self, func, *args):
+        with self._slots:
+            return func(*args)
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured cost, as text."""
+
+        salt = bcrypt.gensalt(self.rounds)
+        return self._run(bcrypt.hashpw, _encode(password), salt).decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the stored `hashed` password?"""
+
+        try:
+            return self._run(bcrypt.checkpw, _encode(password),
+                             hashed.encode('UTF-8'))
+        except ValueError:
+            # Not a bcrypt hash.
+            return False
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than the configured one?"""
+
+        return cost_of(hashed) != self.rounds
+
+
+hasher = PasswordHasher()
+
+
+def connect_passwords(app):
+    """Configure the shared hasher from BCRYPT_LOG_ROUNDS and PASSWORD_WORKERS."""
+
+    global hasher
+
+    rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+    workers = app.config.setdefault('PASSWORD_WORKERS', 2)
+
+    if (rounds, workers) != (hasher.rounds, hasher.workers):
+        hasher = PasswordHasher(rounds=rounds, workers=workers)
+
+    return hasher
+
+
+def get_hasher():
+    return hasher
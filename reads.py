@@ -0,0 +1,123 @@
+"""Queries behind the JSON read API, shared by both serving modes.
+
+The functions here build plain SELECTs. app.py runs them on the Flask
+session, and asgi.py runs them on an AsyncSession. The rows become JSON
+through the *_json helpers, so the sync and async servers return the
+same documents.
+
+The JSON timeline reads its page of message ids through timeline.py, the
+same fan-out stores and pull merge as the homepage (asgi.py runs the
+timeline's plans on its AsyncSession), and then its rows from here.
+"""
+
+from models import db, Like, Message, User
+from pagination import encode_cursor
+
+USER_COLUMNS = [
+    User.id, User.username, User.image_url, User.header_image_url,
+    User.bio, User.location, User.messages_count, User.following_count,
+    User.followers_count, User.likes_count,
+]
+
+MESSAGE_COLUMNS = [
+    Message.id, Message.text, Message.timestamp, Message.user_id,
+    User.username, User.image_url,
+]
+
+
+def user_statement(user_id):
+    return db.select(USER_COLUMNS).where(User.id == user_id)
+
+
+def user_exists_statement(user_id):
+    return db.select([User.id]).where(User.id == user_id)
+
+
+def message_statement(message_id):
+    return (db.select(MESSAGE_COLUMNS)
+            .join_from(Message, User, Message.user_id == User.id)
+            .where(Message.id == message_id))
+
+
+def newest_first(statement, limit, before=None):
+    """`statement` ordered newest message first; one page after `before`.
+
+    Fetches one extra row so message_page can tell if there's another.
+    """
+
+    if before:
+        statement = statement.where(
+            db.tuple_(Message.timestamp, Message.id) < before)
+
+    return (statement
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit + 1))
+
+
+def user_messages_statement(user_id, limit, before=None):
+    statement = (db.select(MESSAGE_COLUMNS)
+                 .join_from(Message, User, Message.user_id == User.id)
+                 .where(Message.user_id == user_id))
+
+    return newest_first(statement, limit, before)
+
+
+def liked_messages_statement(user_id, limit, before=None):
+    statement = (db.select(MESSAGE_COLUMNS)
+                 .join_from(Message, User, Message.user_id == User.id)
+                 .join(Like, Like.message_id == Message.id)
+                 .where(Like.user_id == user_id))
+
+    return newest_first(statement, limit, before)
+
+
+def messages_statement(message_ids):
+    """The messages with `message_ids`, in no particular order."""
+
+    return (db.select(MESSAGE_COLUMNS)
+            .join_from(Message, User, Message.user_id == User.id)
+            .where(Message.id.in_(message_ids)))
+
+
+def user_json(row):
+    return dict(row._mapping)
+
+
+def message_json(row):
+    return {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': row.timestamp.isoformat(),
+        'user': {
+            'id': row.user_id,
+            'username': row.username,
+            'image_url': row.image_url,
+        },
+    }
+
+
+def entries_page(rows, entries, next_cursor):
+    """{"messages": [...], "next_cursor": ...} for a page of timeline
+    entries, from the messages_statement rows of their ids.
+
+    Entries whose message is gone are skipped.
+    """
+
+    by_id = {row.id: row for row in rows}
+
+    return {'messages': [message_json(by_id[message_id])
+                         for (_, message_id, _) in entries
+                         if message_id in by_id],
+            'next_cursor': next_cursor}
+
+
+def message_page(rows, limit):
+    """{"messages": [...], "next_cursor": ...} from a newest_first fetch."""
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id)
+
+    return {'messages': [message_json(row) for row in rows],
+            'next_cursor': next_cursor}
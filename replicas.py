@@ -0,0 +1,122 @@
+"""Read replica routing for the SQLAlchemy session.
+
+With a replica configured (SQLALCHEMY_BINDS['replica'], set from
+REPLICA_DB_URL in app.py), the session sends the reads of GET and HEAD
+requests to the replica and everything else to the primary
+(SQLALCHEMY_DATABASE_URI):
+
+- a flush, or an INSERT/UPDATE/DELETE statement, always goes to the
+  primary, and the rest of that request reads from the primary too;
+- after a request that wrote, the user's session cookie keeps their
+  reads on the primary for REPLICA_STICKY_SECONDS, so they see their own
+  writes even if the replica lags;
+- outside requests (CLI commands, scripts, tests) it's the primary.
+
+Pool sizes are set per engine: SQLALCHEMY_ENGINE_OPTIONS for the primary,
+REPLICA_ENGINE_OPTIONS for the replica (`pool_options` builds either).
+For a local setup, point DB_URL and REPLICA_DB_URL at two SQLite files
+or two Postgres databases.
+"""
+
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, _EngineConnector
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND = 'replica'
+REPLICA_STICKY_SECONDS = 5
+
+# Session cookie key: until when (epoch seconds) to read from the primary.
+PRIMARY_UNTIL_KEY = 'db_primary_until'
+
+READ_METHODS = {'GET', 'HEAD'}
+
+
+def pool_options(url, pool_size, max_overflow, pool_timeout=30):
+    """Engine options for a pooled engine (none for SQLite, which doesn't
+    pool connections to a file)."""
+
+    if url.startswith('sqlite'):
+        return {}
+
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_pre_ping': True,
+    }
+
+
+def has_replica(app):
+    return REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+def note_write():
+    """Record that this request wrote, so it reads from the primary now."""
+
+    if has_request_context():
+        g.db_wrote = True
+
+
+def reads_from_replica():
+    """Should the current statement, a read, go to the replica?"""
+
+    return (has_request_context()
+            and request.method in READ_METHODS
+            and has_replica(current_app)
+            and not g.get('db_wrote')
+            and session.get(PRIMARY_UNTIL_KEY, 0) <= time.time())
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends request reads to the replica (see module doc)."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            note_write()
+        elif reads_from_replica():
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+
+        return super().get_bind(mapper, clause)
+
+
+class _ReplicaConnector(_EngineConnector):
+    """Engine connector that adds REPLICA_ENGINE_OPTIONS for the replica."""
+
+    def get_options(self, sa_url, echo):
+        sa_url, options = super().get_options(sa_url, echo)
+
+        if self._bind == REPLICA_BIND:
+            options.update(self._app.config.get('REPLICA_ENGINE_OPTIONS', {}))
+
+        return sa_url, options
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with a RoutingSession and per-bind pool options."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def make_connector(self, app=None, bind=None):
+        return _ReplicaConnector(self, self.get_app(app), bind)
+
+
+def connect_replicas(app):
+    """Keep a user's reads on the primary for a while after they write."""
+
+    app.config.setdefault('REPLICA_STICKY_SECONDS', REPLICA_STICKY_SECONDS)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if g.pop('db_wrote', False) and has_replica(app):
+            session[PRIMARY_UNTIL_KEY] = (
+                time.time() + app.config['REPLICA_STICKY_SECONDS'])
+
+        return response
@@ -0,0 +1,316 @@
+"""Indexed search over users (username, bio, location) and messages.
+
+Two backends share one interface:
+
+- PostgresSearchBackend: tsvector expression indexes (GIN) for words,
+  plus a pg_trgm index on username for substring matches.
+- SqliteSearchBackend: FTS5 tables kept in step by triggers, for local
+  testing against an SQLite database.
+
+Results are ranked (best first), paged by a (rank, id) cursor and capped
+at SEARCH_MAX_RESULTS. Id lists for hot terms are kept briefly in a
+TTLCache. The indexes are created by migration 0013_search_indexes
+(`flask migrate`).
+"""
+
+from flask import current_app
+
+from cache import TTLCache
+from models import db, Message, User, MESSAGE_CARD_OPTIONS
+from pagination import Page, decode_cursor, encode_cursor, page_size
+
+SEARCH_MAX_RESULTS = 1000
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in `term` (with backslash as the escape)."""
+
+    return (term.replace("\\", "\\\\")
+                .replace("%", "\\%")
+                .replace("_", "\\_"))
+
+
+class SearchBackend:
+    """Interface for search backends.
+
+    The search methods return up to `limit` (rank, id) pairs ranked best
+    first: higher rank first, then higher id. `after` is the (rank, id)
+    pair that results must come after.
+    """
+
+    def install(self, schema):
+        """Create the indexes this backend needs (idempotent).
+
+        `schema` is a migrations.Schema on an autocommit connection.
+        """
+
+        raise NotImplementedError
+
+    def search_users(self, term, limit, after=None):
+        raise NotImplementedError
+
+    def search_messages(self, term, limit, after=None):
+        raise NotImplementedError
+
+
+def _ranked(query, rank, id_column, limit, after):
+    """Order `query` by (rank, id) descending and page it after `after`."""
+
+    if after:
+        query = query.filter(db.tuple_(rank, id_column) < after)
+
+    rows = query.order_by(rank.desc(), id_column.desc()).limit(limit)
+    return [(row_rank, row_id) for (row_rank, row_id) in rows]
+
+
+class PostgresSearchBackend(SearchBackend):
+    """Postgres full-text and trigram search.
+
+    The document expressions below must stay identical to the ones in
+    INDEXES for the planner to use the expression indexes.
+    """
+
+    USER_DOCUMENT = ("to_tsvector('simple', coalesce(username, '') || ' ' || "
+                     "coalesce(bio, '') || ' ' || coalesce(location, ''))")
+
+    MESSAGE_DOCUMENT = "to_tsvector('english', \"text\")"
+
+    # (name, table, column or expression), all GIN.
+    INDEXES = [
+        ('ix_users_search', 'users', f"({USER_DOCUMENT})"),
+        ('ix_users_username_trgm', 'users', "username gin_trgm_ops"),
+        ('ix_messages_search', 'messages', f"({MESSAGE_DOCUMENT})"),
+    ]
+
+    def install(self, schema):
+        schema.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for name, table, column in self.INDEXES:
+            schema.create_index(name, table, [column], using='gin')
+
+    def search_users(self, term, limit, after=None):
+        document = db.literal_column(self.USER_DOCUMENT)
+        words = db.func.plainto_tsquery('simple', term)
+
+        rank = db.cast(
+            db.func.greatest(db.func.similarity(User.username, term),
+                             db.func.ts_rank(document, words)),
+            db.Float)
+
+        query = (db.session
+                 .query(rank, User.id)
+                 .filter(db.or_(
+                     document.op('@@')(words),
+                     User.username.ilike(f"%{escape_like(term)}%",
+                                         escape="\\"))))
+
+        return _ranked(query, rank, User.id, limit, after)
+
+    def search_messages(self, term, limit, after=None):
+        document = db.literal_column(self.MESSAGE_DOCUMENT)
+        words = db.func.plainto_tsquery('english', term)
+
+        rank = db.cast(db.func.ts_rank(document, words), db.Float)
+
+        query = (db.session
+                 .query(rank, Message.id)
+                 .filter(document.op('@@')(words)))
+
+        return _ranked(query, rank, Message.id, limit, after)
+
+
+class SqliteSearchBackend(SearchBackend):
+    """SQLite FTS5 search, ranked by bm25.
+
+    users_fts uses the trigram tokenizer, so any 3+ character substring
+    of a username, bio or location matches. Trigrams can't match shorter
+    terms, so those fall back to an (unindexed) LIKE substring match on
+    the same columns, newest user first.
+    """
+
+    INDEXES = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+        "username, bio, location, content='users', content_rowid='id', "
+        "tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users "
+        "BEGIN INSERT INTO users_fts(rowid, username, bio, location) "
+        "VALUES (new.id, new.username, new.bio, new.location); END",
+        "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users "
+        "BEGIN INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+        "VALUES ('delete', old.id, old.username, old.bio, old.location); END",
+        "CREATE TRIGGER IF NOT EXISTS users_fts_update "
+        "AFTER UPDATE OF username, bio, location ON users "
+        "BEGIN INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+        "VALUES ('delete', old.id, old.username, old.bio, old.location); "
+        "INSERT INTO users_fts(rowid, username, bio, location) "
+        "VALUES (new.id, new.username, new.bio, new.location); END",
+        "INSERT INTO users_fts(users_fts) VALUES ('rebuild')",
+
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "text, content='messages', content_rowid='id', "
+        "tokenize='porter unicode61')",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages "
+        "BEGIN INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages "
+        "BEGIN INSERT INTO messages_fts(messages_fts, rowid, text) "
+        "VALUES ('delete', old.id, old.text); END",
+        "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+    ]
+
+    USERS_SQL = """
+        SELECT rank, id FROM (
+            SELECT -bm25(users_fts, 10.0, 1.0, 2.0) AS rank, rowid AS id
+            FROM users_fts WHERE users_fts MATCH :match
+        )
+        {after}
+        ORDER BY rank DESC, id DESC
+        LIMIT :limit
+    """
+
+    MESSAGES_SQL = """
+        SELECT rank, id FROM (
+            SELECT -bm25(messages_fts) AS rank, rowid AS id
+            FROM messages_fts WHERE messages_fts MATCH :match
+        )
+        {after}
+        ORDER BY rank DESC, id DESC
+        LIMIT :limit
+    """
+
+    AFTER_SQL = "WHERE rank < :rank OR (rank = :rank AND id < :id)"
+
+    def install(self, schema):
+        for statement in self.INDEXES:
+            schema.execute(statement)
+
+    @staticmethod
+    def _phrase(term):
+        return '"' + term.replace('"', '""') + '"'
+
+    def _run(self, sql, match, limit, after):
+        params = {'match': match, 'limit': limit}
+        if after:
+            params['rank'], params['id'] = after
+
+        rows = db.session.execute(
+            db.text(sql.format(after=self.AFTER_SQL if after else "")),
+            params)
+
+        return [(rank, row_id) for (rank, row_id) in rows]
+
+    def search_users(self, term, limit, after=None):
+        if len(term) < 3:
+            pattern = f"%{escape_like(term)}%"
+            query = (db.session
+                     .query(User.id)
+                     .filter(db.or_(*[
+                         column.like(pattern, escape="\\")
+                         for column in (User.username, User.bio,
+                                        User.location)])))
+            if after:
+                query = query.filter(User.id < after[1])
+            return [(0.0, user_id) for (user_id,) in
+                    query.order_by(User.id.desc()).limit(limit)]
+
+        return self._run(self.USERS_SQL, self._phrase(term), limit, after)
+
+    def search_messages(self, term, limit, after=None):
+        words = term.split()
+        if not words:
+            return []
+
+        # Every word must match; the last one as a prefix (search-as-you-type).
+        match = " ".join(self._phrase(word) for word in words) + "*"
+
+        return self._run(self.MESSAGES_SQL, match, limit, after)
+
+
+BACKENDS = {
+    'postgresql': PostgresSearchBackend,
+    'sqlite': SqliteSearchBackend,
+}
+
+
+def connect_search(app):
+    """Set up search config and the hot-term cache."""
+
+    app.config.setdefault('SEARCH_MAX_RESULTS', SEARCH_MAX_RESULTS)
+    app.config.setdefault('SEARCH_CACHE_SIZE', 256)
+    app.config.setdefault('SEARCH_CACHE_TTL', 30)
+
+    app.extensions['search_cache'] = TTLCache(
+        maxsize=app.config['SEARCH_CACHE_SIZE'],
+        ttl=app.config['SEARCH_CACHE_TTL'])
+
+
+def get_backend():
+    """Search backend for the app's database (made on first use)."""
+
+    backend = current_app.extensions.get('search_backend')
+
+    if backend is None:
+        dialect = db.engine.dialect.name
+        if dialect not in BACKENDS:
+            raise RuntimeError(f"No search backend for {dialect} databases")
+        backend = current_app.extensions['search_backend'] = BACKENDS[dialect]()
+
+    return backend
+
+
+def _search(kind, term, cursor):
+    """Page of (rank, id) pairs for `term`, best first; via the cache.
+
+    The cursor carries the rank and id of the last result and how many
+    results came before it, so paging stops at SEARCH_MAX_RESULTS.
+    """
+
+    term = " ".join(term.split())
+    per_page = page_size()
+    max_results = current_app.config['SEARCH_MAX_RESULTS']
+
+    position = decode_cursor(cursor, float, int, int)
+    after, seen = (position[:2], position[2]) if position else (None, 0)
+
+    limit = min(per_page, max_results - seen)
+    if limit <= 0 or not term:
+        return [], None
+
+    cache = current_app.extensions['search_cache']
+    key = (kind, term.lower(), after, limit)
+
+    results = cache.get(key)
+    if results is None:
+        search = getattr(get_backend(), f"search_{kind}")
+        results = search(term, limit + 1, after)
+        cache.set(key, results)
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        if seen + limit < max_results:
+            next_cursor = encode_cursor(*results[-1], seen + limit)
+
+    return results, next_cursor
+
+
+def _hydrate(query, model, results):
+    ids = [row_id for (_, row_id) in results]
+    if not ids:
+        return []
+
+    by_id = {row.id: row for row in query.filter(model.id.in_(ids))}
+    return [by_id[row_id] for row_id in ids if row_id in by_id]
+
+
+def search_users(term, cursor=None):
+    """Page of users matching `term`, best match first."""
+
+    results, next_cursor = _search('users', term, cursor)
+    return Page(_hydrate(User.query, User, results), next_cursor)
+
+
+def search_messages(term, cursor=None):
+    """Page of messages matching `term`, best match first."""
+
+    results, next_cursor = _search('messages', term, cursor)
+    query = Message.query.options(*MESSAGE_CARD_OPTIONS)
+    return Page(_hydrate(query, Message, results), next_cursor)
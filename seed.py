@@ -1,19 +1,11 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db, connect_db
-from models import User, Message, Follows
+Recreates the schema and loads generator/*.csv. This is a thin wrapper
+around loader.py, which also does appends, bigger datasets and parallel
+loads (`python loader.py --help`).
+"""
 
-db.drop_all()
-db.create_all()
+from loader import main
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+if __name__ == '__main__':
+    main(["--dir", "generator"])
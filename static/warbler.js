@@ -1,19 +1,27 @@
 $heartIcon = $('.fa-heart')
 
+// Like/unlike in place: PUT or DELETE the like, then show the state the
+// server reports. Both requests are idempotent, so double clicks are safe.
 $heartIcon.on('click', async (evt) => {
-    let msgId = $(evt.target).data('msgid')
-    resp = await axios.post(`/messages/${msgId}/likes`)
-    toggleIcon($(evt.target))
-})
+    evt.preventDefault()
+    let $icon = $(evt.target)
+    let msgId = $icon.data('msgid')
+    let method = $icon.hasClass('far') ? 'put' : 'delete'
 
-function toggleIcon($icon) {
-    if($icon.hasClass('far')) {
-        $icon.removeClass('far')
-        $icon.addClass('fas')
-    } else {
-        $icon.removeClass('fas')
-        $icon.addClass('far')
+    try {
+        let resp = await axios({ method, url: `/api/messages/${msgId}/like` })
+        showLike($icon, resp.data)
+    } catch (err) {
+        if (err.response && err.response.status === 401) {
+            window.location = '/login'
+        }
     }
+})
+
+function showLike($icon, { liked, like_count }) {
+    $icon.toggleClass('fas', liked)
+    $icon.toggleClass('far', !liked)
+    $icon.attr('title', `${like_count} like${like_count === 1 ? '' : 's'}`)
 }
 
 
@@ -0,0 +1,251 @@
+"""Who to follow: accounts followed by the accounts a user follows.
+
+A user's candidates are the accounts two follows away that they don't
+follow yet, ranked by overlap (how many of the accounts they follow
+follow the candidate), then by id. Counting that per page view means
+reading the follows of everyone the user follows, so it's precomputed:
+
+- `flask suggest-follows` recomputes everyone, SUGGESTIONS_CHUNK
+  followers per query and transaction, into follow_suggestions (the
+  best SUGGESTIONS_PER_USER rows per user). Run it on a schedule (e.g.
+  nightly); it's the only thing that picks up changes made by the
+  people a user follows.
+- When a user follows or unfollows, `follows_changed` queues them, and
+  a background thread (see background.py) recomputes the queued users
+  SUGGESTIONS_CHUNK at a time. The request itself only drops newly
+  followed accounts from the user's cached list. The queue is per
+  process; whatever a process loses is caught by the scheduled run.
+- Reads are one query, joined to users and skipping anyone the user
+  follows by now, through a per-process TTL cache
+  (SUGGESTIONS_CACHE_TTL) of the rows shown.
+"""
+
+import heapq
+from collections import defaultdict
+from threading import Lock
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import orm
+
+from background import BackgroundWorker
+from cache import TTLCache
+from models import db, Follows, FollowSuggestion, User, DELETED_USER_IDS
+
+SUGGESTIONS_PER_USER = 10
+SUGGESTIONS_CHUNK = 500
+SUGGESTIONS_REFRESH_SECONDS = 60
+
+_pending_lock = Lock()
+
+
+def compute(user_ids, per_user=SUGGESTIONS_PER_USER):
+    """{user id: [(overlap, suggested id)]}, best first, for `user_ids`."""
+
+    mine = orm.aliased(Follows)
+    theirs = orm.aliased(Follows)
+    already = orm.aliased(Follows)
+
+    followed_already = (db.exists()
+                        .where(already.user_following_id
+                               == mine.user_following_id)
+                        .where(already.user_being_followed_id
+                               == theirs.user_being_followed_id))
+
+    rows = (db.session
+            .query(mine.user_following_id,
+                   theirs.user_being_followed_id,
+                   db.func.count())
+            .join(theirs,
+                  theirs.user_following_id == mine.user_being_followed_id)
+            .filter(mine.user_following_id.in_(user_ids))
+            .filter(theirs.user_being_followed_id != mine.user_following_id)
+            .filter(mine.user_being_followed_id.notin_(DELETED_USER_IDS))
+            .filter(theirs.user_being_followed_id.notin_(DELETED_USER_IDS))
+            .filter(~followed_already)
+            .group_by(mine.user_following_id, theirs.user_being_followed_id))
+
+    candidates = defaultdict(list)
+    for user_id, suggested_id, overlap in rows:
+        candidates[user_id].append((overlap, -suggested_id))
+
+    return {
+        user_id: [(overlap, -negated_id) for overlap, negated_id in
+                  heapq.nlargest(per_user, candidates.get(user_id, ()))]
+        for user_id in user_ids
+    }
+
+
+def store(ranked):
+    """Replace the stored suggestions of the users in `ranked`.
+
+    The caller commits.
+    """
+
+    (FollowSuggestion.query
+        .filter(FollowSuggestion.user_id.in_(list(ranked)))
+        .delete(synchronize_session=False))
+
+    db.session.bulk_insert_mappings(FollowSuggestion, [
+        {'user_id': user_id, 'suggested_id': suggested_id,
+         'overlap': overlap}
+        for user_id, suggestions in ranked.items()
+        for overlap, suggested_id in suggestions
+    ])
+
+
+def recompute_all(chunk_size=SUGGESTIONS_CHUNK,
+                  per_user=SUGGESTIONS_PER_USER):
+    """Recompute every user who follows anyone; returns how many.
+
+    Users who follow nobody have no suggestions; their rows were cleared
+    by recompute_pending after they unfollowed.
+    """
+
+    done = 0
+    last_id = 0
+
+    while True:
+        user_ids = [user_id for (user_id,) in
+                    db.session.query(Follows.user_following_id)
+                    .filter(Follows.user_following_id > last_id)
+                    .distinct()
+                    .order_by(Follows.user_following_id)
+                    .limit(chunk_size)]
+        if not user_ids:
+            return done
+
+        store(compute(user_ids, per_user))
+        db.session.commit()
+
+        done += len(user_ids)
+        last_id = user_ids[-1]
+
+
+def get_cache():
+    return current_app.extensions['suggestion_cache']
+
+
+def reset():
+    """Forget this process's cached and queued suggestions (between tests)."""
+
+    get_cache().clear()
+    with _pending_lock:
+        current_app.extensions['suggestion_pending'].clear()
+
+
+def follows_changed(user_id, followed_ids=()):
+    """Queue `user_id`'s suggestions for recomputing after they
+    (un)followed someone, and stop suggesting `followed_ids` now."""
+
+    followed_ids = set(followed_ids)
+    cache = get_cache()
+    cached = cache.get(user_id)
+    if cached is not None and followed_ids:
+        cache.set(user_id, [row for row in cached
+                            if row.id not in followed_ids])
+
+    with _pending_lock:
+        current_app.extensions['suggestion_pending'].add(user_id)
+
+    if current_app.config['SUGGESTIONS_IN_BACKGROUND']:
+        current_app.extensions['suggestion_worker'].notify()
+
+
+def recompute_pending(chunk_size=SUGGESTIONS_CHUNK,
+                      per_user=SUGGESTIONS_PER_USER):
+    """Recompute the users queued by follows_changed; returns how many."""
+
+    pending = current_app.extensions['suggestion_pending']
+    cache = get_cache()
+    done = 0
+
+    while True:
+        with _pending_lock:
+            user_ids = [pending.pop()
+                        for _ in range(min(chunk_size, len(pending)))]
+        if not user_ids:
+            return done
+
+        store(compute(user_ids, per_user))
+        db.session.commit()
+
+        for user_id in user_ids:
+            cache.pop(user_id)
+        done += len(user_ids)
+
+
+def suggestions_for(user_id):
+    """Rows (id, username, image_url, overlap) of the users suggested to
+    `user_id`, best first (cached)."""
+
+    cache = get_cache()
+    suggested = cache.get(user_id)
+
+    if suggested is None:
+        followed_already = (db.exists()
+                            .where(Follows.user_following_id == user_id)
+                            .where(Follows.user_being_followed_id
+                                   == FollowSuggestion.suggested_id))
+
+        suggested = (db.session
+                     .query(User.id, User.username, User.image_url,
+                            FollowSuggestion.overlap)
+                     .join(FollowSuggestion,
+                           FollowSuggestion.suggested_id == User.id)
+                     .filter(FollowSuggestion.user_id == user_id)
+                     .filter(~followed_already)
+                     .order_by(FollowSuggestion.overlap.desc(),
+                               FollowSuggestion.suggested_id)
+                     .all())
+        cache.set(user_id, suggested)
+
+    return suggested
+
+
+@click.command('suggest-follows')
+@with_appcontext
+def suggest_command():
+    """Recompute "who to follow" suggestions for every user."""
+
+    done = recompute_all(current_app.config['SUGGESTIONS_CHUNK'],
+                         current_app.config['SUGGESTIONS_PER_USER'])
+    click.echo(f"Recomputed suggestions for {done} user(s).")
+
+
+def connect_suggestions(app):
+    """Set up the suggestion cache, the worker recomputing users who
+    (un)followed someone, and the `flask suggest-follows` command.
+
+    With SUGGESTIONS_IN_BACKGROUND off, queued users wait for
+    recompute_pending (or the command).
+    """
+
+    app.config.setdefault('SUGGESTIONS_PER_USER', SUGGESTIONS_PER_USER)
+    app.config.setdefault('SUGGESTIONS_CHUNK', SUGGESTIONS_CHUNK)
+    app.config.setdefault('SUGGESTIONS_CACHE_SIZE', 10000)
+    app.config.setdefault('SUGGESTIONS_CACHE_TTL', 300)
+    app.config.setdefault('SUGGESTIONS_REFRESH_SECONDS',
+                          SUGGESTIONS_REFRESH_SECONDS)
+    app.config.setdefault('SUGGESTIONS_IN_BACKGROUND', True)
+
+    app.extensions['suggestion_cache'] = TTLCache(
+        maxsize=app.config['SUGGESTIONS_CACHE_SIZE'],
+        ttl=app.config['SUGGESTIONS_CACHE_TTL'])
+    app.extensions['suggestion_pending'] = set()
+
+    worker = app.extensions['suggestion_worker'] = BackgroundWorker(
+        app, "follow-suggestions",
+        lambda: recompute_pending(app.config['SUGGESTIONS_CHUNK'],
+                                  app.config['SUGGESTIONS_PER_USER']),
+        app.config['SUGGESTIONS_REFRESH_SECONDS'])
+
+    @app.before_first_request
+    def start_suggestion_worker():
+        if app.config['SUGGESTIONS_IN_BACKGROUND']:
+            worker.start()
+
+    app.cli.add_command(suggest_command)
+
+    return worker
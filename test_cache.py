@@ -0,0 +1,58 @@
+"""TTLCache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+from unittest import TestCase
+
+from cache import TTLCache
+
+
+class FakeTimer:
+    """Clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTestCase(TestCase):
+    """Test the LRU + TTL cache."""
+
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = TTLCache(maxsize=2, ttl=10, timer=self.timer)
+
+    def test_get_and_expire(self):
+        """Are entries returned until their TTL runs out?"""
+
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+
+        self.timer.now = 10
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_evicts_least_recently_used(self):
+        """Is the least recently used entry dropped past maxsize?"""
+
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("c"), 3)
+
+    def test_pop(self):
+        """Does pop invalidate an entry?"""
+
+        self.cache.set("a", 1)
+        self.cache.pop("a")
+        self.cache.pop("missing")
+
+        self.assertIsNone(self.cache.get("a"))
@@ -6,9 +6,16 @@
 
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import (
+    db, connect_db, JobLease, Message, User, Like, TrendingMessage)
+from instrumentation import QueryBudgetMixin
+import graph
+import suggestions
+import timeline
+import trending
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -31,13 +38,26 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs in the tests, not on worker threads.
+app.config['PURGE_IN_BACKGROUND'] = False
+app.config['TRENDING_IN_BACKGROUND'] = False
+app.config['GRAPH_IN_BACKGROUND'] = False
+app.config['SUGGESTIONS_IN_BACKGROUND'] = False
 
-class MessageViewTestCase(TestCase):
+
+class MessageViewTestCase(QueryBudgetMixin, TestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
+        # These live in the process, not the database; start each test
+        # without what earlier ones left there.
+        with app.app_context():
+            timeline.reset()
+            graph.reset()
+            suggestions.reset()
+
         User.query.delete()
         Message.query.delete()
 
@@ -46,12 +66,14 @@ class MessageViewTestCase(TestCase):
         user = User.signup(username="testuser",
                                     email="test@test.com",
                                     password="testuser",
-                                    image_url=None)
+                                    image_url=None,
+                                    admin=False)
 
         user2 = User.signup(username="testuser2",
                                     email="test2@test.com",
                                     password="testuser",
-                                    image_url=None)
+                                    image_url=None,
+                                    admin=False)
 
         db.session.add(user)
         db.session.add(user2)
@@ -130,6 +152,127 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized.",html)
 
-    
+    def test_message_pages_query_budget(self):
+        """Do message cards run a fixed number of queries, however many?"""
+        for i in range(10):
+            db.session.add(Message(text=f"hello {i}", user_id=self.testuser2.id))
+        db.session.commit()
+        msg_id = Message.query.first().id
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post(f"/users/follow/{user2_id}")
+
+            for url, budget in [('/', 6), (f'/messages/{msg_id}', 3)]:
+                with self.assertMaxQueries(budget, url):
+                    resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("hello", resp.get_data(as_text=True))
+
+    def test_message_card_per_viewer(self):
+        """Is a cached message card still personalised for each viewer?"""
+        db.session.add(Message(text="cached card", user_id=self.testuser2.id))
+        db.session.commit()
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            html = c.get(f"/users/{user2_id}").get_data(as_text=True)
+            self.assertIn("cached card", html)
+            self.assertIn("fa-heart", html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+            html = c.get(f"/users/{user2_id}").get_data(as_text=True)
+            self.assertIn("cached card", html)
+            self.assertNotIn("fa-heart", html)
+
+    def test_like_api(self):
+        """Can a message be liked and unliked over JSON, repeatably?"""
+        msg = Message(text="likeable", user_id=self.testuser2.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+        user_id = self.testuser.id
+
+        with self.client as c:
+            resp = c.put(f"/api/messages/{msg_id}/like")
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for _ in range(2):
+                resp = c.put(f"/api/messages/{msg_id}/like")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.get_json(),
+                                 {"liked": True, "like_count": 1})
+
+            self.assertEqual(User.query.get(user_id).likes_count, 1)
+
+            for _ in range(2):
+                resp = c.delete(f"/api/messages/{msg_id}/like")
+                self.assertEqual(resp.get_json(),
+                                 {"liked": False, "like_count": 0})
+
+            self.assertEqual(User.query.get(user_id).likes_count, 0)
+
+    def test_trending_messages(self):
+        """Are liked messages ranked into trending when it's refreshed?"""
+        Like.query.delete()
+        TrendingMessage.query.delete()
+        liked = Message(text="Hot take", user_id=self.testuser2.id)
+        plain = Message(text="Quiet one", user_id=self.testuser2.id)
+        db.session.add_all([liked, plain])
+        db.session.commit()
+        liked_id = liked.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.put(f"/api/messages/{liked_id}/like")
+
+            self.assertEqual(Message.query.get(liked_id).like_count, 1)
+            # Held by another process: this one skips its turn.
+            holder = JobLease.claim('trending', 60)
+            self.assertIsNone(trending.refresh())
+            # Only the holder's token releases it.
+            JobLease.release('trending', 'an-old-holder')
+            self.assertIsNone(trending.refresh())
+            JobLease.release('trending', holder)
+
+            self.assertEqual(trending.refresh(), 2)
+            self.assertEqual(trending.refresh(), 0)
+
+            html = c.get("/messages/trending").get_data(as_text=True)
+            self.assertLess(html.index("Hot take"), html.index("Quiet one"))
+
+    def test_trending_keeps_messages_below_the_top(self):
+        """When the top message ages out, does the next one move up?"""
+        TrendingMessage.query.delete()
+        now = datetime.utcnow()
+        older = Message(text="Older", user_id=self.testuser2.id,
+                        timestamp=now - timedelta(hours=2))
+        newer = Message(text="Newer", user_id=self.testuser2.id,
+                        timestamp=now - timedelta(minutes=30))
+        db.session.add_all([older, newer])
+        db.session.commit()
+        newer_id = newer.id
+        older.like_count = 1000
+        db.session.commit()
+
+        with app.app_context():
+            trending.refresh()
+            self.assertEqual(TrendingMessage.query.count(),
+                             Message.query.count())
 
-        
+            # Only the last hour counts now: "Older" ages out.
+            trending.refresh(window_hours=1)
+            top = trending.trending_messages(1)
+            self.assertEqual([message.id for message in top], [newer_id])
@@ -0,0 +1,119 @@
+"""Query plan tests: hot pages keep using their indexes."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_query_plans.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Message, User, Follows, Like
+from migrations import unindexed_scans
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import graph
+import suggestions
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Run background jobs in the tests, not on worker threads.
+app.config['PURGE_IN_BACKGROUND'] = False
+app.config['TRENDING_IN_BACKGROUND'] = False
+app.config['GRAPH_IN_BACKGROUND'] = False
+app.config['SUGGESTIONS_IN_BACKGROUND'] = False
+
+# Tables that grow with activity; reading one in full is never OK on a
+# page that's shown all the time.
+BIG_TABLES = {'messages', 'likes', 'follows'}
+
+
+class QueryPlanTestCase(TestCase):
+    """EXPLAIN the statements run by homepage, users_show and followers."""
+
+    def setUp(self):
+        Like.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="password")
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        self.viewer_id = users[0].id
+        self.author_id = users[1].id
+
+        for user in users[1:]:
+            db.session.add(Follows(user_following_id=self.viewer_id,
+                                   user_being_followed_id=user.id))
+            db.session.add(Follows(user_following_id=user.id,
+                                   user_being_followed_id=self.author_id))
+            for n in range(3):
+                db.session.add(Message(text=f"message {n}", user_id=user.id))
+        db.session.commit()
+
+        for message in Message.query.limit(5):
+            db.session.add(Like(user_id=self.viewer_id, message_id=message.id))
+        User.recount()
+        db.session.commit()
+
+        # These live in the process, not the database; start each test
+        # without what earlier ones left there.
+        with app.app_context():
+            timeline.reset()
+            graph.reset()
+            suggestions.reset()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def statements_for(self, url):
+        """[(statement, parameters)] of the SELECTs run to serve `url`."""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.viewer_id
+                resp = c.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(resp.status_code, 200)
+        return statements
+
+    def assertIndexed(self, url):
+        statements = self.statements_for(url)
+        self.assertTrue(statements)
+
+        for statement, parameters in statements:
+            scanned = unindexed_scans(db.engine, statement, parameters)
+            self.assertFalse(scanned & BIG_TABLES,
+                             f"{url} scans {scanned} in:\n{statement}")
+
+    def test_homepage_plans(self):
+        self.assertIndexed("/")
+
+    def test_users_show_plans(self):
+        self.assertIndexed(f"/users/{self.author_id}")
+
+    def test_users_followers_plans(self):
+        self.assertIndexed(f"/users/{self.author_id}/followers")
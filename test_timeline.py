@@ -0,0 +1,94 @@
+"""Timeline store tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from timeline import InMemoryTimelineStore, merge_entries
+
+NOW = datetime(2021, 4, 1, 12, 0)
+
+
+def entry(minutes, message_id, author_id):
+    return (NOW + timedelta(minutes=minutes), message_id, author_id)
+
+
+class InMemoryTimelineStoreTestCase(TestCase):
+    """Test the per-process timeline store."""
+
+    def setUp(self):
+        self.store = InMemoryTimelineStore(length=3)
+
+    def test_cold_timeline(self):
+        """Is an unknown timeline cold, and do pushes leave it cold?"""
+
+        self.assertIsNone(self.store.get(1))
+        self.store.push([1], entry(0, 1, 2))
+        self.assertIsNone(self.store.get(1))
+
+    def test_push_keeps_newest(self):
+        """Do pushes keep the timeline ordered and bounded?"""
+
+        self.store.set(1, [entry(1, 1, 2), entry(2, 2, 2)])
+        self.store.push([1], entry(4, 4, 3))
+        self.store.push([1], entry(3, 3, 2))
+
+        ids = [message_id for (_, message_id, _) in self.store.get(1)]
+        self.assertEqual(ids, [4, 3, 2])
+
+    def test_merge_ignores_duplicates(self):
+        """Does merging entries already in the timeline leave it unchanged?"""
+
+        self.store.set(1, [entry(1, 1, 2)])
+        self.store.merge(1, [entry(1, 1, 2)])
+
+        self.assertEqual(len(self.store.get(1)), 1)
+
+    def test_remove_author(self):
+        """Does unfollowing drop that author's entries?"""
+
+        self.store.set(1, [entry(1, 1, 2), entry(2, 2, 3)])
+        self.store.remove_author(1, 2)
+
+        self.assertEqual(self.store.get(1), [entry(2, 2, 3)])
+
+    def test_remove_from_full_timeline(self):
+        """Does removing from a full timeline make it cold?"""
+
+        self.store.set(1, [entry(1, 1, 2), entry(2, 2, 2), entry(3, 3, 2)])
+        self.store.remove([1], 2)
+
+        self.assertIsNone(self.store.get(1))
+
+    def test_expired_timeline(self):
+        """Does a timeline go cold once its ttl has passed?"""
+
+        store = InMemoryTimelineStore(length=3, ttl=0)
+        store.set(1, [entry(1, 1, 2)])
+        store.push([1], entry(2, 2, 2))
+
+        self.assertIsNone(store.get(1))
+
+
+class MergeEntriesTestCase(TestCase):
+    """Test the k-way merge of pushed and pulled entries."""
+
+    def test_merge_orders_and_limits(self):
+        """Are the lists merged newest first, ties broken by id, and cut?"""
+
+        pushed = [entry(5, 5, 2), entry(1, 1, 2)]
+        pulled = [entry(5, 6, 3), entry(3, 3, 3), entry(0, 0, 3)]
+
+        ids = [message_id for (_, message_id, _) in
+               merge_entries([pushed, pulled], 3)]
+        self.assertEqual(ids, [6, 5, 3])
+
+    def test_merge_drops_duplicates(self):
+        """Is a message in both lists returned once?"""
+
+        merged = merge_entries([[entry(1, 1, 2)], [entry(1, 1, 2)]], 10)
+        self.assertEqual(len(merged), 1)
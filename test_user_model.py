@@ -98,6 +98,32 @@ class UserModelTestCase(TestCase):
         self.assertEqual(self.u1.is_followed_by(self.u2), False)
 
 
+    def test_load_following_ids(self):
+        """Do preloaded follow checks match the follows table?"""
+        follow = Follows(user_being_followed_id=self.u2.id, user_following_id=self.u1.id)
+        db.session.add(follow)
+        db.session.commit()
+
+        self.u1.load_following_ids([self.u1.id, self.u2.id])
+
+        self.assertEqual(self.u1.is_following(self.u2), True)
+        self.assertEqual(self.u1.is_following(self.u1), False)
+
+    def test_recount(self):
+        """Does recount repair drifted counters?"""
+        follow = Follows(user_being_followed_id=self.u2.id, user_following_id=self.u1.id)
+        db.session.add(follow)
+        db.session.add(Message(text="hello", user_id=self.u1.id))
+        db.session.commit()
+
+        self.assertEqual(User.recount(), 2)
+        db.session.commit()
+
+        self.assertEqual(self.u1.messages_count, 1)
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u2.followers_count, 1)
+        self.assertEqual(User.recount(), 0)
+
     def test_signup(self):
         """successfully signs a user up"""
         response = User.signup("user3","user@hotmail.com,","pword", "google.com")
@@ -141,14 +167,14 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(bad_username)
 
+    def test_authenticate_rehashes(self):
+        """Is a hash made at another cost replaced on login?"""
 
-    
-
-
-
-
-
-        
-
+        self.u1.password = bcrypt.generate_password_hash('PASSWORD', rounds=4).decode('UTF-8')
+        db.session.commit()
 
+        response = User.authenticate(self.u1.username, 'PASSWORD')
 
+        self.assertIsInstance(response, User)
+        self.assertFalse(response.password.startswith('$2b$04$'))
+        self.assertTrue(bcrypt.check_password_hash(response.password, 'PASSWORD'))
@@ -5,11 +5,22 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
+import io
 import os
 from unittest import TestCase
 from flask import session
 
-from models import db, connect_db, Message, User
+from models import (
+    db, connect_db, Message, User, Follows, Like, AccountPurge)
+import deletion
+import graph
+import search
+import suggestions
+import timeline
+from instrumentation import QueryBudgetMixin
+from replicas import REPLICA_BIND, PRIMARY_UNTIL_KEY
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import IntegrityError, PendingRollbackError
 from sqlalchemy import exc
 
@@ -34,14 +45,27 @@ db.create_all()
 app.config['TESTING'] = True
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs in the tests, not on worker threads.
+app.config['PURGE_IN_BACKGROUND'] = False
+app.config['TRENDING_IN_BACKGROUND'] = False
+app.config['GRAPH_IN_BACKGROUND'] = False
+app.config['SUGGESTIONS_IN_BACKGROUND'] = False
 
-class UserViewTestCase(TestCase):
+
+class UserViewTestCase(QueryBudgetMixin, TestCase):
     """Test views for user."""
 
     def setUp(self):
         """Create test client, add sample data."""
         db.session.rollback()
 
+        # These live in the process, not the database; start each test
+        # without what earlier ones left there.
+        with app.app_context():
+            timeline.reset()
+            graph.reset()
+            suggestions.reset()
+
         User.query.delete()
         Message.query.delete()
 
@@ -50,12 +74,14 @@ class UserViewTestCase(TestCase):
         user = User.signup(username="testuser",
                                     email="test@test.com",
                                     password="testuser",
-                                    image_url=None)
+                                    image_url=None,
+                                    admin=False)
 
         user2 = User.signup(username="testuser2",
                                     email="test2@test.com",
                                     password="testuser2",
-                                    image_url=None)
+                                    image_url=None,
+                                    admin=False)
         
         db.session.add(user)
         db.session.add(user2)
@@ -150,11 +176,393 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 404)
     
-    def test_user_logout(self)
+    def test_user_profile_pages(self):
+        """Is the profile split into pages linked by a cursor?"""
+        app.config['PAGE_SIZE'] = 2
+        for i in range(3):
+            db.session.add(Message(text=f"message {i}", user_id=self.testuser.id))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f'/users/{self.testuser.id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("message 2", html)
+            self.assertNotIn("message 0", html)
+            self.assertIn("cursor=", html)
+
+            cursor = html.split("cursor=")[1].split('"')[0]
+            resp = c.get(f'/users/{self.testuser.id}?cursor={cursor}')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("message 0", html)
+            self.assertNotIn("cursor=", html)
+
+        app.config['PAGE_SIZE'] = 20
+
+    def test_user_pages_query_budget(self):
+        """Do user pages run a fixed number of queries, however many rows?"""
+        for i in range(10):
+            user = User(username=f"crowd{i}", email=f"crowd{i}@test.com",
+                        password="unused")
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Follows(user_following_id=user.id,
+                                   user_being_followed_id=self.testuser.id))
+            db.session.add(Follows(user_following_id=self.testuser.id,
+                                   user_being_followed_id=user.id))
+            msg = Message(text=f"crowd message {i}", user_id=user.id)
+            db.session.add(msg)
+            db.session.flush()
+            db.session.add(Like(user_id=self.testuser.id, message_id=msg.id))
+        db.session.commit()
+        User.recount()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            user_id = self.testuser.id
+            budgets = {
+                '/': 6,
+                '/users': 2,
+                f'/users/{user_id}': 3,
+                f'/users/{user_id}/following': 3,
+                f'/users/{user_id}/followers': 3,
+                f'/users/{user_id}/likes': 3,
+            }
+
+            for url, budget in budgets.items():
+                with self.assertMaxQueries(budget, url):
+                    resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('X-Query-Count', resp.headers)
+
+    def test_user_page_not_modified(self):
+        """Is an unchanged profile answered with 304 until the user posts?"""
+        user_id = self.testuser.id
+
+        with self.client as c:
+            resp = c.get(f'/users/{user_id}')
+            etag = resp.headers['ETag']
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('private', resp.headers['Cache-Control'])
+            self.assertIn('Cookie', resp.headers['Vary'])
+
+            resp = c.get(f'/users/{user_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post("/messages/new", data={"text": "Hello"})
+
+            resp = c.get(f'/users/{user_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Hello", resp.get_data(as_text=True))
+
+    def test_follow_api(self):
+        """Can a user be followed and unfollowed over JSON, repeatably?"""
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for _ in range(2):
+                resp = c.put(f'/api/users/{user2_id}/follow')
+                self.assertEqual(resp.get_json(),
+                                 {"following": True, "followers_count": 1})
+
+            for _ in range(2):
+                resp = c.delete(f'/api/users/{user2_id}/follow')
+                self.assertEqual(resp.get_json(),
+                                 {"following": False, "followers_count": 0})
+
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(User.query.get(user_id).following_count, 0)
+
+            resp = c.delete(f'/api/users/{user2_id + 100}/follow')
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.post(f'/users/stop-following/{user2_id + 100}')
+            self.assertNotEqual(resp.status_code, 500)
+
+    def test_bulk_follow_import_export(self):
+        """Does a CSV of usernames import, and export back the same?"""
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+
         with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            data = {"file": (io.BytesIO(b"username\n@testuser2\nnobody\n"
+                                        b"testuser2\ntestuser\n"),
+                             "follows.csv")}
+            resp = c.post("/users/follows/import", data=data,
+                          content_type="multipart/form-data")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 1)
+            self.assertEqual(User.query.get(user_id).following_count, 1)
+
+            resp = c.get(f"/users/{user_id}/following.csv")
+            self.assertEqual(resp.get_data(as_text=True).split(),
+                             ["username", "testuser2"])
+
+            resp = c.delete("/api/follows",
+                            json={"usernames": ["testuser2", "nobody"]})
+            self.assertEqual(resp.get_json(), {"unfollowed": [user2_id],
+                                               "not_found": ["nobody"]})
+            self.assertEqual(User.query.get(user2_id).followers_count, 0)
+
+    def test_replica_routing(self):
+        """Do GETs read from the replica, but not just after a write?"""
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+
+        app.config['SQLALCHEMY_BINDS'] = {
+            REPLICA_BIND: app.config['SQLALCHEMY_DATABASE_URI']}
+        replica = db.get_engine(app, bind=REPLICA_BIND)
+        engines = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            engines.append("replica" if conn.engine is replica else "primary")
+
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            with self.client as c:
                 with c.session_transaction() as sess:
-                    sess[CURR_USER_KEY] = self.testuser.id
-        
+                    sess[CURR_USER_KEY] = user_id
+
+                c.get(f"/users/{user2_id}")
+                self.assertEqual(set(engines), {"replica"})
+
+                del engines[:]
+                c.post(f"/users/follow/{user2_id}")
+                c.get(f"/users/{user_id}/following")
+                self.assertEqual(set(engines), {"primary"})
+
+                with c.session_transaction() as sess:
+                    sess[PRIMARY_UNTIL_KEY] = 0
+
+                del engines[:]
+                c.get(f"/users/{user_id}/following")
+                self.assertEqual(set(engines), {"replica"})
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+            app.config['SQLALCHEMY_BINDS'] = None
+
+    def test_json_read_api(self):
+        """Do the JSON read endpoints return profiles and timelines?"""
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+
+        db.session.add(Message(text="Hello", user_id=user2_id))
+        db.session.add(Follows(user_following_id=user_id,
+                               user_being_followed_id=user2_id))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/api/timeline")
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get("/api/timeline")
+            self.assertEqual([m["text"] for m in resp.get_json()["messages"]],
+                             ["Hello"])
+
+            resp = c.get(f"/api/users/{user2_id}")
+            self.assertEqual(resp.get_json()["user"]["username"], "testuser2")
+            message_id = resp.get_json()["messages"][0]["id"]
+
+            resp = c.get(f"/api/messages/{message_id}")
+            self.assertEqual(resp.get_json()["message"]["user"]["id"],
+                             user2_id)
+
+            resp = c.get(f"/api/users/{user_id}/likes")
+            self.assertEqual(resp.get_json()["messages"], [])
+
+            resp = c.get(f"/api/users/{user2_id + 100}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_delete_user_hides_then_purges(self):
+        """Is a deleted user hidden at once, and purged in chunks later?"""
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+
+        AccountPurge.query.delete()
+        for n in range(3):
+            db.session.add(Message(text=f"Bye {n}", user_id=user_id))
+        db.session.add(Follows(user_following_id=user2_id,
+                               user_being_followed_id=user_id))
+        db.session.commit()
+        db.session.add(Like(user_id=user2_id,
+                            message_id=Message.query.first().id))
+        User.recount()
+        db.session.commit()
+
+        with app.app_context():
+            app.extensions['follow_graph'].reload()
+            follow_graph = graph.get_graph()
+            timeline.get_store().invalidate(user2_id)
+            self.assertEqual(
+                len(timeline.home_timeline(user2_id).items), 3)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.location, "http://localhost/signup")
+
+            resp = c.get(f"/api/users/{user_id}")
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertIsNone(User.query.get(user_id))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(User.query.get(user2_id).following, [])
+        # Not counted or in the graph any more, before the purge runs.
+        self.assertEqual(User.query.get(user2_id).following_count, 0)
+        self.assertFalse(follow_graph.follows(user2_id, user_id))
+        self.assertEqual(User.recount(), 0)
+        with app.app_context():
+            app.extensions['follow_graph'].reload()
+            self.assertEqual(graph.get_graph().following_count(user2_id), 0)
+            follow_graph = graph.get_graph()
+
+        with app.app_context():
+            self.assertEqual(deletion.purge_pending(chunk_size=2), 1)
+            self.assertEqual(timeline.get_store().get(user2_id), [])
+        self.assertFalse(follow_graph.follows(user2_id, user_id))
+
+        purge = AccountPurge.query.get(user_id)
+        self.assertIsNotNone(purge.finished_at)
+        self.assertEqual(purge.rows_deleted, 6)
+        self.assertEqual(
+            db.session.query(Message)
+            .execution_options(include_deleted=True).count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(User.recount(), 0)
+
+    def test_follow_suggestions(self):
+        """Are friends of friends suggested, and dropped once followed?"""
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+        user3 = User.signup(username="testuser3", email="test3@test.com",
+                            password="testuser3", image_url=None,
+                            admin=False)
+        db.session.add(user3)
+        db.session.commit()
+        user3_id = user3.id
+
+        db.session.add(Follows(user_following_id=user_id,
+                               user_being_followed_id=user2_id))
+        db.session.add(Follows(user_following_id=user2_id,
+                               user_being_followed_id=user3_id))
+        db.session.commit()
+        suggestions.recompute_all()
+        with app.app_context():
+            suggestions.get_cache().clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get("/api/suggestions")
+            self.assertEqual(
+                [(s["user"]["id"], s["followed_by"])
+                 for s in resp.get_json()["suggestions"]],
+                [(user3_id, 1)])
+            self.assertIn("Who to follow", c.get("/").get_data(as_text=True))
+
+            c.post(f"/users/follow/{user3_id}")
+            resp = c.get("/api/suggestions")
+            self.assertEqual(resp.get_json()["suggestions"], [])
+
+        with app.app_context():
+            self.assertEqual(suggestions.recompute_pending(), 1)
+        resp = self.client.get("/api/suggestions")
+        self.assertEqual(resp.get_json()["suggestions"], [])
+
+    def test_follow_graph(self):
+        """Does the profile show follows from the graph, kept up to date?"""
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+        user3 = User.signup(username="testuser3", email="test3@test.com",
+                            password="testuser3", image_url=None,
+                            admin=False)
+        db.session.add(user3)
+        db.session.commit()
+        user3_id = user3.id
+
+        for follower_id, followed_id in [(user_id, user2_id),
+                                         (user2_id, user3_id),
+                                         (user3_id, user_id)]:
+            db.session.add(Follows(user_following_id=follower_id,
+                                   user_being_followed_id=followed_id))
+        db.session.commit()
+        with app.app_context():
+            app.extensions['follow_graph'].reload()
+            follow_graph = graph.get_graph()
+
+        self.assertTrue(follow_graph.follows(user2_id, user3_id))
+        self.assertFalse(follow_graph.follows(user3_id, user2_id))
+        self.assertEqual(follow_graph.followers(user3_id), [user2_id])
+        self.assertEqual(
+            follow_graph.followed_by_followed(user_id, user3_id), [user2_id])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            html = c.get(f"/users/{user3_id}").get_data(as_text=True)
+            self.assertIn("Follows you", html)
+            self.assertIn("Followed by", html)
+            self.assertIn("@testuser2</a>", html)
+
+            c.post(f"/users/stop-following/{user2_id}")
+            self.assertEqual(follow_graph.following_count(user_id), 0)
+            resp = c.get(f"/users/{user3_id}")
+            self.assertNotIn("Followed by", resp.get_data(as_text=True))
+
+            # A reload can bring in other processes' follows, so the
+            # page's ETag has to change with it.
+            with app.app_context():
+                app.extensions['follow_graph'].reload()
+            resp = c.get(f"/users/{user3_id}",
+                         headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_short_user_search(self):
+        """Do searches under 3 characters match inside username, bio and
+        location?"""
+        self.testuser2.location = "Oz"
+        db.session.commit()
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+
+        # Too short for trigrams; this is a plain query on any database.
+        backend = search.SqliteSearchBackend()
+
+        def found(term):
+            return [found_id for _, found_id in backend.search_users(term, 10)]
+
+        self.assertEqual(found("r2"), [user2_id])
+        self.assertEqual(found("Oz"), [user2_id])
+        self.assertEqual(found("te"), sorted([user_id, user2_id],
+                                             reverse=True))
+
+    def test_user_logout(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
             resp=c.get("/logout", follow_redirects=True)
 
             html = resp.get_data(as_text=True)
@@ -0,0 +1,741 @@
+"""Precomputed home timelines for Warbler (fan-out on write).
+
+Every user's home timeline is kept as a bounded list of the newest
+message ids from themselves and the users they follow. `messages_add`
+pushes a new message into the timelines of the author's followers, so a
+homepage read is one ordered id fetch plus one query to hydrate them.
+
+Authors with TIMELINE_FANOUT_THRESHOLD or more followers aren't fanned
+out. Their recent messages are kept in a per-author index instead, and
+each read does a k-way heap merge of the pushed timeline with the index
+of every such author the user follows.
+
+Timelines that aren't in the store ("cold") are rebuilt from the author
+indexes on first read. Writes never warm a cold timeline.
+
+Two stores are provided:
+
+- InMemoryTimelineStore: per-process, the default. It only sees the
+  writes made by its own process, so its timelines go cold
+  TIMELINE_MEMORY_TTL seconds after they're built; with several
+  processes, that's how stale a homepage can get.
+- RedisTimelineStore: shared between workers; needs the `redis` package.
+  Use it when more than one process serves the app.
+
+Pick one with the TIMELINE_BACKEND config ("memory" or "redis"); the
+redis store connects to TIMELINE_REDIS_URL.
+"""
+
+import heapq
+import time
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+
+from flask import current_app
+
+from models import db, Follows, Message, User, MESSAGE_CARD_OPTIONS
+from pagination import Page, encode_cursor
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - only needed for the redis backend
+    redis = None
+
+TIMELINE_LENGTH = 100
+
+# Seconds an in-memory timeline is used before it's rebuilt.
+TIMELINE_MEMORY_TTL = 60
+
+# Authors with at least this many followers aren't fanned out on write;
+# their messages are pulled from the author index when a timeline is read.
+FANOUT_THRESHOLD = 1000
+
+# Most authors loaded into the author index per query.
+AUTHOR_CHUNK = 500
+
+
+def entry_for(message):
+    """Timeline entry for `message`: (timestamp, message id, author id)."""
+
+    return (message.timestamp, message.id, message.user_id)
+
+
+class InMemoryTimelineStore:
+    """Timelines held in this process, newest entry first.
+
+    At most `max_users` timelines are kept; the least recently read ones
+    are dropped (and so go cold) past that. A timeline also goes cold
+    `ttl` seconds after it was set (never, if `ttl` is None).
+    """
+
+    def __init__(self, length=TIMELINE_LENGTH, max_users=10000,
+                 ttl=TIMELINE_MEMORY_TTL):
+        self.length = length
+        self.max_users = max_users
+        self.ttl = ttl
+        # {user id: entries}, and {user id: when it goes cold}.
+        self._timelines = OrderedDict()
+        self._expires = {}
+        self._lock = Lock()
+
+    def _entries(self, user_id):
+        """This timeline's entries, or None if it's cold; hold the lock."""
+
+        entries = self._timelines.get(user_id)
+        if entries is not None and self._expires[user_id] <= time.monotonic():
+            self._drop(user_id)
+            return None
+        return entries
+
+    def _drop(self, user_id):
+        self._timelines.pop(user_id, None)
+        self._expires.pop(user_id, None)
+
+    def get(self, user_id):
+        """Return the entries of this timeline, or None if it's cold."""
+
+        with self._lock:
+            entries = self._entries(user_id)
+            if entries is None:
+                return None
+            self._timelines.move_to_end(user_id)
+            return list(entries)
+
+    def get_many(self, user_ids):
+        """Return {user id: entries} for the warm timelines in `user_ids`."""
+
+        found = {}
+        for user_id in user_ids:
+            entries = self.get(user_id)
+            if entries is not None:
+                found[user_id] = entries
+        return found
+
+    def set(self, user_id, entries):
+        """Replace this timeline with `entries` (any order)."""
+
+        entries = sorted(set(entries), reverse=True)[:self.length]
+
+        expires = (time.monotonic() + self.ttl if self.ttl is not None
+                   else float('inf'))
+
+        with self._lock:
+            self._timelines[user_id] = entries
+            self._expires[user_id] = expires
+            self._timelines.move_to_end(user_id)
+            while len(self._timelines) > self.max_users:
+                oldest, _ = self._timelines.popitem(last=False)
+                del self._expires[oldest]
+
+    def push(self, user_ids, entry):
+        """Add `entry` to each warm timeline in `user_ids`."""
+
+        with self._lock:
+            for user_id in user_ids:
+                entries = self._entries(user_id)
+                if entries is None:
+                    continue
+                self._timelines[user_id] = self._combine(entries, [entry])
+
+    def merge(self, user_id, new_entries):
+        """Merge `new_entries` into this timeline, if it's warm."""
+
+        with self._lock:
+            entries = self._entries(user_id)
+            if entries is None:
+                return
+            self._timelines[user_id] = self._combine(entries, new_entries)
+
+    def remove(self, user_ids, message_id):
+        """Remove a message from each timeline in `user_ids`."""
+
+        self._discard(user_ids, lambda entry: entry[1] == message_id)
+
+    def remove_author(self, user_id, author_id):
+        """Remove every message by `author_id` from this timeline."""
+
+        self._discard([user_id], lambda entry: entry[2] == author_id)
+
+    def invalidate(self, user_id):
+        """Make this timeline cold."""
+
+        with self._lock:
+            self._drop(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._timelines.clear()
+            self._expires.clear()
+
+    def _combine(self, entries, new_entries):
+        return sorted(set(entries).union(new_entries),
+                      reverse=True)[:self.length]
+
+    def _discard(self, user_ids, matches):
+        """Drop matching entries.
+
+        A full timeline that loses entries is made cold instead: older
+        messages that should now move up aren't in the store.
+        """
+
+        with self._lock:
+            for user_id in user_ids:
+                entries = self._entries(user_id)
+                if entries is None:
+                    continue
+                kept = [entry for entry in entries if not matches(entry)]
+                if len(kept) == len(entries):
+                    continue
+                if len(entries) >= self.length:
+                    self._drop(user_id)
+                else:
+                    self._timelines[user_id] = kept
+
+
+class RedisTimelineStore:
+    """Timelines shared between workers, one redis sorted set per user.
+
+    Members are "<message id>:<author id>" scored by the message
+    timestamp. A separate marker key records that a timeline is warm, so
+    that an empty timeline isn't mistaken for a cold one.
+    """
+
+    def __init__(self, url, length=TIMELINE_LENGTH, ttl=24 * 60 * 60,
+                 prefix="warbler:timeline"):
+        if redis is None:
+            raise RuntimeError(
+                "TIMELINE_BACKEND is 'redis' but the redis package isn't installed")
+
+        self.client = redis.Redis.from_url(url)
+        self.length = length
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, user_id):
+        return f"{self.prefix}:{user_id}"
+
+    def _warm_key(self, user_id):
+        return f"{self.prefix}:{user_id}:warm"
+
+    @staticmethod
+    def _member(entry):
+        return f"{entry[1]}:{entry[2]}"
+
+    @staticmethod
+    def _score(entry):
+        return entry[0].timestamp()
+
+    def _parse(self, member, score):
+        message_id, author_id = member.decode().split(":")
+        return (datetime.fromtimestamp(score), int(message_id), int(author_id))
+
+    def get(self, user_id):
+        pipe = self.client.pipeline()
+        pipe.exists(self._warm_key(user_id))
+        pipe.zrevrange(self._key(user_id), 0, self.length - 1, withscores=True)
+        warm, members = pipe.execute()
+
+        if not warm:
+            return None
+
+        # Equal timestamps come back in member order; sort to break ties by id.
+        return sorted((self._parse(m, s) for m, s in members), reverse=True)
+
+    def get_many(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline()
+        for user_id in user_ids:
+            pipe.exists(self._warm_key(user_id))
+            pipe.zrevrange(self._key(user_id), 0, self.length - 1,
+                           withscores=True)
+        results = pipe.execute()
+
+        found = {}
+        for i, user_id in enumerate(user_ids):
+            warm, members = results[2 * i], results[2 * i + 1]
+            if warm:
+                found[user_id] = sorted(
+                    (self._parse(m, s) for m, s in members), reverse=True)
+        return found
+
+    def set(self, user_id, entries):
+        entries = sorted(entries, reverse=True)[:self.length]
+
+        pipe = self.client.pipeline()
+        pipe.delete(self._key(user_id))
+        if entries:
+            pipe.zadd(self._key(user_id),
+                      {self._member(e): self._score(e) for e in entries})
+            pipe.expire(self._key(user_id), self.ttl)
+        pipe.set(self._warm_key(user_id), 1, ex=self.ttl)
+        pipe.execute()
+
+    def _warm_ids(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline()
+        for user_id in user_ids:
+            pipe.exists(self._warm_key(user_id))
+        return [uid for uid, warm in zip(user_ids, pipe.execute()) if warm]
+
+    def push(self, user_ids, entry):
+        pipe = self.client.pipeline()
+        for user_id in self._warm_ids(user_ids):
+            key = self._key(user_id)
+            pipe.zadd(key, {self._member(entry): self._score(entry)})
+            pipe.zremrangebyrank(key, 0, -self.length - 1)
+            pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def merge(self, user_id, new_entries):
+        new_entries = list(new_entries)
+        if not new_entries or not self._warm_ids([user_id]):
+            return
+
+        key = self._key(user_id)
+        pipe = self.client.pipeline()
+        pipe.zadd(key, {self._member(e): self._score(e) for e in new_entries})
+        pipe.zremrangebyrank(key, 0, -self.length - 1)
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def remove(self, user_ids, message_id):
+        self._discard(user_ids, lambda entry: entry[1] == message_id)
+
+    def remove_author(self, user_id, author_id):
+        self._discard([user_id], lambda entry: entry[2] == author_id)
+
+    def invalidate(self, user_id):
+        self.client.delete(self._key(user_id), self._warm_key(user_id))
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{self.prefix}:*"):
+            self.client.delete(key)
+
+    def _discard(self, user_ids, matches):
+        for user_id in self._warm_ids(user_ids):
+            entries = self.get(user_id)
+            if entries is None:
+                continue
+            doomed = [e for e in entries if matches(e)]
+            if not doomed:
+                continue
+            if len(entries) >= self.length:
+                self.invalidate(user_id)
+            else:
+                self.client.zrem(self._key(user_id),
+                                 *[self._member(e) for e in doomed])
+
+
+def connect_timelines(app):
+    """Create the timeline stores configured for `app`.
+
+    Two stores are made with the same backend: the home timelines, and
+    the per-author indexes of recent messages that pulled authors are
+    read from.
+    """
+
+    backend = app.config.setdefault('TIMELINE_BACKEND', 'memory')
+    length = app.config.setdefault('TIMELINE_LENGTH', TIMELINE_LENGTH)
+    ttl = app.config.setdefault('TIMELINE_MEMORY_TTL', TIMELINE_MEMORY_TTL)
+    app.config.setdefault('TIMELINE_FANOUT_THRESHOLD', FANOUT_THRESHOLD)
+
+    if backend == 'memory':
+        store = InMemoryTimelineStore(length=length, ttl=ttl)
+        author_index = InMemoryTimelineStore(length=length, ttl=ttl)
+    elif backend == 'redis':
+        url = app.config['TIMELINE_REDIS_URL']
+        store = RedisTimelineStore(url, length=length)
+        author_index = RedisTimelineStore(url, length=length,
+                                          prefix="warbler:author")
+    else:
+        raise ValueError(f"Unknown TIMELINE_BACKEND: {backend!r}")
+
+    app.extensions['timeline_store'] = store
+    app.extensions['timeline_author_index'] = author_index
+    return store
+
+
+def get_store():
+    return current_app.extensions['timeline_store']
+
+
+def get_author_index():
+    return current_app.extensions['timeline_author_index']
+
+
+def reset():
+    """Empty this process's timelines and author indexes (between tests)."""
+
+    get_store().clear()
+    get_author_index().clear()
+
+
+def is_pulled(followers_count):
+    """Are an author's messages pulled at read time rather than pushed?"""
+
+    return followers_count >= current_app.config['TIMELINE_FANOUT_THRESHOLD']
+
+
+def follower_ids(user_id):
+    """Ids of the users following `user_id` (ids only, no User rows)."""
+
+    return [
+        follower_id for (follower_id,) in
+        db.session
+        .query(Follows.user_following_id)
+        .filter(Follows.user_being_followed_id == user_id)
+    ]
+
+
+##############################################################################
+# Reading timelines
+#
+# The read path is written as plans: generators that yield SELECT
+# statements and are sent back each one's rows, finishing with `return`.
+# Plans call each other with `yield from`. `run` drives one on the Flask
+# session; asgi.py drives the same plans on an AsyncSession, so both
+# serving modes read through the stores and the pull merge alike.
+
+
+def run(plan):
+    """Run a read plan on the Flask session; returns its result."""
+
+    try:
+        statement = next(plan)
+        while True:
+            statement = plan.send(db.session.execute(statement).all())
+    except StopIteration as done:
+        return done.value
+
+
+def followed_author_ids(user_id, pulled):
+    """Plan: ids of the authors `user_id` follows that are pulled (or
+    pushed)."""
+
+    threshold = current_app.config['TIMELINE_FANOUT_THRESHOLD']
+
+    statement = (db.select([Follows.user_being_followed_id])
+                 .join_from(Follows, User,
+                            User.id == Follows.user_being_followed_id)
+                 .where(Follows.user_following_id == user_id))
+
+    if pulled:
+        statement = statement.where(User.followers_count >= threshold)
+    else:
+        statement = statement.where(User.followers_count < threshold)
+
+    rows = yield statement
+    return [author_id for (author_id,) in rows]
+
+
+def followed_authors(user_id):
+    """Plan: (pushed, pulled) ids of the authors `user_id` follows, in one
+    query."""
+
+    rows = yield (db.select([Follows.user_being_followed_id,
+                             User.followers_count])
+                  .join_from(Follows, User,
+                             User.id == Follows.user_being_followed_id)
+                  .where(Follows.user_following_id == user_id))
+
+    pushed, pulled = [], []
+    for author_id, followers_count in rows:
+        if is_pulled(followers_count):
+            pulled.append(author_id)
+        else:
+            pushed.append(author_id)
+
+    return pushed, pulled
+
+
+def newest_entries(author_ids, limit, before):
+    """Plan: newest `limit` entries by any of `author_ids` older than
+    `before`.
+
+    Straight from the database; used for pages past what the stores hold.
+    """
+
+    rows = yield (db.select([Message.timestamp, Message.id, Message.user_id])
+                  .where(Message.user_id.in_(author_ids))
+                  .where(db.tuple_(Message.timestamp, Message.id) < before)
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(limit))
+
+    return [tuple(row) for row in rows]
+
+
+def newest_entries_by_author(author_ids, per_author):
+    """Plan: {author id: newest `per_author` entries, newest first}, from
+    the db."""
+
+    rank = (db.func.row_number()
+            .over(partition_by=Message.user_id,
+                  order_by=(Message.timestamp.desc(), Message.id.desc()))
+            .label('rank'))
+
+    ranked = (db.select([Message.timestamp, Message.id, Message.user_id,
+                         rank])
+              .where(Message.user_id.in_(author_ids))
+              .subquery())
+
+    rows = yield (db.select([ranked.c.timestamp, ranked.c.id,
+                             ranked.c.user_id])
+                  .where(ranked.c.rank <= per_author)
+                  .order_by(ranked.c.timestamp.desc(), ranked.c.id.desc()))
+
+    found = {author_id: [] for author_id in author_ids}
+    for row in rows:
+        found[row.user_id].append(tuple(row))
+    return found
+
+
+def author_entries(author_ids):
+    """Plan: {author id: recent entries} from the author index.
+
+    Authors missing from the index are loaded from the database in chunks
+    of AUTHOR_CHUNK and stored in the index.
+    """
+
+    index = get_author_index()
+    found = index.get_many(author_ids)
+
+    missing = [author_id for author_id in author_ids
+               if author_id not in found]
+
+    for start in range(0, len(missing), AUTHOR_CHUNK):
+        loaded = yield from newest_entries_by_author(
+            missing[start:start + AUTHOR_CHUNK], index.length)
+        for author_id, entries in loaded.items():
+            index.set(author_id, entries)
+        found.update(loaded)
+
+    return found
+
+
+def merge_entries(entry_lists, limit):
+    """K-way heap merge of newest-first entry lists.
+
+    Stops after `limit` entries, so the work is O(limit * log k) for k
+    lists. A message found in more than one list is kept once.
+    """
+
+    merged = []
+    seen = set()
+
+    for entry in heapq.merge(*entry_lists, reverse=True):
+        if entry[1] in seen:
+            continue
+        seen.add(entry[1])
+        merged.append(entry)
+        if len(merged) == limit:
+            break
+
+    return merged
+
+
+def rebuild(user_id, pushed_ids=None):
+    """Plan: rebuild this user's pushed timeline and store it.
+
+    Only the user and the pushed authors they follow (`pushed_ids`, looked
+    up if not given) are included; pulled authors are merged in on every
+    read.
+    """
+
+    store = get_store()
+
+    if pushed_ids is None:
+        pushed_ids = yield from followed_author_ids(user_id, pulled=False)
+    author_ids = [*pushed_ids, user_id]
+
+    found = yield from author_entries(author_ids)
+    entries = merge_entries(found.values(), store.length)
+    store.set(user_id, entries)
+    return entries
+
+
+def hydrate(message_ids):
+    """Load the messages (and their authors) for `message_ids`, in order.
+
+    Ids whose message no longer exists are skipped.
+    """
+
+    if not message_ids:
+        return []
+
+    messages = (Message.query
+                .options(*MESSAGE_CARD_OPTIONS)
+                .filter(Message.id.in_(message_ids)))
+
+    by_id = {message.id: message for message in messages}
+
+    return [by_id[message_id] for message_id in message_ids
+            if message_id in by_id]
+
+
+def older_entries(entries, before, limit, length):
+    """Entries of a stored list older than `before`.
+
+    Returns None if the list was cut at `length` and doesn't hold `limit`
+    of them: older entries that belong in the page aren't stored.
+    """
+
+    older = [entry for entry in entries if entry[:2] < before]
+
+    if len(older) < limit and len(entries) >= length:
+        return None
+    return older
+
+
+def timeline_entries(user_id, limit=TIMELINE_LENGTH, before=None):
+    """Plan: (entries, next cursor) of a page of this user's homepage
+    timeline, newest first.
+
+    The pushed timeline is merged with the recent messages of every
+    pulled author the user follows. `before` is the (timestamp, id) key
+    that the page starts after. Pages deeper than the stores go to the
+    database.
+    """
+
+    store = get_store()
+
+    # A cold rebuild needs both kinds of author, so look them up together.
+    pushed_ids = None
+    pushed = store.get(user_id)
+    if pushed is None:
+        pushed_ids, pulled_ids = yield from followed_authors(user_id)
+        pushed = yield from rebuild(user_id, pushed_ids)
+    else:
+        pulled_ids = yield from followed_author_ids(user_id, pulled=True)
+
+    pulled = yield from author_entries(pulled_ids)
+    entry_lists = [pushed, *pulled.values()]
+
+    if before is not None:
+        entry_lists = [older_entries(entries, before, limit + 1, store.length)
+                       for entries in entry_lists]
+
+    if None in entry_lists:
+        if pushed_ids is None:
+            pushed_ids = yield from followed_author_ids(user_id, pulled=False)
+        author_ids = [*pushed_ids, *pulled_ids, user_id]
+        entries = yield from newest_entries(author_ids, limit + 1, before)
+    else:
+        entries = merge_entries(entry_lists, limit + 1)
+
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = encode_cursor(*entries[-1][:2])
+
+    return entries, next_cursor
+
+
+def home_timeline(user_id, limit=TIMELINE_LENGTH, before=None):
+    """A page of this user's homepage timeline, as a pagination.Page of
+    messages (see timeline_entries)."""
+
+    entries, next_cursor = run(timeline_entries(user_id, limit, before))
+
+    messages = hydrate([message_id for (_, message_id, _) in entries])
+    return Page(messages, next_cursor)
+
+
+##############################################################################
+# Write hooks, called by the routes after they commit
+
+
+def message_added(message):
+    """Fan a new message out to its author and, if pushed, their followers."""
+
+    entry = entry_for(message)
+    get_author_index().push([message.user_id], entry)
+
+    recipients = [message.user_id]
+    if not is_pulled(message.user.followers_count):
+        recipients.extend(follower_ids(message.user_id))
+
+    get_store().push(recipients, entry)
+
+
+def message_removed(message_id, author_id):
+    """Take a deleted message out of the author index and timelines."""
+
+    get_author_index().remove([author_id], message_id)
+
+    recipients = follower_ids(author_id)
+    recipients.append(author_id)
+
+    get_store().remove(recipients, message_id)
+
+
+def follow_added(user_id, followed_id):
+    """Merge the newly followed user's recent messages into the timeline.
+
+    Nothing to do for a pulled author: they're merged in on every read.
+    """
+
+    followed = User.query.get(followed_id)
+    if is_pulled(followed.followers_count):
+        return
+
+    found = run(author_entries([followed_id]))
+    get_store().merge(user_id, found[followed_id])
+
+
+def follow_removed(user_id, followed_id):
+    """Take the unfollowed user's messages out of the timeline.
+
+    If this drops the unfollowed user below the fan-out threshold, their
+    followers' pushed timelines are missing the messages that were only
+    pulled, so those timelines are made cold.
+    """
+
+    store = get_store()
+    store.remove_author(user_id, followed_id)
+
+    followed = User.query.get(followed_id)
+    threshold = current_app.config['TIMELINE_FANOUT_THRESHOLD']
+
+    if followed is not None and followed.followers_count == threshold - 1:
+        for follower_id in follower_ids(followed_id):
+            store.invalidate(follower_id)
+
+
+def follows_changed(user_id, unfollowed_ids=()):
+    """Make the timeline cold after a bulk follow or unfollow.
+
+    Rebuilding it on the next read is cheaper than merging authors one
+    at a time. Unfollowed authors that dropped below the fan-out
+    threshold make their followers' timelines cold too (see
+    follow_removed).
+    """
+
+    store = get_store()
+    store.invalidate(user_id)
+
+    if not unfollowed_ids:
+        return
+
+    threshold = current_app.config['TIMELINE_FANOUT_THRESHOLD']
+    dropped = [author_id for (author_id,) in
+               db.session
+               .query(User.id)
+               .filter(User.id.in_(unfollowed_ids))
+               .filter(User.followers_count == threshold - 1)]
+
+    for author_id in dropped:
+        for follower_id in follower_ids(author_id):
+            store.invalidate(follower_id)
+
+
+def author_purged(author_id, follower_ids=()):
+    """Forget a deleted author's messages once purged: their author
+    index, their own timeline, and the timelines of `follower_ids`."""
+
+    store = get_store()
+    get_author_index().invalidate(author_id)
+    store.invalidate(author_id)
+
+    for follower_id in follower_ids:
+        store.remove_author(follower_id, author_id)
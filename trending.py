@@ -0,0 +1,186 @@
+"""Trending messages: recent messages ranked by likes, decayed by age.
+
+A message's score is
+
+    log10(like_count + 1) + (timestamp - EPOCH) / TRENDING_DECAY_SECONDS
+
+so every 10x in likes is worth TRENDING_DECAY_SECONDS of recency. Unlike
+"likes / age", this doesn't change as time passes: a message only needs
+rescoring when its like_count does. Bumping like_count sets the message's
+trending_stale flag (new messages start stale), and `refresh` rescores
+just the stale ones, a batch per transaction, into trending_messages.
+
+That table holds every message of the last TRENDING_WINDOW_HOURS, not
+just the top: a message is only rescored when it's stale, so one trimmed
+for rank would never come back once the messages above it aged out.
+Reading the page is one query down its score index.
+
+`refresh` runs every TRENDING_REFRESH_SECONDS on a background thread (see
+background.py), or on demand with `flask refresh-trending`. Every app
+process has that thread, so a refresh first claims the "trending" job
+lease (renewed with each batch); while another process holds it, the
+others skip their turn instead of rewriting the same rows. A refresh that
+finds its lease taken over stops without committing its batch.
+"""
+
+import math
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from background import BackgroundWorker
+from models import (
+    db, JobLease, Message, TrendingMessage, MESSAGE_CARD_OPTIONS)
+
+EPOCH = datetime(2020, 1, 1)
+
+TRENDING_SIZE = 50
+TRENDING_WINDOW_HOURS = 72
+TRENDING_DECAY_SECONDS = 45000
+TRENDING_REFRESH_SECONDS = 60
+TRENDING_BATCH = 1000
+TRENDING_LEASE_SECONDS = 60
+
+
+def score(like_count, timestamp, decay_seconds=TRENDING_DECAY_SECONDS):
+    """Trending score of a message (see module doc)."""
+
+    age = (timestamp - EPOCH).total_seconds()
+    return math.log10(like_count + 1) + age / decay_seconds
+
+
+def rescore_batch(batch, since, decay_seconds):
+    """Rescore up to `batch` stale messages; returns how many were stale."""
+
+    stale_ids = [message_id for (message_id,) in
+                 db.session.query(Message.id)
+                 .filter(Message.trending_stale)
+                 .limit(batch)]
+    if not stale_ids:
+        return 0
+
+    # Clear the flags first: a like landing after this sets it again, so
+    # the message is rescored next time rather than left with an old score.
+    (Message.query
+        .filter(Message.id.in_(stale_ids))
+        .update({Message.trending_stale: False}, synchronize_session=False))
+
+    rows = (db.session.query(Message.id, Message.like_count, Message.timestamp)
+            .filter(Message.id.in_(stale_ids))
+            .filter(Message.timestamp >= since))
+
+    (TrendingMessage.query
+        .filter(TrendingMessage.message_id.in_(stale_ids))
+        .delete(synchronize_session=False))
+
+    db.session.bulk_insert_mappings(TrendingMessage, [
+        {'message_id': message_id,
+         'score': score(like_count, timestamp, decay_seconds),
+         'timestamp': timestamp}
+        for message_id, like_count, timestamp in rows
+    ])
+
+    return len(stale_ids)
+
+
+def trim(since):
+    """Drop rankings of messages older than `since`."""
+
+    (TrendingMessage.query
+        .filter(TrendingMessage.timestamp < since)
+        .delete(synchronize_session=False))
+
+
+def refresh(window_hours=TRENDING_WINDOW_HOURS,
+            decay_seconds=TRENDING_DECAY_SECONDS, batch=TRENDING_BATCH,
+            lease_seconds=TRENDING_LEASE_SECONDS):
+    """Rescore every stale message and drop the ones that aged out.
+
+    Returns the number of messages rescored, or None if another process
+    is refreshing.
+    """
+
+    holder = JobLease.claim('trending', lease_seconds)
+    if holder is None:
+        return None
+
+    since = datetime.utcnow() - timedelta(hours=window_hours)
+    rescored = 0
+
+    try:
+        while True:
+            count = rescore_batch(batch, since, decay_seconds)
+            trim(since)
+            if not JobLease.renew('trending', holder, lease_seconds):
+                # It ran past its lease and someone else has the job now.
+                db.session.rollback()
+                return None
+            db.session.commit()
+
+            rescored += count
+            if count < batch:
+                return rescored
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        JobLease.release('trending', holder)
+
+
+def refresh_from_config(app):
+    return refresh(app.config['TRENDING_WINDOW_HOURS'],
+                   app.config['TRENDING_DECAY_SECONDS'])
+
+
+def trending_messages(size=None):
+    """The top trending messages, best first."""
+
+    size = size or current_app.config['TRENDING_SIZE']
+
+    return (Message.query
+            .options(*MESSAGE_CARD_OPTIONS)
+            .join(TrendingMessage,
+                  TrendingMessage.message_id == Message.id)
+            .order_by(TrendingMessage.score.desc())
+            .limit(size)
+            .all())
+
+
+@click.command('refresh-trending')
+@with_appcontext
+def refresh_command():
+    """Rescore messages whose likes changed into the trending ranking."""
+
+    rescored = refresh_from_config(current_app)
+    if rescored is None:
+        click.echo("Another process is refreshing the ranking.")
+    else:
+        click.echo(f"Rescored {rescored} message(s).")
+
+
+def connect_trending(app):
+    """Set up the refresh worker and the `flask refresh-trending` command.
+
+    With TRENDING_IN_BACKGROUND off, the ranking only moves when the
+    command runs.
+    """
+
+    app.config.setdefault('TRENDING_SIZE', TRENDING_SIZE)
+    app.config.setdefault('TRENDING_WINDOW_HOURS', TRENDING_WINDOW_HOURS)
+    app.config.setdefault('TRENDING_DECAY_SECONDS', TRENDING_DECAY_SECONDS)
+    app.config.setdefault('TRENDING_IN_BACKGROUND', True)
+
+    worker = app.extensions['trending_worker'] = BackgroundWorker(
+        app, "trending-refresh", lambda: refresh_from_config(app),
+        app.config.get('TRENDING_REFRESH_SECONDS', TRENDING_REFRESH_SECONDS))
+
+    @app.before_first_request
+    def start_trending_worker():
+        if app.config['TRENDING_IN_BACKGROUND']:
+            worker.start()
+
+    app.cli.add_command(refresh_command)
+
+    return worker